@@ -0,0 +1,83 @@
+"""
+Benchmark for the time taken to import the SSE before the gRPC server can be started.
+The SSE entry point is imported in a fresh process with python -X importtime, which requires Python 3.7 or later,
+and the modules with the largest cumulative import times are listed. The modules for each capability, which are
+imported on the first call that needs them, can be measured separately with --capabilities.
+Run from the repository root: python benchmarks/bench_import_time.py --top 15 --capabilities
+"""
+
+import os
+import sys
+import argparse
+import subprocess
+
+# Add the core and generated folders to the module path
+PARENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CORE_DIR = os.path.join(PARENT_DIR, 'core')
+
+# Modules imported on first use by the SSE for each capability
+CAPABILITY_MODULES = ['_prophet', '_clustering', '_sklearn', '_spacy', '_common']
+
+# Code run in the child process to import the SSE entry point without starting the server
+IMPORT_MAIN = "import importlib.util as u; s = u.spec_from_file_location('sse_main', {0!r}); s.loader.exec_module(u.module_from_spec(s))"
+
+def import_times(code):
+    """
+    Run code in a fresh process with -X importtime and parse the timings written to stderr.
+    :return: a tuple of the total import time in seconds and a list of (cumulative seconds, module) for top level imports
+    """
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([CORE_DIR, os.path.join(PARENT_DIR, 'generated')]))
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=CORE_DIR, env=env,\
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+    if proc.returncode != 0:
+        raise Exception(proc.stderr.strip().splitlines()[-1])
+
+    modules = []
+
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        _, cumulative, name = line[len('import time:'):].split('|')
+
+        # Modules imported directly by the code are not indented
+        if not name[1:].startswith(' '):
+            modules.append((int(cumulative) / 1e6, name.strip()))
+
+    return sum(m[0] for m in modules), modules
+
+def report(title, code, top):
+    """
+    Print the total import time and the modules that take the longest to import.
+    """
+
+    try:
+        total, modules = import_times(code)
+    except Exception as e:
+        print("{0:<40}failed: {1}".format(title, e))
+        return
+
+    print("{0:<40}{1:>10.2f} s".format(title, total))
+
+    for seconds, name in sorted(modules, reverse=True)[:top]:
+        print("    {0:<36}{1:>10.2f} s".format(name, seconds))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--capabilities', action='store_true')
+    args = parser.parse_args()
+
+    if sys.version_info < (3, 7):
+        print("python -X importtime requires Python 3.7 or later.")
+        sys.exit(1)
+
+    report("SSE entry point (core/__main__.py)", IMPORT_MAIN.format(os.path.join(CORE_DIR, '__main__.py')), args.top)
+
+    # Each capability module is measured in its own process, as it would be imported by the first call that needs it
+    if args.capabilities:
+        for module in CAPABILITY_MODULES:
+            print()
+            report("First call to {0}".format(module), "import " + module, args.top)
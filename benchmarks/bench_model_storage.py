@@ -0,0 +1,145 @@
+"""
+Benchmark for loading models saved compressed (the default) and uncompressed with storage=mmap.
+Each load is done in a fresh process, as a worker process would, and reports the load time, the time for a first
+prediction and the memory used. With mmap the arrays of the model are mapped from the page cache, so the memory
+private to each process stays small and is shared between processes loading the same model.
+Tree based models such as RandomForest copy their nodes into memory when loaded, so for these mmap mainly saves the 
+time spent decompressing. Models that keep large arrays as they are, e.g. KNeighbors, also share the memory.
+Memory figures are read from /proc and are only available on Linux.
+Run from the repository root: python benchmarks/bench_model_storage.py --estimator forest --trees 200 --processes 4
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import importlib
+import tempfile
+import subprocess
+import numpy as np
+
+# Add the core and generated folders to the module path
+PARENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(PARENT_DIR, 'core'))
+sys.path.append(os.path.join(PARENT_DIR, 'generated'))
+
+def build_model(estimator, n_trees, n_samples, n_features):
+    """
+    Fit a RandomForest or KNeighbors model on random data and wrap it in a PersistentModel as SKLearnForQlik would.
+    """
+
+    from sklearn.ensemble import RandomForestRegressor
+    from sklearn.neighbors import KNeighborsRegressor
+    from _machine_learning import PersistentModel
+
+    X = np.random.rand(n_samples, n_features)
+    y = X.sum(axis=1) + np.random.rand(n_samples)
+
+    model = PersistentModel()
+
+    if estimator == 'forest':
+        model.pipe = RandomForestRegressor(n_estimators=n_trees, n_jobs=-1).fit(X, y)
+    else:
+        model.pipe = KNeighborsRegressor(algorithm='brute').fit(X, y)
+    
+    model.n_features = n_features
+    return model
+
+def get_memory():
+    """
+    Return the resident and private memory of this process in MB.
+    """
+
+    memory = {'rss': None, 'private': None}
+
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            values = dict((line.split(':')[0], int(line.split()[1])) for line in f if line.split()[-1] == 'kB')
+        memory['rss'] = values['Rss'] / 1024
+        memory['private'] = (values['Private_Clean'] + values['Private_Dirty']) / 1024
+    except (OSError, KeyError):
+        pass
+
+    return memory
+
+def child(name, path):
+    """
+    Load a model and make a prediction, then print the timings and memory as JSON.
+    """
+
+    from _machine_learning import PersistentModel
+
+    # The estimator modules are imported first so that the memory used by them is not counted against the model
+    for module in ('sklearn.ensemble', 'sklearn.neighbors'):
+        importlib.import_module(module)
+
+    before = get_memory()
+
+    start = time.perf_counter()
+    model = PersistentModel().load(name, path)
+    load_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    model.pipe.predict(np.random.rand(100, model.n_features))
+    predict_time = time.perf_counter() - start
+
+    after = get_memory()
+    delta = {k: after[k] - before[k] if after[k] is not None else None for k in after}
+
+    print(json.dumps({'load': load_time, 'predict': predict_time, 'rss': delta['rss'], 'private': delta['private']}))
+
+def run_children(name, path, n):
+    """
+    Load the model in n processes at the same time and return their results.
+    """
+
+    procs = [subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child', name, '--path', path],\
+             stdout=subprocess.PIPE, universal_newlines=True) for _ in range(n)]
+
+    return [json.loads(p.communicate()[0].strip().splitlines()[-1]) for p in procs]
+
+def fmt(value, spec):
+    return "n/a" if value is None else format(value, spec)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--estimator', choices=['forest', 'knn'], default='forest')
+    parser.add_argument('--trees', type=int, default=200)
+    parser.add_argument('--samples', type=int, default=50000)
+    parser.add_argument('--features', type=int, default=20)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--child', nargs='?')
+    parser.add_argument('--path', nargs='?')
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.path)
+        sys.exit(0)
+
+    path = tempfile.mkdtemp() + os.sep
+
+    try:
+        model = build_model(args.estimator, args.trees, args.samples, args.features)
+
+        # Save the same model with the default compression and uncompressed as with storage=mmap
+        model.save('compressed', path, compress=3)
+        model.save('mmap', path, compress=0)
+
+        print("{0} model. Each format loaded by {1} processes at the same time.\n".format(type(model.pipe).__name__, args.processes))
+        print("{0:<12}{1:>12}{2:>12}{3:>14}{4:>14}{5:>18}".format('storage', 'file MB', 'load s', 'predict s', 'RSS MB', 'private MB'))
+
+        for name in ('compressed', 'mmap'):
+            size = os.path.getsize(path + name + '.joblib') / 1024**2
+
+            # Read the file once so that both formats are measured with a warm page cache
+            run_children(name, path, 1)
+            results = run_children(name, path, args.processes)
+
+            mean = lambda key: None if results[0][key] is None else sum(r[key] for r in results) / len(results)
+
+            print("{0:<12}{1:>12.1f}{2:>12.3f}{3:>14.3f}{4:>14}{5:>18}".format(name, size, mean('load'), mean('predict'),\
+                  fmt(mean('rss'), '.1f'), fmt(mean('private'), '.1f')))
+    finally:
+        shutil.rmtree(path)
@@ -0,0 +1,87 @@
+"""
+Benchmark for decoding SSE requests into a Data Frame.
+Compares the previous row by row decoder with the columnar decoder in _utils.request_df.
+Run from the repository root: python benchmarks/bench_request_decode.py --rows 1000000
+"""
+
+import os
+import sys
+import time
+import argparse
+import pandas as pd
+
+# Add the core and generated folders to the module path
+PARENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(PARENT_DIR, 'core'))
+sys.path.append(os.path.join(PARENT_DIR, 'generated'))
+
+import ServerSideExtension_pb2 as SSE
+import _utils as utils
+
+def request_df_rows(request_list, row_template, col_headers):
+    """
+    The previous implementation of utils.request_df, which reads the request cell by cell.
+    """
+    
+    rows = [row for request_rows in request_list for row in request_rows.rows]
+    outer = []
+    
+    for i in range(len(rows)):
+        inner = []
+        
+        for j in range(len(row_template)):
+            inner.append(getattr(rows[i].duals[j], row_template[j]))
+        
+        outer.append(inner)
+    
+    return pd.DataFrame(outer, columns=col_headers)
+
+def build_request(n_rows, bundle_size):
+    """
+    Build a request similar to a load script call to a sklearn predict function.
+    """
+
+    request_list = []
+
+    for start in range(0, n_rows, bundle_size):
+        rows = [SSE.Row(duals=[SSE.Dual(strData="model"), SSE.Dual(strData=str(i)), SSE.Dual(numData=i * 0.5),\
+                SSE.Dual(numData=i % 7), SSE.Dual(strData="cat{}".format(i % 13))]) for i in range(start, min(start + bundle_size, n_rows))]
+        request_list.append(SSE.BundledRows(rows=rows))
+    
+    return request_list
+
+def timed(func, *args, repeat=3):
+    """
+    Return the best time in seconds for func(*args) along with its result.
+    """
+
+    best = None
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--bundle_size', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    request_list = build_request(args.rows, args.bundle_size)
+    row_template = ['strData', 'strData', 'numData', 'numData', 'strData']
+    col_headers = ['model_name', 'key', 'n1', 'n2', 'cat']
+
+    t_rows, df_rows = timed(request_df_rows, request_list, row_template, col_headers, repeat=args.repeat)
+    t_cols, df_cols = timed(utils.request_df, request_list, row_template, col_headers, repeat=args.repeat)
+
+    assert df_rows.equals(df_cols), "The decoders returned different results"
+
+    print("Rows: {0:,}, bundles: {1:,}".format(args.rows, len(request_list)))
+    print("Row by row decoder: {0:.3f}s".format(t_rows))
+    print("Columnar decoder:   {0:.3f}s".format(t_cols))
+    print("Speed up: {0:.2f}x".format(t_rows / t_cols))
@@ -0,0 +1,109 @@
+"""
+Benchmark for encoding responses as SSE.Rows.
+Compares the previous row by row encoder with _utils.encode_response for string, numeric and mixed responses.
+Run from the repository root: python benchmarks/bench_response_encode.py --rows 200000
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+# Add the core and generated folders to the module path
+PARENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(PARENT_DIR, 'core'))
+sys.path.append(os.path.join(PARENT_DIR, 'generated'))
+
+import ServerSideExtension_pb2 as SSE
+import _utils as utils
+
+def get_response_rows(response, template):
+    """
+    The previous implementation of utils.encode_response, which was called with response.values.tolist().
+    """
+
+    response_rows = []
+
+    for row in response:
+        i = 0
+        this_row = []
+
+        if len(template) > 1:
+            for col in row:
+                if template[i] == "str":
+                    if col is None:
+                        col = "\x00"
+                    elif type(col) is not str:
+                        col = "{0:.5f}".format(col)
+                    this_row.append(SSE.Dual(strData=col))
+                elif template[i] == "num":
+                    this_row.append(SSE.Dual(numData=col))
+                elif template[i] == "dual":
+                    this_row.append(SSE.Dual(strData=col, numData=col))
+                i = i + 1
+        else:
+            if template[0] == "str":
+                if row is None:
+                    row = "\x00"
+                elif type(row) is not str:
+                    row = "{0:.5f}".format(row)
+                this_row.append(SSE.Dual(strData=row))
+            elif template[0] == "num":
+                this_row.append(SSE.Dual(numData=row))
+            elif template[0] == "dual":
+                this_row.append(SSE.Dual(strData=row, numData=row))
+
+        response_rows.append(iter(this_row))
+
+    return [SSE.Row(duals=duals) for duals in response_rows]
+
+def build_responses(n_rows):
+    """
+    Build responses similar to those returned by the sklearn functions, e.g. a key and a prediction for each row.
+    """
+
+    df = pd.DataFrame({'key': [str(i) for i in range(n_rows)], 'label': ["cat{}".format(i % 13) for i in range(n_rows)],\
+                       'score': np.random.rand(n_rows), 'count': np.arange(n_rows, dtype=np.float64)})
+
+    return {
+        'string': (df[['key', 'label']], ["str", "str"]),
+        'numeric': (df[['score', 'count']], ["num", "num"]),
+        'mixed': (df, ["str", "str", "num", "num"]),
+        'single string': (df['label'], ["str"]),
+        'single numeric': (df['score'], ["num"])
+    }
+
+def timed(func, *args, repeat=3):
+    """
+    Return the best time in seconds for func(*args) along with its result.
+    """
+
+    best = None
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print("Rows: {0:,}".format(args.rows))
+    print("{0:<16}{1:>12}{2:>12}{3:>12}".format('response', 'row s', 'column s', 'speed up'))
+
+    for name, (response, template) in build_responses(args.rows).items():
+        t_rows, rows = timed(lambda: get_response_rows(response.values.tolist(), template), repeat=args.repeat)
+        t_cols, cols = timed(utils.encode_response, response, template, repeat=args.repeat)
+
+        assert [r.SerializeToString() for r in rows] == [r.SerializeToString() for r in cols],\
+               "The encoders returned different results"
+
+        print("{0:<16}{1:>12.3f}{2:>12.3f}{3:>11.2f}x".format(name, t_rows, t_cols, t_rows / t_cols))
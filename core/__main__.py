@@ -8,7 +8,11 @@ import sys
 import time
 import locale
 import warnings
+import importlib
+import threading
 from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict
 
 # Add Generated folder to module path.
 PARENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -27,11 +31,20 @@ import pandas as pd
 from pandas.api.types import is_string_dtype
 from pandas.api.types import is_numeric_dtype
 import _utils as utils
-from _prophet import ProphetForQlik
-from _clustering import HDBSCANForQlik
-from _sklearn import SKLearnForQlik
-from _spacy import SpaCyForQlik
-from _common import CommonFunction
+import _executors as executors
+import _metrics as metrics
+import _jobs as jobs
+from _cache import ResponseCache, SingleFlight, LeaderCancelled, ModelCache
+
+# The classes implementing each capability and their modules. The modules are imported on the first call that needs them, 
+# as they load heavy libraries such as fbprophet, hdbscan, tensorflow and spaCy that would otherwise slow down startup.
+_CAPABILITY_MODULES = {'ProphetForQlik': '_prophet', 'HDBSCANForQlik': '_clustering', 'SKLearnForQlik': '_sklearn',\
+                       'SpaCyForQlik': '_spacy', 'CommonFunction': '_common'}
+_imported = set()
+_import_lock = threading.Lock()
+
+# Model caches set up by the server, which are given to the capability classes when they are imported
+_model_caches = {}
 
 # Set the default port for this SSE Extension
 _DEFAULT_PORT = '50055'
@@ -39,6 +52,44 @@ _DEFAULT_PORT = '50055'
 # Set the maximum message length for gRPC in bytes
 MAX_MESSAGE_LENGTH = 10 * 1024 * 1024
 
+# Set the default target size for response bundles in bytes
+_DEFAULT_BUNDLE_BYTES = 1024 * 1024
+
+# Set the default number of threads and queue depth for the pools used by each class of functions
+_DEFAULT_POOL_WORKERS = {'training': 2, 'setup': 4, 'forecasting': 4, 'nlp': 2, 'prediction': 8}
+_DEFAULT_POOL_QUEUE = {'training': 8, 'setup': 16, 'forecasting': 16, 'nlp': 8, 'prediction': 32}
+
+# Set the default memory budget in megabytes and time to live in seconds for the response cache
+_DEFAULT_CACHE_MB = 100
+_DEFAULT_CACHE_TTL = 3600
+
+# Set the default number of seconds between metrics summaries in the log
+_DEFAULT_METRICS_INTERVAL = 300
+
+# Set the default interface for serving metrics. Only local connections are accepted unless this is overridden.
+_DEFAULT_METRICS_HOST = '127.0.0.1'
+
+# Set the default memory budget in megabytes and eviction policy for the machine learning model cache
+_DEFAULT_MODEL_CACHE_MB = 512
+_DEFAULT_MODEL_CACHE_POLICY = 'lru'
+
+# Functions that consume the request as it is streamed from Qlik. These are never cached, coalesced or executed in a 
+# worker process, as that would require the complete request to be read first.
+_STREAMING_FUNCTIONS = {13}
+
+# Functions that submit or query background jobs. The jobs are kept by the server process, so these are never cached, 
+# coalesced or executed in a worker process.
+_JOB_FUNCTIONS = {46, 47}
+
+# Set the default number of models trained at the same time by background jobs
+_DEFAULT_JOB_WORKERS = 1
+
+# Set the default size limit in megabytes for the fitted transformers cached on disk with cache_preprocessing=true
+_DEFAULT_PREPROCESSING_CACHE_MB = 1024
+
+# Set the default number of threads used to load the models in the warm-up manifest
+_DEFAULT_WARMUP_THREADS = 4
+
 _ONE_DAY_IN_SECONDS = 60 * 60 * 24
 _MINFLOAT = float('-inf')
 
@@ -50,17 +101,130 @@ class ExtensionService(SSE.ConnectorServicer):
     A SSE-plugin to provide Python data science functions for Qlik.
     """
 
-    def __init__(self, funcdef_file):
+    # Target size in bytes for the BundledRows streamed back to Qlik
+    bundle_bytes = _DEFAULT_BUNDLE_BYTES
+
+    def __init__(self, funcdef_file, bundle_bytes=_DEFAULT_BUNDLE_BYTES, processes=0, cache_mb=_DEFAULT_CACHE_MB,\
+                 cache_ttl=_DEFAULT_CACHE_TTL, pool_workers=None, pool_queue=None, metrics_port=0,\
+                 metrics_host=_DEFAULT_METRICS_HOST, metrics_interval=_DEFAULT_METRICS_INTERVAL, model_cache_mb=_DEFAULT_MODEL_CACHE_MB,\
+                 model_cache_policy=_DEFAULT_MODEL_CACHE_POLICY, pin_models=None, watch_models=0, warmup=None,\
+                 preprocessing_cache_mb=_DEFAULT_PREPROCESSING_CACHE_MB, job_workers=_DEFAULT_JOB_WORKERS):
         """
         Class initializer.
         :param funcdef_file: a function definition JSON file
+        :param bundle_bytes: target size in bytes for each bundle in the response
+        :param processes: number of worker processes for functions flagged with "Process": true in the definition file. 
+        :                 If 0, all functions are executed in the gRPC threads.
+        :param cache_mb: memory budget in megabytes for caching responses of functions flagged with "Cache": true in the 
+        :                definition file. If 0, responses are not cached.
+        :param cache_ttl: time to live for cached responses in seconds. If 0, cached responses don't expire.
+        :param pool_workers: dictionary of the number of threads for each class of functions in function_pools
+        :param pool_queue: dictionary of the maximum number of queued calls for each class of functions in function_pools
+        :param metrics_port: port for serving metrics in the Prometheus text format over HTTP. If 0, metrics are not served.
+        :param metrics_host: interface for serving metrics. By default only local connections are accepted.
+        :param metrics_interval: seconds between metrics summaries in the log. If 0, no summaries are logged.
+        :param model_cache_mb: memory budget in megabytes for machine learning models kept in memory between calls
+        :param model_cache_policy: eviction policy for the model cache, 'lru' or 'lfu'
+        :param pin_models: list of model names that are never evicted from the model cache
+        :param watch_models: seconds between checks for cached models that have changed on disk. Changed models are 
+        :                    removed from the cache and loaded again. If 0, models are only checked when they are used.
+        :param warmup: a JSON manifest file listing the models to load into the model caches before the server is started
+        :param preprocessing_cache_mb: size limit in megabytes for the temporary directory used to cache fitted transformers
+        :                              for machine learning models fitted with cache_preprocessing=true
+        :param job_workers: number of models trained at the same time by jobs submitted with sklearn_Fit_Async
         """
         self._function_definitions = funcdef_file
+
+        # Bundles must stay well within the maximum message length for gRPC
+        if not 0 < bundle_bytes <= MAX_MESSAGE_LENGTH//2:
+            err = "bundle_bytes must be between 1 and {0} bytes.".format(MAX_MESSAGE_LENGTH//2)
+            raise Exception(err)
+        
+        # The handlers are static methods so the setting is kept at the class level
+        self.__class__.bundle_bytes = bundle_bytes
         os.makedirs('logs', exist_ok=True)
         log_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logger.config')
         logging.config.fileConfig(log_file)
         logging.info('Logging enabled')
 
+        # Get the ids of functions that should be executed in worker processes or cached from the function definitions
+        with open(self.function_definitions) as json_file:
+            definitions = json.load(json_file)['Functions']
+            self.process_functions = {definition['Id'] for definition in definitions if definition.get('Process', False)}
+            self.cache_functions = {definition['Id'] for definition in definitions if definition.get('Cache', False)}
+            self.coalesce_functions = {definition['Id'] for definition in definitions if definition.get('Coalesce', False)}
+        
+        # Streaming functions are always executed in the gRPC threads as the request arrives
+        # Job functions are also executed in the gRPC threads as the jobs are kept by this process
+        self.process_functions -= _STREAMING_FUNCTIONS | _JOB_FUNCTIONS
+        self.cache_functions -= _STREAMING_FUNCTIONS | _JOB_FUNCTIONS
+        self.coalesce_functions -= _STREAMING_FUNCTIONS | _JOB_FUNCTIONS
+        
+        # Set up the response cache
+        self.response_cache = ResponseCache(cache_mb * 1024 * 1024, cache_ttl) if cache_mb > 0 else None
+
+        # Identical calls in flight at the same time are coalesced into a single execution
+        self.single_flight = SingleFlight()
+
+        # Export the cache statistics along with the metrics for each call
+        if self.response_cache is not None:
+            metrics.registry.register_collector('sse_response_cache', self.response_cache.stats, help="Response cache statistics",\
+                                                counters=('hits', 'misses', 'evictions'))
+        
+        metrics.registry.register_collector('sse_single_flight', lambda: {'coalesced': self.single_flight.coalesced},\
+                                            help="Number of calls that shared the result of an identical call in flight",\
+                                            counters=('coalesced',))
+        
+        # Set up the caches for machine learning, pretrained and spaCy models, each with its own memory budget
+        # The caches are given to the classes using them when they are imported
+        for name in ('SKLearnForQlik', 'CommonFunction', 'SpaCyForQlik'):
+            _model_caches[name] = ModelCache(model_cache_mb * 1024 * 1024, model_cache_policy.lower(), pin_models)
+        
+        model_cache_counters = ('hits', 'misses', 'evictions', 'invalidations')
+        metrics.registry.register_collector('sse_model_cache', _model_caches['SKLearnForQlik'].stats,\
+                                            help="Model cache statistics", counters=model_cache_counters)
+        metrics.registry.register_collector('sse_pretrained_model_cache', _model_caches['CommonFunction'].stats,\
+                                            help="Pretrained model cache statistics", counters=model_cache_counters)
+        metrics.registry.register_collector('sse_spacy_model_cache', _model_caches['SpaCyForQlik'].stats,\
+                                            help="spaCy model cache statistics", counters=model_cache_counters)
+
+        # Optionally watch for cached models replaced on disk, e.g. by another SSE sharing the models directory
+        # Machine learning models are loaded again, while other models are loaded on their next use
+        if watch_models > 0:
+            _model_caches['SKLearnForQlik'].watch(watch_models, reload=lambda name: get_class('SKLearnForQlik').reload_model(name))
+            _model_caches['CommonFunction'].watch(watch_models)
+            _model_caches['SpaCyForQlik'].watch(watch_models)
+            self._watch_registry(watch_models)
+        
+        # The models in the warm-up manifest are loaded when the server is started
+        self.warmup = warmup
+
+        # Set the size limit for the fitted transformers cached on disk
+        utils.transformer_cache.bytes_limit = preprocessing_cache_mb * 1024 * 1024
+
+        # Set the number of background jobs executed at the same time and export the number of jobs in each state
+        jobs.registry.max_workers = job_workers
+        metrics.registry.register_collector('sse_jobs', jobs.registry.stats, help="Background jobs by state")
+
+        # The metrics server and summary are started with the server
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
+        self.metrics_interval = metrics_interval
+
+        # Set up a separate pool for each class of functions so that long running calls don't hold up interactive ones
+        workers = dict(_DEFAULT_POOL_WORKERS, **(pool_workers or {}))
+        queue_depth = dict(_DEFAULT_POOL_QUEUE, **(pool_queue or {}))
+
+        if set(workers) != set(_DEFAULT_POOL_WORKERS) or set(queue_depth) != set(_DEFAULT_POOL_QUEUE):
+            err = "Invalid pool name. Valid pools are: {0}".format(", ".join(_DEFAULT_POOL_WORKERS))
+            raise Exception(err)
+        
+        self.pools = {name: executors.Bulkhead(name, int(workers[name]), int(queue_depth[name])) for name in _DEFAULT_POOL_WORKERS}
+        
+        # The process pool is created when the server starts
+        self.processes = processes
+        self.process_pool = None
+
     @property
     def function_definitions(self):
         """
@@ -87,7 +251,7 @@ class ExtensionService(SSE.ConnectorServicer):
             10: '_sklearn',
             11: '_sklearn',
             12: '_sklearn',
-            13: '_sklearn',
+            13: '_sklearn_partial_fit',
             14: '_sklearn',
             15: '_sklearn',
             16: '_sklearn',
@@ -119,9 +283,26 @@ class ExtensionService(SSE.ConnectorServicer):
             42: '_sklearn',
             43: '_misc',
             44: '_misc',
-            45: '_misc'
+            45: '_misc',
+            46: '_sklearn',
+            47: '_sklearn'
         }
 
+    @property
+    def function_pools(self):
+        """
+        :return: Mapping of function id and the pool used to execute the function
+        """
+        pools = {
+            'training': (12, 13, 26, 27, 28),
+            'setup': (9, 10, 21, 22, 24, 33, 34, 42, 46),
+            'forecasting': (0, 1, 2, 5, 6, 7, 8, 40, 41),
+            'nlp': (30, 31, 32),
+            'prediction': (3, 4, 11, 14, 15, 16, 17, 18, 19, 20, 23, 25, 29, 35, 36, 37, 38, 39, 43, 44, 45, 47)
+        }
+
+        return {func_id: name for name, ids in pools.items() for func_id in ids}
+
     """
     Implementation of added functions.
     """
@@ -159,7 +340,7 @@ class ExtensionService(SSE.ConnectorServicer):
         
         # Create an instance of the HDBSCANForQlik class
         # This will take the request data from Qlik and prepare it for clustering
-        clusterer = HDBSCANForQlik(request_list, context, variant=variant)
+        clusterer = get_class('HDBSCANForQlik')(request_list, context, variant=variant)
         
         # Calculate the clusters and store in a Pandas series (or DataFrame in the case of a load script call)
         clusters = clusterer.scan()
@@ -168,34 +349,15 @@ class ExtensionService(SSE.ConnectorServicer):
         # This occurs when the load_script=true argument is passed in the Qlik expression.
         response_is_df = isinstance(clusters, pd.DataFrame)
         
-        # Convert the response to a list of rows
-        clusters = clusters.values.tolist()
-        
-        # We convert values to type SSE.Dual, and group columns into a iterable
+        # Set the data types of the output
         if response_is_df:
-            response_rows = [iter([SSE.Dual(strData=row[0]),SSE.Dual(numData=row[1])]) for row in clusters]
+            dtypes = ["str", "num"]
         else:
-            response_rows = [iter([SSE.Dual(numData=row)]) for row in clusters]
+            dtypes = ["num"]
         
-        # Values are then structured as SSE.Rows
-        response_rows = [SSE.Row(duals=duals) for duals in response_rows]
-
-        # Get the number of bundles in the request
-        num_request_bundles = len(request_list)
-
-        # Get the number of rows in the response
-        num_rows = len(response_rows) 
-
-        # Calculate the number of rows to send per bundle
-        if num_rows >= num_request_bundles:
-            rows_per_bundle = num_rows//num_request_bundles
-        else:
-            rows_per_bundle = num_rows
-
-        # Stream response as BundledRows
-        for i in range(0, num_rows, rows_per_bundle):
-            # Yield Row data as Bundled rows
-            yield SSE.BundledRows(rows=response_rows[i : i + rows_per_bundle])
+        # Stream the response as SSE.BundledRows
+        for bundle in utils.stream_response(clusters, dtypes, ExtensionService.bundle_bytes):
+            yield bundle
     
     @staticmethod
     def _correlation(request, context):
@@ -339,7 +501,7 @@ class ExtensionService(SSE.ConnectorServicer):
                        
         # Create an instance of the ProphetForQlik class
         # This will take the request data from Qlik and prepare it for forecasting
-        predictor = ProphetForQlik(request_list, context)
+        predictor = get_class('ProphetForQlik')(request_list, context)
         
         # Calculate the forecast and store in a Pandas series
         forecast = predictor.predict()  
@@ -356,25 +518,9 @@ class ExtensionService(SSE.ConnectorServicer):
         else:
             dtypes = ['num']
 
-        # Get the response as SSE.Rows
-        response_rows = utils.get_response_rows(forecast.values.tolist(), dtypes) 
-
-        # Get the number of bundles in the request
-        num_request_bundles = len(request_list)
-
-        # Get the number of rows in the response
-        num_rows = len(response_rows) 
-
-        # Calculate the number of rows to send per bundle
-        if num_rows >= num_request_bundles:
-            rows_per_bundle = num_rows//num_request_bundles
-        else:
-            rows_per_bundle = num_rows
-
-        # Stream response as BundledRows
-        for i in range(0, num_rows, rows_per_bundle):
-            # Yield Row data as Bundled rows
-            yield SSE.BundledRows(rows=response_rows[i : i + rows_per_bundle])  
+        # Stream the response as SSE.BundledRows
+        for bundle in utils.stream_response(forecast, dtypes, ExtensionService.bundle_bytes):
+            yield bundle
     
     @staticmethod
     def _prophet_seasonality(request, context):
@@ -420,34 +566,14 @@ class ExtensionService(SSE.ConnectorServicer):
                               
         # Create an instance of the ProphetForQlik class
         # This will take the request data from Qlik and prepare it for forecasting
-        predictor = ProphetForQlik.init_seasonality(request_list, context)
+        predictor = get_class('ProphetForQlik').init_seasonality(request_list, context)
         
         # Calculate the forecast and store in a Pandas series
         forecast = predictor.predict()
         
-        # Values in the series are converted to type SSE.Dual
-        response_rows = forecast.apply(lambda result: iter([SSE.Dual(numData=result)]))
-        
-        # Values in the series are converted to type SSE.Row
-        # The series is then converted to a list
-        response_rows = response_rows.apply(lambda duals: SSE.Row(duals=duals)).tolist()        
-        
-        # Get the number of bundles in the request
-        num_request_bundles = len(request_list)
-
-        # Get the number of rows in the response
-        num_rows = len(response_rows) 
-
-        # Calculate the number of rows to send per bundle
-        if num_rows >= num_request_bundles:
-            rows_per_bundle = num_rows//num_request_bundles
-        else:
-            rows_per_bundle = num_rows
-
-        # Stream response as BundledRows
-        for i in range(0, num_rows, rows_per_bundle):
-            # Yield Row data as Bundled rows
-            yield SSE.BundledRows(rows=response_rows[i : i + rows_per_bundle]) 
+        # Stream the response as SSE.BundledRows
+        for bundle in utils.stream_response(forecast, ["num"], ExtensionService.bundle_bytes):
+            yield bundle
     
     @staticmethod
     def _sklearn(request, context):
@@ -464,7 +590,7 @@ class ExtensionService(SSE.ConnectorServicer):
         function = ExtensionService._get_function_id(context)
         
         # Create an instance of the SKLearnForQlik class
-        model = SKLearnForQlik(request_list, context)
+        model = get_class('SKLearnForQlik')(request_list, context)
         
         # Call the function based on the mapping in functions.json
         # The if conditions are grouped based on similar output structure
@@ -580,7 +706,7 @@ class ExtensionService(SSE.ConnectorServicer):
         elif function == 25:
             # Get the best parameters based on a grid search cross validation
             response = model.get_best_params()
-            dtypes = ["str", "str"]
+            dtypes = ["str", "str", "str", "num", "num"]
         
         elif function == 26:
             # Provide results from dimensionality reduction
@@ -603,25 +729,40 @@ class ExtensionService(SSE.ConnectorServicer):
             for i in range(1, response.shape[1]):
                 dtypes.append("num")
         
-        # Get the response as SSE.Rows
-        response_rows = utils.get_response_rows(response.values.tolist(), dtypes) 
-
-        # Get the number of rows in the request
-        num_request_bundles = len(request_list)
-
-        # Get the number of rows in the response
-        num_rows = len(response_rows) 
+        elif function == 46:
+            # Submit a job to train and test an existing model in the background and return the job id
+            response = model.fit_async()
+            dtypes = ["str", "str", "str", "str"]
+        
+        elif function == 47:
+            # Get the status of jobs submitted with sklearn_Fit_Async
+            response = model.get_job_status()
+            dtypes = ["str", "str", "str", "str", "num", "num", "num", "num", "num", "str", "str", "str"]
+        
+        # Stream the response as SSE.BundledRows
+        for bundle in utils.stream_response(response, dtypes, ExtensionService.bundle_bytes):
+            yield bundle
+    
+    @staticmethod
+    def _sklearn_partial_fit(request, context):
+        """
+        Train a machine learning model incrementally as the request is streamed from Qlik.
+        Unlike the other sklearn functions the request is not read into a list, so that training data larger than 
+        the available memory can be used.
+        :param request: an iterable sequence of RowData
+        :param context:
+        :return: the result of training the model, with the same columns as the response of the fit function
+        """
+        # Create an instance of the SKLearnForQlik class with the request iterator
+        model = get_class('SKLearnForQlik')(request, context)
 
-        # Calculate the number of rows to send per bundle
-        if num_rows >= num_request_bundles:
-            rows_per_bundle = len(response_rows)//len(request_list)
-        else:
-            rows_per_bundle = num_rows
+        # Update the model with each batch of samples in the request and save it to disk
+        response = model.partial_fit()
+        dtypes = ["str", "str", "str", "str", "num"]
 
-        # Stream response as BundledRows
-        for i in range(0, len(response_rows), rows_per_bundle):
-            # Yield Row data as Bundled rows
-            yield SSE.BundledRows(rows=response_rows[i : i + rows_per_bundle])
+        # Stream the response as SSE.BundledRows
+        for bundle in utils.stream_response(response, dtypes, ExtensionService.bundle_bytes):
+            yield bundle
     
     @staticmethod
     def _spacy(request, context):
@@ -638,7 +779,7 @@ class ExtensionService(SSE.ConnectorServicer):
         function = ExtensionService._get_function_id(context)
         
         # Create an instance of the SpaCyForQlik class
-        model = SpaCyForQlik(request_list, context)
+        model = get_class('SpaCyForQlik')(request_list, context)
         
         # Call the function based on the mapping in functions.json
         # The if conditions are grouped based on similar output structure
@@ -660,25 +801,9 @@ class ExtensionService(SSE.ConnectorServicer):
             # return four columns: model_name, subset, metric, value
             dtypes = ["str", "str", "str", "num"]
 
-        # Get the response as SSE.Rows
-        response_rows = utils.get_response_rows(response.values.tolist(), dtypes) 
-
-        # Get the number of rows in the request
-        num_request_bundles = len(request_list)
-
-        # Get the number of rows in the response
-        num_rows = len(response_rows) 
-
-        # Calculate the number of rows to send per bundle
-        if num_rows >= num_request_bundles:
-            rows_per_bundle = len(response_rows)//len(request_list)
-        else:
-            rows_per_bundle = num_rows
-
-        # Stream response as BundledRows
-        for i in range(0, len(response_rows), rows_per_bundle):
-            # Yield Row data as Bundled rows
-            yield SSE.BundledRows(rows=response_rows[i : i + rows_per_bundle])
+        # Stream the response as SSE.BundledRows
+        for bundle in utils.stream_response(response, dtypes, ExtensionService.bundle_bytes):
+            yield bundle
     
     @staticmethod
     def _misc(request, context):
@@ -695,7 +820,7 @@ class ExtensionService(SSE.ConnectorServicer):
         function = ExtensionService._get_function_id(context)
         
         # Create an instance of the CommonFunction class
-        handle = CommonFunction(request_list, context)
+        handle = get_class('CommonFunction')(request_list, context)
         
         # Call the function based on the mapping in functions.json
         # The if conditions are grouped based on similar output structure
@@ -720,25 +845,9 @@ class ExtensionService(SSE.ConnectorServicer):
             # Return the feature expression
             dtypes = ["str"]
 
-        # Get the response as SSE.Rows
-        response_rows = utils.get_response_rows(response.values.tolist(), dtypes) 
-
-        # Get the number of bundles in the request
-        num_request_bundles = len(request_list)
-
-        # Get the number of rows in the response
-        num_rows = len(response_rows) 
-
-        # Calculate the number of rows to send per bundle
-        if num_rows >= num_request_bundles:
-            rows_per_bundle = num_rows//num_request_bundles
-        else:
-            rows_per_bundle = num_rows
-
-        # Stream response as BundledRows
-        for i in range(0, num_rows, rows_per_bundle):
-            # Yield Row data as Bundled rows
-            yield SSE.BundledRows(rows=response_rows[i : i + rows_per_bundle])
+        # Stream the response as SSE.BundledRows
+        for bundle in utils.stream_response(response, dtypes, ExtensionService.bundle_bytes):
+            yield bundle
     
     @staticmethod
     def _get_function_id(context):
@@ -753,13 +862,42 @@ class ExtensionService(SSE.ConnectorServicer):
 
         return header.functionId
 
-    def _get_call_info(self, context):
+    @staticmethod
+    def _get_time_remaining(context):
+        """
+        Retrieve the seconds remaining before the deadline of the call.
+        If Qlik sets no deadline gRPC returns a very large number, which can't be used as a timeout.
+        :param context: context
+        :return: the seconds remaining, or None if the call has no deadline
+        """
+        remaining = context.time_remaining()
+
+        if remaining is None or remaining >= threading.TIMEOUT_MAX:
+            return None
+
+        return remaining
+
+    def _get_call_info(self, context, labels=None):
         """
         Retreive useful information for the function call.
         :param context: context
+        :param labels: the labels from _get_call_labels, if already retrieved for the call
         :return: string containing header info
         """
 
+        if labels is None:
+            labels = self._get_call_labels(context)
+
+        return "{0} - Capability '{1}' called by user {2} from app {3}"\
+               .format(labels['peer'], labels['capability'], labels['user'], labels['app'])
+
+    def _get_call_labels(self, context):
+        """
+        Retreive the capability, user, app and peer for the function call, e.g. to label the metrics for the call.
+        :param context: context
+        :return: dictionary of the labels
+        """
+
         # Get metadata for the call from the context
         metadata = dict(context.invocation_metadata())
         
@@ -774,7 +912,7 @@ class ExtensionService(SSE.ConnectorServicer):
 
         # Get capabilities
         if not hasattr(self, 'capabilities'):
-            self.capabilities = self.GetCapabilities(None, context, log=False)
+            self.GetCapabilities(None, context, log=False)
 
         # Get the name of the capability called in the function
         capability = [function.name for function in self.capabilities.functions if function.functionId == func_id][0]
@@ -791,7 +929,7 @@ class ExtensionService(SSE.ConnectorServicer):
         # Get the call's origin
         peer = context.peer()
 
-        return "{0} - Capability '{1}' called by user {2} from app {3}".format(peer, capability, userId, appId)
+        return OrderedDict([('capability', capability), ('app', appId), ('user', userId), ('peer', peer)])
     
     """
     Implementation of rpc functions.
@@ -813,7 +951,8 @@ class ExtensionService(SSE.ConnectorServicer):
         # Create an instance of the Capabilities grpc message
         # Enable(or disable) script evaluation
         # Set values for pluginIdentifier and pluginVersion
-        self.capabilities = SSE.Capabilities(allowScript=False,
+        # The message is only assigned to self.capabilities once complete, as it is read by concurrent calls
+        capabilities = SSE.Capabilities(allowScript=False,
                                         pluginIdentifier='Qlik Python Tools',
                                         pluginVersion='v2.3.0')
 
@@ -821,7 +960,7 @@ class ExtensionService(SSE.ConnectorServicer):
         with open(self.function_definitions) as json_file:
             # Iterate over each function definition and add data to the Capabilities grpc message
             for definition in json.load(json_file)['Functions']:
-                function = self.capabilities.functions.add()
+                function = capabilities.functions.add()
                 function.name = definition['Name']
                 function.functionId = definition['Id']
                 function.functionType = definition['Type']
@@ -835,7 +974,8 @@ class ExtensionService(SSE.ConnectorServicer):
                     logging.info('Adding to capabilities: {}({})'.format(function.name,
                                                                         [p.name for p in function.params]))
 
-        return self.capabilities
+        self.capabilities = capabilities
+        return capabilities
 
     def ExecuteFunction(self, request_iterator, context):
         """
@@ -846,11 +986,284 @@ class ExtensionService(SSE.ConnectorServicer):
         """
         # Retrieve function id
         func_id = self._get_function_id(context)
-        logging.info(self._get_call_info(context))
+        labels = self._get_call_labels(context)
+        logging.info(self._get_call_info(context, labels))
         logging.info('ExecuteFunction (functionId: {}, {})'.format(func_id, self.functions[func_id]))
+
+        # The peer is left out of the metrics labels
+        labels = tuple((key, labels[key]) for key in ('capability', 'app', 'user'))
+
+        # Responses for deterministic functions can be served from the cache or shared with identical calls in flight
+        if (self.response_cache is not None and func_id in self.cache_functions) or func_id in self.coalesce_functions:
+            return self._execute_shared(func_id, request_iterator, context, labels)
+        
+        return self._execute(func_id, request_iterator, context, labels)
+
+    def _execute(self, func_id, request_iterator, context, labels=()):
+        """
+        Execute a function in the pool for its class of functions.
+        If the pool is at capacity the call is rejected with a RESOURCE_EXHAUSTED status.
+        :param func_id: the function id
+        :param request_iterator: an iterable sequence of RowData.
+        :param context: the context.
+        :param labels: the labels for the metrics recorded for the call as a tuple of (label, value) pairs
+        :return: an iterable sequence of RowData.
+        """
+        pool = self.pools[self.function_pools[func_id]]
+
+        try:
+            response = pool.stream(self._execute_measured, func_id, request_iterator, context, labels, context=context)
+        except executors.PoolFull as e:
+            logging.warning('Rejected call to function id {0}: {1}'.format(func_id, e))
+            context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, str(e))
+        
+        try:
+            for bundle in response:
+                yield bundle
+        except utils.CallCancelled as e:
+            logging.info('Stopped call to function id {0}: {1}'.format(func_id, e))
+            raise
+
+    def _execute_measured(self, func_id, request_iterator, context, labels):
+        """
+        Execute a function and record the metrics for the call. This is run by the pool thread executing the function,
+        so that the stages timed within the function handler are recorded against this call.
+        :param func_id: the function id
+        :param request_iterator: an iterable sequence of RowData.
+        :param context: the context.
+        :param labels: the labels for the metrics recorded for the call as a tuple of (label, value) pairs
+        :return: an iterable sequence of RowData.
+        """
+        call = metrics.start_call(OrderedDict(labels))
+
+        try:
+            for bundle in self._execute_function(func_id, self._count_request(request_iterator, call), context):
+                call.counts['response_rows'] += len(bundle.rows)
+                call.counts['response_bytes'] += bundle.ByteSize()
+                yield bundle
+        finally:
+            # Write the profile for the call if it was requested with profile=true
+            utils.end_profile()
+            metrics.end_call(call)
+    
+    @staticmethod
+    def _count_request(request_iterator, call):
+        """
+        Count the rows and bytes in the request for the metrics of a call as the request is consumed.
+        :param request_iterator: an iterable sequence of RowData.
+        :param call: the metrics.CallMetrics for the call
+        :return: an iterable sequence of RowData.
+        """
+        for request_rows in request_iterator:
+            call.counts['request_rows'] += len(request_rows.rows)
+            call.counts['request_bytes'] += request_rows.ByteSize()
+            yield request_rows
+
+    def _execute_function(self, func_id, request_iterator, context):
+        """
+        Execute a function in the current thread or the process pool based on the function definitions.
+        :param func_id: the function id
+        :param request_iterator: an iterable sequence of RowData.
+        :param context: the context.
+        :return: an iterable sequence of RowData.
+        """
+        # CPU bound functions can be handed to a pool of worker processes
+        if self.process_pool is not None and func_id in self.process_functions:
+            return self._execute_in_process(func_id, request_iterator, context)
         
         return getattr(self, self.functions[func_id])(request_iterator, context)
 
+    def _execute_shared(self, func_id, request_iterator, context, labels=()):
+        """
+        Execute a function whose response can be shared between identical calls.
+        The response is served from the cache if possible. Otherwise, if an identical call is already in flight, 
+        this call waits for its result instead of executing the function again.
+        :param func_id: the function id
+        :param request_iterator: an iterable sequence of RowData.
+        :param context: the context.
+        :param labels: the labels for the metrics recorded for the call as a tuple of (label, value) pairs
+        :return: an iterable sequence of RowData.
+        """
+        # Get a list from the generator object so that it can be hashed and then passed on to the function
+        request_list = [request_rows for request_rows in request_iterator]
+
+        key = ResponseCache.get_key(func_id, request_list)
+        use_cache = self.response_cache is not None and func_id in self.cache_functions
+        shared = None
+
+        if use_cache:
+            shared = self.response_cache.get(key)
+
+            if shared is not None:
+                logging.info('Response cache hit for function id {0}: {1}'.format(func_id, self.response_cache.stats()))
+        
+        # Join an identical call in flight or become the leader for this key
+        leader = False
+
+        if shared is None and func_id in self.coalesce_functions:
+            call, leader = self.single_flight.join(key)
+
+            if not leader:
+                logging.info('Waiting on an identical call in flight for function id {0}'.format(func_id))
+
+                try:
+                    shared = call.result(timeout=self._get_time_remaining(context))
+                except LeaderCancelled:
+                    # The leader's client went away before it completed, so this call is executed on its own
+                    shared = None
+                except futures.TimeoutError:
+                    err = "The deadline for the call passed while waiting on an identical call in flight."
+                    logging.info('Stopped call to function id {0}: {1}'.format(func_id, err))
+                    context.abort(grpc.StatusCode.DEADLINE_EXCEEDED, err)
+        
+        if shared is not None:
+            response, initial_metadata = shared
+
+            # Send the table description and other initial metadata set by the function
+            if initial_metadata:
+                context.send_initial_metadata(initial_metadata)
+            
+            for bundle in response:
+                yield SSE.BundledRows.FromString(bundle)
+            
+            return
+        
+        # Record the initial metadata so that it can be sent with the shared response
+        recorder = executors.RecordingContext(context)
+        response = []
+
+        try:
+            # Stream the response to Qlik while keeping a serialized copy to share
+            for bundle in self._execute(func_id, iter(request_list), recorder, labels):
+                response.append(bundle.SerializeToString())
+                yield bundle
+        except BaseException as e:
+            # Pass on the failure to any calls waiting on this one
+            # If this call was cancelled or aborted, e.g. rejected by its pool, the waiting calls execute the function themselves
+            if leader:
+                cancelled = isinstance(e, utils.CallCancelled) or not isinstance(e, Exception) or recorder.aborted
+                self.single_flight.done(key, exception=LeaderCancelled() if cancelled else e)
+            raise
+        
+        if use_cache:
+            self.response_cache.put(key, response, recorder.initial_metadata)
+        
+        if leader:
+            self.single_flight.done(key, result=(response, recorder.initial_metadata))
+
+    def _execute_in_process(self, func_id, request_iterator, context):
+        """
+        Execute a function in the process pool and stream the result back to Qlik.
+        :param func_id: the function id
+        :param request_iterator: an iterable sequence of RowData.
+        :param context: the context.
+        :return: an iterable sequence of RowData.
+        """
+        # The request is decoded in the worker, so it is passed on in its serialized form
+        request = [request_rows.SerializeToString() for request_rows in request_iterator]
+        metadata = [(key, value) for key, value in context.invocation_metadata()]
+
+        try:
+            future = self.process_pool.submit(executors.run_handler, ExtensionService, self.functions[func_id], request,\
+                                              metadata, context.peer(), self._get_time_remaining(context), self.bundle_bytes)
+            response, initial_metadata, timings = future.result()
+        except BrokenProcessPool:
+            # A worker process terminated abruptly, e.g. due to a crash or running out of memory. 
+            # The pool can no longer be used and is replaced for subsequent calls.
+            logging.error('A worker process terminated abruptly. Restarting the process pool.')
+            self._start_process_pool()
+            raise
+
+        # Record the stages timed in the worker against this call. The remaining time is counted as compute.
+        metrics.add_timings(timings)
+
+        # Send the table description and other initial metadata set by the function
+        if initial_metadata:
+            context.send_initial_metadata(initial_metadata)
+        
+        for bundle in response:
+            yield SSE.BundledRows.FromString(bundle)
+
+    def _start_process_pool(self):
+        """
+        Start the pool of worker processes.
+        """
+        if self.process_pool is not None:
+            self.process_pool.shutdown(wait=False)
+        
+        # Create the transformer cache directory first so that the workers share it and it is deleted by this process
+        utils.transformer_cache.get_location()
+
+        self.process_pool = futures.ProcessPoolExecutor(max_workers=self.processes)
+
+        # Start the workers ahead of the first request so that they are created before the gRPC server
+        self.process_pool.submit(executors.ready).result()
+
+        logging.info('Process pool started with {0} workers for function ids: {1}'\
+                     .format(self.processes, sorted(self.process_functions)))
+
+    @staticmethod
+    def _watch_registry(interval):
+        """
+        Keep the catalogs of saved models in line with the models directories every interval seconds from a daemon thread,
+        e.g. for models copied into or deleted from a directory by other means than the SSE.
+        The catalogs are only checked once the machine learning module has been imported by a call.
+        """
+
+        def run():
+            while True:
+                time.sleep(interval)
+
+                module = sys.modules.get('_machine_learning')
+
+                if module is None:
+                    continue
+
+                try:
+                    module.ModelRegistry.reconcile_all()
+                except Exception as e:
+                    logging.warning('Model registry check failed: {0}'.format(e))
+        
+        threading.Thread(target=run, name='model-registry-watch', daemon=True).start()
+
+    def _warmup(self, manifest, threads=_DEFAULT_WARMUP_THREADS):
+        """
+        Load the models listed in a warm-up manifest into the model caches, using multiple threads.
+        The manifest is a JSON file with lists of model names for each type of model, e.g.
+        {"sklearn": ["HR-Attrition-LR"], "pretrained": ["HR-Attrition-Keras"], "spacy": ["en_core_web_sm"]}
+        Models that can't be loaded are logged and skipped.
+        :param manifest: the path to the manifest file
+        :param threads: the number of threads used to load the models
+        """
+
+        with open(manifest) as json_file:
+            models = json.load(json_file)
+        
+        # Functions that load each type of model into its cache
+        loaders = {'sklearn': lambda name: get_class('SKLearnForQlik').reload_model(name),\
+                   'pretrained': lambda name: get_class('CommonFunction').warm(name),\
+                   'spacy': lambda name: get_class('SpaCyForQlik').load_model(name)}
+
+        unknown = set(models) - set(loaders)
+        if len(unknown) > 0:
+            err = "Invalid keys in the warm-up manifest: {0}. Valid keys are: {1}".format(sorted(unknown), ", ".join(loaders))
+            raise Exception(err)
+        
+        start = time.time()
+
+        with futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix='warmup') as executor:
+            tasks = {executor.submit(loaders[kind], name): (kind, name) for kind in models for name in models[kind]}
+
+            for task in futures.as_completed(tasks):
+                kind, name = tasks[task]
+
+                try:
+                    task.result()
+                except Exception as e:
+                    logging.warning('Warm-up of {0} model {1} failed: {2}'.format(kind, name, e))
+        
+        logging.info('Warm-up of {0} models completed in {1:.1f} seconds'.format(len(tasks), time.time() - start))
+
     """
     Implementation of the Server connecting to gRPC.
     """
@@ -862,7 +1275,26 @@ class ExtensionService(SSE.ConnectorServicer):
         :param pem_dir: Directory including certificates
         :return: None
         """
-        server = grpc.server(futures.ThreadPoolExecutor(max_workers=10),\
+        if self.processes > 0:
+            self._start_process_pool()
+        
+        # Load the models in the warm-up manifest so that the first calls don't wait for them
+        if self.warmup:
+            self._warmup(self.warmup)
+        
+        # Serve the metrics for Prometheus and write a periodic summary to the log
+        if self.metrics_port:
+            metrics.serve(int(self.metrics_port), self.metrics_host)
+            logging.info('*** Serving metrics on {0}:{1} ***'.format(self.metrics_host, self.metrics_port))
+        
+        if self.metrics_interval > 0:
+            metrics.log_summary(self.metrics_interval)
+
+        # The gRPC threads wait on the pools for each class of functions, so there must be enough of them to accept a call
+        # for every slot in the pools, with a few to spare for rejecting calls and serving cached responses
+        max_workers = sum(pool.workers + pool.queue_depth for pool in self.pools.values()) + 10
+
+        server = grpc.server(futures.ThreadPoolExecutor(max_workers=max_workers),\
         options=[('grpc.max_send_message_length', MAX_MESSAGE_LENGTH),('grpc.max_receive_message_length', MAX_MESSAGE_LENGTH)])
         
         SSE.add_ConnectorServicer_to_server(self, server)
@@ -889,6 +1321,44 @@ class ExtensionService(SSE.ConnectorServicer):
                 time.sleep(_ONE_DAY_IN_SECONDS)
         except KeyboardInterrupt:
             server.stop(0)
+            
+            for pool in self.pools.values():
+                pool.shutdown(wait=False)
+            
+            if self.process_pool is not None:
+                self.process_pool.shutdown()
+            
+            # Jobs still running are reported as interrupted when their status is next requested
+            jobs.registry.shutdown(wait=False)
+
+            # Complete any models still being saved in the background
+            utils.background_writer.flush()
+
+def get_class(name):
+    """
+    Get a class implementing a capability, importing its module on first use.
+    Any model cache set up by the server is given to the class when it is imported.
+    :param name: the name of the class, e.g. 'SKLearnForQlik'
+    :return: the class
+    """
+
+    module_name = _CAPABILITY_MODULES[name]
+
+    # Modules are imported under a lock so that other threads don't see a partially imported module
+    if module_name not in _imported:
+        with _import_lock:
+            if module_name not in _imported:
+                start = time.time()
+                module = importlib.import_module(module_name)
+                logging.info('Imported {0} in {1:.1f} seconds'.format(module_name, time.time() - start))
+
+                for class_name, cache in _model_caches.items():
+                    if _CAPABILITY_MODULES[class_name] == module_name:
+                        getattr(module, class_name).model_cache = cache
+                
+                _imported.add(module_name)
+    
+    return getattr(sys.modules[module_name], name)
 
 class AAIException(Exception):
     """
@@ -901,10 +1371,34 @@ if __name__ == '__main__':
     parser.add_argument('--port', nargs='?', default=_DEFAULT_PORT)
     parser.add_argument('--pem_dir', nargs='?')
     parser.add_argument('--definition_file', nargs='?', default='functions.json')
+    parser.add_argument('--bundle_bytes', nargs='?', type=int, default=_DEFAULT_BUNDLE_BYTES)
+    parser.add_argument('--processes', nargs='?', type=int, default=0)
+    parser.add_argument('--cache_mb', nargs='?', type=int, default=_DEFAULT_CACHE_MB)
+    parser.add_argument('--cache_ttl', nargs='?', type=int, default=_DEFAULT_CACHE_TTL)
+    parser.add_argument('--pool_workers', nargs='?', default='')
+    parser.add_argument('--pool_queue', nargs='?', default='')
+    parser.add_argument('--metrics_port', nargs='?', type=int, default=0)
+    parser.add_argument('--metrics_host', nargs='?', default=_DEFAULT_METRICS_HOST)
+    parser.add_argument('--metrics_interval', nargs='?', type=int, default=_DEFAULT_METRICS_INTERVAL)
+    parser.add_argument('--model_cache_mb', nargs='?', type=int, default=_DEFAULT_MODEL_CACHE_MB)
+    parser.add_argument('--model_cache_policy', nargs='?', default=_DEFAULT_MODEL_CACHE_POLICY)
+    parser.add_argument('--pin_models', nargs='?', default='')
+    parser.add_argument('--watch_models', nargs='?', type=int, default=0)
+    parser.add_argument('--warmup', nargs='?')
+    parser.add_argument('--preprocessing_cache_mb', nargs='?', type=int, default=_DEFAULT_PREPROCESSING_CACHE_MB)
+    parser.add_argument('--job_workers', nargs='?', type=int, default=_DEFAULT_JOB_WORKERS)
     args = parser.parse_args()
 
     # need to locate the file when script is called from outside it's location dir.
     def_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), args.definition_file)
 
-    calc = ExtensionService(def_file)
+    # Pool sizes are given as comma separated key word arguments, e.g. 'training=2, prediction=8'
+    calc = ExtensionService(def_file, bundle_bytes=args.bundle_bytes, processes=args.processes, cache_mb=args.cache_mb,\
+                            cache_ttl=args.cache_ttl, pool_workers=utils.get_kwargs(args.pool_workers),\
+                            pool_queue=utils.get_kwargs(args.pool_queue), metrics_port=args.metrics_port,\
+                            metrics_host=args.metrics_host, metrics_interval=args.metrics_interval, model_cache_mb=args.model_cache_mb,\
+                            model_cache_policy=args.model_cache_policy,\
+                            pin_models=[name.strip() for name in args.pin_models.split(',') if name.strip()],\
+                            watch_models=args.watch_models, warmup=args.warmup,\
+                            preprocessing_cache_mb=args.preprocessing_cache_mb, job_workers=args.job_workers)
     calc.Serve(args.port, args.pem_dir)
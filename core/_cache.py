@@ -0,0 +1,487 @@
+import os
+import sys
+import time
+import pickle
+import hashlib
+import logging
+import threading
+from concurrent import futures
+from collections import OrderedDict
+
+class ResponseCache:
+    """
+    A thread-safe LRU cache for function responses.
+    Entries are keyed by the function id and a hash of the serialized request bundles, which include the argument strings.
+    The cache is limited by the total size of the cached responses in bytes, and entries expire after a time to live.
+    """
+
+    def __init__(self, max_bytes=100*1024*1024, ttl=3600):
+        """
+        Class initializer.
+        :param max_bytes: the memory budget for the cached responses in bytes
+        :param ttl: the time to live for cache entries in seconds. Use 0 for entries that don't expire.
+        """
+
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+        # Counters for the cache statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def get_key(func_id, request_list):
+        """
+        Get the cache key for a request.
+        :param func_id: the function id
+        :param request_list: the request as a list of SSE.BundledRows
+        :return: a tuple of the function id and the hash of the request
+        """
+
+        payload_hash = hashlib.sha256()
+
+        for request_rows in request_list:
+            payload_hash.update(request_rows.SerializeToString())
+
+        return (func_id, payload_hash.hexdigest())
+
+    def get(self, key):
+        """
+        Get a cached response.
+        :param key: the cache key from get_key
+        :return: a tuple of the response as a list of serialized SSE.BundledRows and the initial metadata, or None for a miss
+        """
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            # Expired entries are removed and counted as a miss
+            if entry is not None and self.ttl > 0 and time.time() > entry[0]:
+                self._remove(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            # Mark the entry as most recently used
+            self.entries.move_to_end(key)
+            self.hits += 1
+
+            return entry[2], entry[3]
+
+    def put(self, key, response, initial_metadata=None):
+        """
+        Add a response to the cache, evicting least recently used entries to stay within the memory budget.
+        Responses larger than the budget are not cached.
+        :param key: the cache key from get_key
+        :param response: the response as a list of serialized SSE.BundledRows
+        :param initial_metadata: the initial metadata sent with the response, e.g. the table description
+        """
+
+        size = sum(len(bundle) for bundle in response)
+
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+            while self.size + size > self.max_bytes and len(self.entries) > 0:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+            self.entries[key] = (time.time() + self.ttl, size, response, initial_metadata)
+            self.size += size
+
+    def stats(self):
+        """
+        :return: a dictionary with the cache statistics
+        """
+
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses,\
+                    'evictions': self.evictions}
+
+    def _remove(self, key):
+        """
+        Remove an entry from the cache. The lock must be held by the caller.
+        """
+
+        entry = self.entries.pop(key)
+        self.size -= entry[1]
+
+class SingleFlight:
+    """
+    Coalesce identical function calls that are in flight at the same time.
+    The first call for a key becomes the leader and executes the function. 
+    Calls with the same key that arrive while the leader is running wait for and share its result.
+    """
+
+    def __init__(self):
+        """
+        Class initializer.
+        """
+
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.coalesced = 0
+
+    def join(self, key):
+        """
+        Join the call in flight for a key, or start a new one.
+        :param key: the key for the call, e.g. from ResponseCache.get_key
+        :return: a tuple of a Future for the result of the call and a flag that is True if this call is the leader
+        """
+
+        with self.lock:
+            call = self.calls.get(key)
+
+            if call is None:
+                call = futures.Future()
+                self.calls[key] = call
+                return call, True
+            
+            self.coalesced += 1
+            return call, False
+
+    def done(self, key, result=None, exception=None):
+        """
+        Complete the call for a key and pass the result or exception to the calls waiting on it.
+        This must be called by the leader.
+        :param key: the key for the call
+        :param result: the result of the call
+        :param exception: the exception raised by the call
+        """
+
+        with self.lock:
+            call = self.calls.pop(key)
+        
+        if exception is not None:
+            call.set_exception(exception)
+        else:
+            call.set_result(result)
+
+class LeaderCancelled(Exception):
+    """
+    Raised for calls waiting on a leader that was cancelled before it completed.
+    """
+    pass
+
+class ModelCache:
+    """
+    A thread-safe cache for models kept in memory between calls.
+    The cache is limited by the total size of the models in bytes, measured by pickling each model when it is added.
+    Models are evicted based on the policy, which can be 'lru' for least recently used or 'lfu' for least frequently used.
+    Pinned models are never evicted.
+    Models added with their file path are checked against the file's modification time and size on each hit, so that a 
+    model replaced on disk, e.g. by another SSE sharing the models directory, is loaded again rather than served stale.
+    """
+
+    def __init__(self, max_bytes=512*1024*1024, policy='lru', pinned=None):
+        """
+        Class initializer.
+        :param max_bytes: the memory budget for the cached models in bytes
+        :param policy: the eviction policy, 'lru' or 'lfu'
+        :param pinned: a list of model names that are kept in the cache once loaded
+        """
+
+        if policy not in ('lru', 'lfu'):
+            err = "Invalid model cache policy: {0}. Valid policies are: lru, lfu".format(policy)
+            raise Exception(err)
+
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.pinned = set(pinned or [])
+        self.lock = threading.RLock()
+
+        # Entries are kept in order of use, with a size, use count, file path and file signature for each model
+        self.entries = OrderedDict()
+        self.size = 0
+
+        # Counters for the cache statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __contains__(self, name):
+        with self.lock:
+            return name in self.entries
+
+    def get(self, name):
+        """
+        Get a model from the cache.
+        :param name: the model name
+        :return: the model, or None if it is not in the cache
+        """
+
+        with self.lock:
+            entry = self.entries.get(name)
+
+        # The file is checked outside the lock as this may be slow on a network share
+        if entry is not None and entry[3] is not None and self.get_signature(entry[3]) != entry[4]:
+            with self.lock:
+                # The entry may have been replaced while the file was checked
+                if self.entries.get(name) is entry:
+                    self._remove(name)
+                    self.invalidations += 1
+
+            entry = None
+
+        with self.lock:
+            if entry is None or self.entries.get(name) is not entry:
+                self.misses += 1
+                return None
+
+            # Mark the model as most recently used and count the use
+            self.entries.move_to_end(name)
+            entry[2] += 1
+            self.hits += 1
+
+            return entry[0]
+
+    def put(self, name, model, file=None, size=None):
+        """
+        Add a model to the cache, replacing any previous version, and evict models to stay within the memory budget.
+        Models larger than the budget are not cached unless they are pinned.
+        :param name: the model name
+        :param model: the model, e.g. a PersistentModel
+        :param file: the path of the model file. If given, the model is dropped from the cache when the file changes.
+        :param size: the size of the model in bytes. If not given, the size is measured by pickling the model.
+        """
+
+        # The size is measured outside the lock as pickling a large model takes time
+        if size is None:
+            size = self.get_size(model)
+
+        signature = self.get_signature(file) if file is not None else None
+
+        with self.lock:
+            uses = 0
+
+            if name in self.entries:
+                uses = self.entries[name][2]
+                self._remove(name)
+
+            if size > self.max_bytes and name not in self.pinned:
+                return
+
+            self.entries[name] = [model, size, uses, file, signature]
+            self.size += size
+
+            # Evict models other than the one just added until the cache is within budget
+            while self.size > self.max_bytes:
+                victim = self._get_victim(exclude=name)
+
+                if victim is None:
+                    break
+
+                self._remove(victim)
+                self.evictions += 1
+
+    def remove(self, name):
+        """
+        Remove a model from the cache, e.g. if it has been deleted.
+        """
+
+        with self.lock:
+            if name in self.entries:
+                self._remove(name)
+
+    def refresh(self, name, model):
+        """
+        Record the current signature of the file for a cached model, e.g. after the model has been saved by this process.
+        :param name: the model name
+        :param model: the model that was saved. Nothing is done if the cache holds a different version of the model.
+        """
+
+        with self.lock:
+            entry = self.entries.get(name)
+
+            if entry is not None and entry[0] is model and entry[3] is not None:
+                entry[4] = self.get_signature(entry[3])
+
+    def validate(self):
+        """
+        Check the files for all cached models and remove the models whose files have changed.
+        :return: a list of the names of the models removed from the cache
+        """
+
+        with self.lock:
+            entries = [(name, entry) for name, entry in self.entries.items() if entry[3] is not None]
+
+        changed = []
+
+        for name, entry in entries:
+            if self.get_signature(entry[3]) != entry[4]:
+                with self.lock:
+                    if self.entries.get(name) is entry:
+                        self._remove(name)
+                        self.invalidations += 1
+                        changed.append(name)
+
+        return changed
+
+    def watch(self, interval, reload=None):
+        """
+        Check the files for the cached models every interval seconds from a daemon thread.
+        Models whose files have changed are removed from the cache and optionally loaded again.
+        :param interval: the number of seconds between checks
+        :param reload: a function called with the name of each changed model, e.g. to load the updated model into the cache
+        """
+
+        def run():
+            while True:
+                time.sleep(interval)
+
+                try:
+                    changed = self.validate()
+                except Exception as e:
+                    logging.warning('Model cache check failed: {0}'.format(e))
+                    continue
+
+                for name in changed:
+                    logging.info('Model {0} has changed on disk and was removed from the cache'.format(name))
+
+                    if reload is not None:
+                        try:
+                            reload(name)
+                        except Exception as e:
+                            logging.warning('Model {0} could not be loaded again: {1}'.format(name, e))
+        
+        threading.Thread(target=run, name='model-cache-watch', daemon=True).start()
+
+    def pin(self, name):
+        """
+        Keep a model in the cache once it is loaded.
+        """
+
+        with self.lock:
+            self.pinned.add(name)
+
+    def unpin(self, name):
+        """
+        Allow a model to be evicted from the cache.
+        """
+
+        with self.lock:
+            self.pinned.discard(name)
+
+    def names(self):
+        """
+        :return: the names of the cached models from least to most recently used
+        """
+
+        with self.lock:
+            return list(self.entries)
+
+    def stats(self):
+        """
+        :return: a dictionary with the cache statistics
+        """
+
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses,\
+                    'evictions': self.evictions, 'invalidations': self.invalidations,\
+                    'pinned': len(self.pinned.intersection(self.entries))}
+
+    def _get_victim(self, exclude=None):
+        """
+        Get the model to be evicted next based on the policy. Pinned models are never evicted.
+        The lock must be held by the caller.
+        :return: the model name, or None if no model can be evicted
+        """
+
+        candidates = [name for name in self.entries if name not in self.pinned and name != exclude]
+
+        if len(candidates) == 0:
+            return None
+
+        if self.policy == 'lfu':
+            # The candidates are in order of use, so ties go to the least recently used model
+            return min(candidates, key=lambda name: self.entries[name][2])
+
+        return candidates[0]
+
+    def _remove(self, name):
+        """
+        Remove a model from the cache. The lock must be held by the caller.
+        """
+
+        entry = self.entries.pop(name)
+        self.size -= entry[1]
+
+    @staticmethod
+    def get_signature(file):
+        """
+        Get a signature for a file that changes when the file is replaced or modified.
+        :return: a tuple of the modification time, size and inode of the file, or None if the file does not exist
+        """
+
+        try:
+            stat = os.stat(file)
+        except OSError:
+            return None
+
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    @staticmethod
+    def get_size(model):
+        """
+        Measure the size of a model by pickling it to a writer that only counts the bytes.
+        Keras models can't be pickled, so their size is estimated from the number of parameters.
+        :param model: the model
+        :return: the size in bytes
+        """
+
+        writer = _ByteCounter()
+        pickler = _SizePickler(writer, protocol=pickle.HIGHEST_PROTOCOL)
+
+        try:
+            pickler.dump(model)
+        except Exception:
+            # Fall back to the memory used by the object itself if the model can't be pickled
+            return sys.getsizeof(model)
+
+        return writer.size + pickler.extra_size
+
+class _ByteCounter:
+    """
+    A file-like object that counts the bytes written to it.
+    """
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+class _SizePickler(pickle.Pickler):
+    """
+    A pickler that leaves Keras models out of the pickled data and estimates their size from the number of parameters.
+    Tensorflow graphs and sessions, which can't be pickled, are also left out.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.extra_size = 0
+
+    def persistent_id(self, obj):
+        # Keras is only imported by the modules that use it, so if it has not been imported there are no Keras models
+        keras = sys.modules.get('keras')
+
+        if keras is not None and isinstance(obj, keras.models.Model):
+            # Keras weights are 32 bit floats
+            self.extra_size += obj.count_params() * 4
+            return id(obj)
+        
+        if type(obj).__module__.startswith('tensorflow'):
+            return id(obj)
+
+        return None
@@ -52,7 +52,7 @@ class HDBSCANForQlik:
             col_headers = ['key', 'measures', 'kwargs']
         
         # Create a Pandas Data Frame for the request data
-        self.request_df = utils.request_df(request, row_template, col_headers)
+        self.request_df = utils.request_df(request, row_template, col_headers, context=context)
         
         # Handle null value rows in the request dataset
         self.NaN_df = self.request_df.loc[self.request_df['key'].str.len() == 0].copy()
@@ -116,6 +116,9 @@ class HDBSCANForQlik:
         Calculate clusters using the HDBSCAN library.
         """
                 
+        # Stop if Qlik is no longer waiting for the result
+        utils.check_context(self.context, "HDBSCAN.fit")
+
         # Instantiate a HDSCAN object and fit the input data frame:
         self.clusterer = hdbscan.HDBSCAN(**self.hdbscan_kwargs)
         
@@ -252,6 +255,10 @@ class HDBSCANForQlik:
             if 'debug' in self.kwargs:
                 self.debug = 'true' == self.kwargs['debug'].lower()
             
+            # Set the profile option for writing a cProfile dump and a summary of the call to the logs folder
+            # Valid values are: true, false. Use profile_memory=true to include memory allocations and profile_top=<n> for the summary length.
+            utils.start_profile('Cluster', self.kwargs)
+            
             # Set optional parameters for the HDBSCAN algorithmn
             # For documentation see here: https://hdbscan.readthedocs.io/en/latest/api.html#id20
             
@@ -6,7 +6,6 @@ import pickle
 import string
 import pathlib
 import warnings
-import threading
 import numpy as np
 import pandas as pd
 
@@ -22,13 +21,14 @@ from efficient_apriori import apriori
 stderr = sys.stderr
 sys.stderr = open(os.devnull, 'w')
 import keras
-from keras import backend as kerasbackend
 sys.stderr = stderr
 
 import tensorflow as tf
 tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
 
 import _utils as utils
+import _metrics as metrics
+from _cache import ModelCache
 import ServerSideExtension_pb2 as SSE
 
 # Add Generated folder to module path
@@ -43,8 +43,9 @@ class CommonFunction:
     # Counter used to name log files for instances of the class
     log_no = 0
 
-    # A locking mechanism to allow tensorflow graphs to be setup uninterrupted by multithreaded requests to the same model
-    thread_lock = None
+    # Cache for pretrained models and preprocessors at the class level, keyed by the path of the model file
+    # This is replaced by the server based on the model_cache_mb and model_cache_policy options
+    model_cache = ModelCache()
 
     def __init__(self, request, context, path="../models/"):
         """
@@ -245,7 +246,7 @@ class CommonFunction:
         """
                 
         # Create a Pandas DataFrame for the request data
-        self.request_df = utils.request_df(self.request, row_template, col_headers)
+        self.request_df = utils.request_df(self.request, row_template, col_headers, context=self.context)
 
         if 'kwargs' in self.request_df.columns:
             # Get the argument strings from the request dataframe
@@ -285,6 +286,11 @@ class CommonFunction:
 
             self._print_log(1)
         
+        # Set the profile option for writing a cProfile dump and a summary of the call to the logs folder
+        # Valid values are: true, false. Use profile_memory=true to include memory allocations and profile_top=<n> for the summary length.
+        # The profile arguments are removed as the remaining arguments are passed on to the function
+        utils.start_profile('Common Functions', self.kwargs, pop=True)
+        
         # Set the name of the function to be called on the model
         # By default this is the 'predict' function, but could be other functions such as 'predict_proba' if supported by the model
         self.prediction_func = 'predict' if 'return' not in self.kwargs else self.kwargs.pop('return')
@@ -296,11 +302,10 @@ class CommonFunction:
         # The identifier can be excluded from the inputs to the model using the exclude_identifier argument.
         self.exclude_identifier = False if 'exclude_identifier' not in self.kwargs else (self.kwargs.pop('exclude_identifier').lower()=='true')
 
-        # Number of seconds to wait if a Keras model is being loaded by another thread
-        self.wait = 2 if 'keras_wait' not in self.kwargs else utils.atoi(self.kwargs.pop('keras_wait'))
-
-        # Number of retries if a Keras model is being loaded by another thread
-        self.retries = 5 if 'keras_retries' not in self.kwargs else utils.atoi(self.kwargs.pop('keras_retries'))
+        # The keras_wait and keras_retries arguments are no longer required as each Keras model is loaded into its own graph
+        # They are removed here so that they are not passed on to the model
+        self.kwargs.pop('keras_wait', None)
+        self.kwargs.pop('keras_retries', None)
         
         # Get the rest of the parameters, converting values to the correct data type
         self.pass_on_kwargs = {} if len(self.kwargs)==0 else utils.get_kwargs_by_type(self.kwargs) 
@@ -318,7 +323,7 @@ class CommonFunction:
 
     def _get_model(self, load=True):
         """
-        Load a model from disk.
+        Load a model from the class model cache or disk.
 
         This function currently only supports sklearn models saved to disk using pickle.
         The version of Python and sklearn used to build the model must match this SSE.
@@ -343,33 +348,11 @@ class CommonFunction:
         self.name = model_name
 
         # Get model meta data from the YAML file
-        try:
-            with open(self.path + model_name + ".yaml", 'r') as stream:
-                model_meta = yaml.safe_load(stream)
-        except FileNotFoundError as fe:
-            err = "Model definition file not found. A YAML file with the model path, type and features needs to be placed in ../models/"
-            raise FileNotFoundError(err) from fe
-        
-        # Get model path, type, preprocessor (optional), and feature definitions
-        model_path, model_type, model_features = model_meta['path'], model_meta['type'].lower(), model_meta['features']
-        
-        # Check that the model type is supported
-        supported = ['sklearn', 'scikit-learn', 'keras']
-        assert model_type in supported, "Unsupported model type: {}".format(model_meta['type'])
+        model_meta = self._get_model_meta(model_name, self.path)
+        model_features = model_meta['features']
 
         if load:
-            # Get the preprocessor if required
-            if 'preprocessor' in model_meta:
-                prep_path = model_meta['preprocessor']
-                self.prep = self._get_model_sklearn(prep_path)
-            else:
-                self.prep = None
-            
-            # Load the model
-            if model_type in ['sklearn', 'scikit-learn']:
-                self.model = self._get_model_sklearn(model_path)
-            elif model_type in ['keras']:
-                self.model = self._get_model_keras(model_path)
+            self.prep, self.model = self.load_model(model_meta)
             
             # Debug information is printed to the terminal and logs if the paramater debug = true
             if self.debug:
@@ -385,7 +368,74 @@ class CommonFunction:
         if self.debug:
             self._print_log(7)
     
-    def _get_model_sklearn(self, model_path):
+    @classmethod
+    def warm(cls, model_name, path="../models/"):
+        """
+        Load a pretrained model and its preprocessor into the class model cache, e.g. when the server is started.
+        :param model_name: the name of the model's YAML definition file without the extension
+        :param path: the directory with the YAML definition file
+        """
+
+        cls.load_model(cls._get_model_meta(model_name, path))
+
+    @classmethod
+    def load_model(cls, model_meta):
+        """
+        Get the preprocessor and model for a YAML definition from the class model cache, loading them from disk if required.
+        :param model_meta: the YAML model definition as a dictionary
+        :return: a tuple of the preprocessor, which is None if not required, and the model
+        """
+
+        # Get model path and type
+        model_path, model_type = model_meta['path'], model_meta['type'].lower()
+        
+        # Check that the model type is supported
+        supported = ['sklearn', 'scikit-learn', 'keras']
+        assert model_type in supported, "Unsupported model type: {}".format(model_meta['type'])
+
+        # Get the preprocessor if required
+        prep = cls._get_cached(model_meta['preprocessor'], cls._get_model_sklearn) if 'preprocessor' in model_meta else None
+        
+        # Load the model
+        if model_type in ['sklearn', 'scikit-learn']:
+            model = cls._get_cached(model_path, cls._get_model_sklearn)
+        elif model_type in ['keras']:
+            model = cls._get_cached(model_path, cls._get_model_keras)
+        
+        return prep, model
+
+    @classmethod
+    def _get_cached(cls, model_path, load):
+        """
+        Get a model from the class model cache, or load it with the given function and add it to the cache.
+        The cached model is dropped when the model file changes.
+        """
+
+        model = cls.model_cache.get(model_path)
+
+        if model is None:
+            with metrics.stage('model_load'):
+                model = load(model_path)
+            
+            cls.model_cache.put(model_path, model, file=model_path)
+        
+        return model
+
+    @staticmethod
+    def _get_model_meta(model_name, path):
+        """
+        Read the YAML definition for a pretrained model.
+        """
+
+        try:
+            with open(path + model_name + ".yaml", 'r') as stream:
+                return yaml.safe_load(stream)
+        except FileNotFoundError as fe:
+            err = "Model definition file not found. A YAML file with the model path, type and features needs to be placed in ../models/"
+            raise FileNotFoundError(err) from fe
+
+    @staticmethod
+    def _get_model_sklearn(model_path):
         """
         Load a pretrained scikit-learn pipeline from disk.
         The pipeline must have been saved in the pickle format.
@@ -393,7 +443,7 @@ class CommonFunction:
         """
 
         # Add model directory to the system path
-        self._add_model_path(model_path)
+        CommonFunction._add_model_path(model_path)
 
         # Load the saved pipeline from disk
         with open(model_path, 'rb') as file:
@@ -401,48 +451,34 @@ class CommonFunction:
         
         return model
 
-    def _get_model_keras(self, model_path):
+    @staticmethod
+    def _get_model_keras(model_path):
         """
         Load a pretrained Keras model from disk.
         The model must have been saved in the HDF5 format.
         Versions for Python and Keras should match the SSE.
         
         model_path is the path to the model including the file extension if applicable.
-        If the model is already locked, wait for a specified number of seconds.
-        Retry a maximum number of times before timing out.
+        The model is loaded into its own tensorflow graph and session so that it can be cached alongside other Keras models.
         """
 
         # Add model directory to the system path
-        self._add_model_path(model_path)
-
-        # Lock the model until the tensorflow graph has been setup
-        for _ in range(self.retries):
-            # If the model is not locked
-            if self.__class__.thread_lock is None:
-                try:
-                    # Set a class variable to lock the model
-                    self.__class__.thread_lock = threading.get_ident()
-
-                    # Clear any previous Keras session
-                    kerasbackend.clear_session()
-
-                    # Load the keras model architecture and weights from disk
-                    model = keras.models.load_model(model_path)
-                    model._make_predict_function()
-                    break
-                finally:
-                    # Release the lock, even in the case of any exceptions in the try block
-                    if self.__class__.thread_lock == threading.get_ident():
-                        self.__class__.thread_lock = None
-            else:
-                time.sleep(self.wait)
-        else:
-            raise TimeoutError("The specified model is locked by another thread. If you believe this to be wrong, please restart the SSE. "+\
-                "You can also try increasing the number of retries or wait time using the 'keras_retries' and 'keras_wait' arguments.")
+        CommonFunction._add_model_path(model_path)
 
-        return model
+        graph = tf.Graph()
+
+        with graph.as_default():
+            session = tf.compat.v1.Session(graph=graph)
 
-    def _add_model_path(self, model_path):
+            with session.as_default():
+                # Load the keras model architecture and weights from disk
+                model = keras.models.load_model(model_path)
+                model._make_predict_function()
+
+        return KerasGraphModel(model, graph, session)
+
+    @staticmethod
+    def _add_model_path(model_path):
         """
         Add the model's directory to the system path.
         """
@@ -551,4 +587,39 @@ class CommonFunction:
         
         if self.debug:
             with open(self.logfile,'a') as f:
-                f.write("\n{0}: {1} \n\n".format(s, e))
\ No newline at end of file
+                f.write("\n{0}: {1} \n\n".format(s, e))
+
+class KerasGraphModel:
+    """
+    A pretrained Keras model loaded into its own tensorflow graph and session.
+    Methods of the model, e.g. predict, are executed within the model's graph and session, so that multiple Keras models 
+    can be kept in memory and used by different threads at the same time.
+    """
+
+    def __init__(self, model, graph, session):
+        """
+        Class initializer.
+        :param model: the Keras model
+        :param graph: the tensorflow graph the model was loaded into
+        :param session: the tensorflow session for the graph
+        """
+
+        self.model = model
+        self.graph = graph
+        self.session = session
+
+    def __getattr__(self, name):
+        # Special attributes, e.g. those looked up by pickle, are not passed on to the model
+        if name.startswith('__'):
+            raise AttributeError(name)
+
+        attr = getattr(self.model, name)
+
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            with self.graph.as_default(), self.session.as_default():
+                return attr(*args, **kwargs)
+        
+        return call
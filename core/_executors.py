@@ -0,0 +1,286 @@
+import os
+import sys
+import time
+import queue
+import threading
+
+# Add Generated folder to module path
+PARENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(PARENT_DIR, 'generated'))
+
+import ServerSideExtension_pb2 as SSE
+import _utils as utils
+import _metrics as metrics
+
+class DetachedContext:
+    """
+    A stand-in for the gRPC context when a function is executed away from the gRPC thread, e.g. in a worker process.
+    The invocation metadata is replayed to the function and any initial metadata it sends is recorded,
+    so that it can be passed on to the real context.
+    """
+
+    def __init__(self, metadata, peer="", time_remaining=None):
+        """
+        Class initializer.
+        :param metadata: the invocation metadata of the original call as a list of (key, value) tuples
+        :param peer: the peer of the original call
+        :param time_remaining: the seconds remaining before the deadline of the original call, or None
+        """
+
+        self.metadata = tuple(metadata)
+        self._peer = peer
+        self.deadline = None if time_remaining is None else time.time() + time_remaining
+        self.initial_metadata = None
+
+    def invocation_metadata(self):
+        """
+        :return: the invocation metadata of the original call
+        """
+        return self.metadata
+
+    def peer(self):
+        """
+        :return: the peer of the original call
+        """
+        return self._peer
+
+    def send_initial_metadata(self, initial_metadata):
+        """
+        Record the initial metadata sent by the function, e.g. the table description.
+        """
+        self.initial_metadata = tuple(initial_metadata)
+
+    def is_active(self):
+        """
+        The original call can not be observed from here, so the call is active until its deadline.
+        """
+        return self.deadline is None or time.time() < self.deadline
+
+    def time_remaining(self):
+        """
+        :return: the seconds remaining before the deadline of the original call, or None if there is no deadline
+        """
+        return None if self.deadline is None else max(self.deadline - time.time(), 0)
+
+class RecordingContext:
+    """
+    A wrapper for the gRPC context that records the initial metadata sent by a function,
+    e.g. so that the table description can be sent again with a cached response, and whether the call was aborted.
+    All other attributes are passed through to the wrapped context.
+    """
+
+    def __init__(self, context):
+        """
+        Class initializer.
+        :param context: the gRPC context of the call
+        """
+
+        self.context = context
+        self.initial_metadata = None
+        self.aborted = False
+
+    def send_initial_metadata(self, initial_metadata):
+        """
+        Record the initial metadata and send it on the wrapped context.
+        """
+        self.initial_metadata = tuple(initial_metadata)
+        self.context.send_initial_metadata(initial_metadata)
+
+    def abort(self, code, details):
+        """
+        Record that the call was aborted, e.g. when it was rejected by its pool, and abort it on the wrapped context.
+        """
+        self.aborted = True
+        self.context.abort(code, details)
+
+    def __getattr__(self, name):
+        return getattr(self.context, name)
+
+class Bulkhead:
+    """
+    A thread pool for a class of functions, e.g. training or prediction, with a bounded queue.
+    Separate pools keep long running calls in one class from holding up calls in another.
+    The calls waiting for a thread are kept in a queue with a maximum size, so the pool can never hold more calls
+    than its threads and queue depth.
+    """
+
+    def __init__(self, name, workers, queue_depth):
+        """
+        Class initializer.
+        :param name: the name of the pool, used in messages
+        :param workers: the number of threads in the pool
+        :param queue_depth: the maximum number of calls waiting for a thread. Further calls are rejected.
+        """
+
+        self.name = name
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.slots = threading.BoundedSemaphore(workers + queue_depth)
+        self.tasks = queue.Queue(maxsize=workers + queue_depth)
+
+        # The threads don't keep the SSE running once it has stopped serving calls
+        self.threads = [threading.Thread(target=self._work, name="{0}_{1}".format(name, i), daemon=True) for i in range(workers)]
+
+        for thread in self.threads:
+            thread.start()
+
+    def stream(self, func, *args, context=None):
+        """
+        Execute a function that returns an iterable in the pool and pass the items back to the calling thread.
+        A slot in the pool is taken immediately, so PoolFull is raised here rather than when the items are consumed.
+        Only a few items are held for the calling thread at a time, so the function runs no further ahead of the 
+        consumer than that, e.g. when gRPC is sending a large response to a slow client.
+        :param func: the function, e.g. a function handler that yields SSE.BundledRows
+        :param args: the arguments for the function
+        :param context: the gRPC context of the call. The function is stopped if the call is no longer active.
+        :return: a generator for the items returned by the function
+        """
+
+        if not self.slots.acquire(blocking=False):
+            err = "The {0} pool is at capacity with {1} running and {2} queued calls. Please try again later."\
+                  .format(self.name, self.workers, self.queue_depth)
+            raise PoolFull(err)
+        
+        items = queue.Queue(maxsize=_STREAM_QUEUE_SIZE)
+        cancelled = threading.Event()
+
+        def put(entry):
+            # Wait for the caller to take an item, giving up if it stops consuming the results or the call is cancelled
+            while not cancelled.is_set() and (context is None or context.is_active()):
+                try:
+                    items.put(entry, timeout=_STREAM_POLL_INTERVAL)
+                    return True
+                except queue.Full:
+                    pass
+            
+            return False
+
+        def run():
+            try:
+                for item in func(*args):
+                    if not put((item, None)):
+                        return
+                
+                put((_DONE, None))
+            except BaseException as e:
+                put((None, e))
+            finally:
+                self.slots.release()
+        
+        try:
+            self.tasks.put_nowait(run)
+        except queue.Full:
+            self.slots.release()
+            err = "The {0} pool is at capacity with {1} running and {2} queued calls. Please try again later."\
+                  .format(self.name, self.workers, self.queue_depth)
+            raise PoolFull(err)
+
+        return self._consume(items, cancelled, context)
+    
+    def _work(self):
+        """
+        Execute the calls in the queue until the pool is shutdown.
+        """
+
+        while True:
+            task = self.tasks.get()
+
+            if task is _DONE:
+                return
+            
+            task()
+
+    @staticmethod
+    def _consume(items, cancelled, context=None):
+        """
+        Yield items put in the queue by the pool thread until it is done, re-raising any exception from the function.
+        Stop waiting for items if the call is no longer active, as the pool thread will then stop the function.
+        """
+
+        try:
+            while True:
+                try:
+                    item, exception = items.get(timeout=_STREAM_POLL_INTERVAL)
+                except queue.Empty:
+                    if context is None or context.is_active():
+                        continue
+                    return
+
+                if exception is not None:
+                    raise exception
+                elif item is _DONE:
+                    return
+                
+                yield item
+        finally:
+            cancelled.set()
+
+    def shutdown(self, wait=True):
+        """
+        Shutdown the pool. Calls already in the queue are executed first.
+        """
+
+        # Each thread stops when it takes a marker from the queue
+        for _ in self.threads:
+            self.tasks.put(_DONE)
+        
+        if wait:
+            for thread in self.threads:
+                thread.join()
+
+class PoolFull(Exception):
+    """
+    Raised when a call is submitted to a pool whose threads and queue are all taken.
+    """
+    pass
+
+# Marker for the end of the items returned by a function executed in a pool
+_DONE = object()
+
+# Maximum number of items a function executed in a pool can return ahead of the caller consuming them
+_STREAM_QUEUE_SIZE = 2
+
+# Seconds between checks for a cancelled call while a pool thread waits for the caller to take an item
+_STREAM_POLL_INTERVAL = 0.5
+
+def run_handler(service, handler, request, metadata, peer="", time_remaining=None, bundle_bytes=None):
+    """
+    Execute a function handler for a request and return the complete response.
+    This is the entry point for functions executed in a worker process, so arguments and results are serialized.
+    :param service: the class implementing the function handlers
+    :param handler: the name of the handler, e.g. '_prophet'
+    :param request: the request as a list of serialized SSE.BundledRows
+    :param metadata: the invocation metadata of the call as a list of (key, value) tuples
+    :param peer: the peer of the call
+    :param time_remaining: the seconds remaining before the deadline of the call, or None
+    :param bundle_bytes: target size in bytes for the bundles in the response
+    :return: a tuple of the response as a list of serialized SSE.BundledRows, the initial metadata sent by the handler and 
+    :        the seconds spent in each stage of the call, e.g. decode and model_load, for the metrics of the calling process
+    """
+
+    if bundle_bytes is not None:
+        service.bundle_bytes = bundle_bytes
+
+    context = DetachedContext(metadata, peer, time_remaining)
+    request_list = [SSE.BundledRows.FromString(bundle) for bundle in request]
+
+    # The stages timed by the handler are recorded here and returned with the response
+    call = metrics.start_call({})
+
+    try:
+        response = [bundle.SerializeToString() for bundle in getattr(service, handler)(iter(request_list), context)]
+    finally:
+        # Write the profile for the call if it was requested with profile=true
+        utils.end_profile()
+        # Other workers load models from disk, so background saves must complete before the response is returned
+        utils.background_writer.flush()
+        metrics.end_call(call, record=False)
+
+    return response, context.initial_metadata, call.timings
+
+def ready():
+    """
+    Used to start the worker processes ahead of the first request.
+    :return: the process id of the worker
+    """
+    return os.getpid()
@@ -0,0 +1,312 @@
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from concurrent import futures
+
+import _utils as utils
+from _executors import DetachedContext
+
+# Minimum seconds between writes of the status file for progress within a stage, e.g. for each epoch
+SAVE_INTERVAL = 1.0
+
+# States for a job. Jobs in a final state are no longer updated.
+QUEUED, RUNNING, COMPLETED, FAILED, INTERRUPTED = 'queued', 'running', 'completed', 'failed', 'interrupted'
+FINAL_STATES = (COMPLETED, FAILED, INTERRUPTED)
+
+class Job:
+    """
+    The status of a function, such as training a model, executed in the background.
+    """
+
+    # Attributes written to the status file for the job
+    attributes = ['job_id', 'model_name', 'function', 'state', 'stage', 'step', 'total', 'stage_started', 'submitted',\
+                  'started', 'finished', 'result', 'score']
+
+    def __init__(self, job_id, model_name, function):
+        """
+        Class initializer.
+        :param job_id: a unique identifier for the job
+        :param model_name: the model the job is for
+        :param function: a description of the function executed by the job, e.g. 'fit'
+        """
+
+        self.job_id = job_id
+        self.model_name = model_name
+        self.function = function
+        self.state = QUEUED
+        self.stage = None
+        self.step = None
+        self.total = None
+        self.stage_started = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.score = None
+
+    def progress(self):
+        """
+        :return: the fraction of the current stage that is complete, or None if the stage has no steps
+        """
+
+        if self.state == COMPLETED:
+            return 1.0
+
+        if self.step is None or not self.total:
+            return None
+
+        return min(self.step / self.total, 1.0)
+
+    def eta(self):
+        """
+        Estimate the seconds remaining in the current stage based on the time taken for the steps completed so far.
+        :return: the estimate, or None if no steps have been completed
+        """
+
+        if self.state != RUNNING or not self.step or not self.total or self.stage_started is None:
+            return None
+
+        elapsed = time.time() - self.stage_started
+        return max(elapsed / self.step * (self.total - self.step), 0.0)
+
+    def to_dict(self):
+        """
+        :return: the job as a dictionary for the status file
+        """
+        return {a: getattr(self, a) for a in self.attributes}
+
+    @classmethod
+    def from_dict(cls, d):
+        """
+        Create a job from a dictionary read from a status file.
+        """
+
+        job = cls(d['job_id'], d['model_name'], d['function'])
+
+        for a in cls.attributes:
+            setattr(job, a, d.get(a))
+
+        return job
+
+class JobContext(DetachedContext):
+    """
+    A stand-in for the gRPC context for a function executed as a job.
+    The function reports its progress through this context with utils.report_progress.
+    """
+
+    def __init__(self, job, registry, metadata, peer=""):
+        """
+        Class initializer.
+        :param job: the Job being executed
+        :param registry: the JobRegistry that persists the status of the job
+        :param metadata: the invocation metadata of the call that submitted the job
+        :param peer: the peer of the call that submitted the job
+        """
+
+        super().__init__(metadata, peer)
+        self.job = job
+        self.registry = registry
+        self.last_saved = 0
+
+    def report_progress(self, stage, step=None, total=None):
+        """
+        Update the stage of the job and the number of steps completed in that stage, e.g. 'cross validation', 2, 5.
+        The status in memory is always updated, while the status file is written when the stage changes and otherwise
+        at most once every SAVE_INTERVAL seconds.
+        """
+
+        job = self.job
+        now = time.time()
+        new_stage = stage != job.stage
+
+        if new_stage:
+            job.stage_started = now
+
+        job.stage, job.step, job.total = stage, step, total
+
+        if new_stage or now - self.last_saved >= SAVE_INTERVAL:
+            self.registry.save(job)
+            self.last_saved = now
+
+class JobRegistry:
+    """
+    Execute functions such as training a model as jobs in a pool of background threads, so that the call from Qlik can
+    return a job id immediately. The status of each job is kept in memory and written to a JSON file so that it can be
+    queried later, including after the SSE is restarted.
+    """
+
+    def __init__(self, path="../jobs/", max_workers=1, retention=7*24*60*60):
+        """
+        Class initializer.
+        :param path: the directory for the job status files
+        :param max_workers: the number of jobs executed at the same time
+        :param retention: seconds after which the status of finished jobs is deleted
+        """
+
+        self.path = path
+        self.max_workers = max_workers
+        self.retention = retention
+        self.executor = None
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, model_name, function, func, metadata=(), peer=""):
+        """
+        Submit a job to be executed in the background.
+        :param model_name: the model the job is for
+        :param function: a description of the function, e.g. 'fit'
+        :param func: the function to execute, which takes the JobContext as its only argument and returns a tuple
+        :            of a result message and a score
+        :param metadata: the invocation metadata of the call submitting the job, as a list of (key, value) tuples
+        :param peer: the peer of the call submitting the job
+        :return: the Job
+        """
+
+        job = Job(uuid.uuid4().hex, model_name, function)
+        context = JobContext(job, self, metadata, peer)
+
+        with self.lock:
+            # The pool is created on first use, so that the number of workers can be set when the server starts
+            if self.executor is None:
+                self.executor = futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='job')
+
+            self.jobs[job.job_id] = job
+
+        self.save(job)
+        self.executor.submit(self._run, job, func, context)
+        self.cleanup()
+
+        logging.info('Submitted job {0} to {1} model {2}'.format(job.job_id, function, model_name))
+        return job
+
+    def get(self, job_id):
+        """
+        Get the status of a job from memory or from its status file.
+        Jobs that were not finished when the SSE was stopped are returned as interrupted.
+        :param job_id: the job id
+        :return: the Job
+        """
+
+        with self.lock:
+            job = self.jobs.get(job_id)
+
+        if job is not None:
+            return job
+
+        try:
+            with open(self._get_file(job_id), 'r', encoding='utf-8') as f:
+                job = Job.from_dict(json.load(f))
+        except (OSError, ValueError):
+            err = "Job not found: {0}".format(job_id)
+            raise Exception(err)
+
+        if job.state not in FINAL_STATES:
+            job.state = INTERRUPTED
+            job.result = "The SSE was stopped before the job completed."
+
+        return job
+
+    def save(self, job):
+        """
+        Write the status of a job to its file.
+        """
+
+        with utils.atomic_path(self._get_file(job.job_id)) as temp:
+            with open(temp, 'w', encoding='utf-8') as f:
+                json.dump(job.to_dict(), f)
+
+    def cleanup(self):
+        """
+        Delete the status of finished jobs older than the retention period.
+        The status files of jobs held in memory are kept, e.g. for a long running job that hasn't reported progress recently.
+        """
+
+        cutoff = time.time() - self.retention
+
+        with self.lock:
+            for job_id, job in list(self.jobs.items()):
+                if job.state in FINAL_STATES and job.finished is not None and job.finished < cutoff:
+                    del self.jobs[job_id]
+            
+            active = set(self.jobs)
+
+        try:
+            files = [f for f in os.listdir(self.path) if f.endswith('.json')]
+        except OSError:
+            return
+
+        for f in files:
+            if f[:-len('.json')] in active:
+                continue
+
+            filepath = os.path.join(self.path, f)
+
+            try:
+                if os.path.getmtime(filepath) < cutoff:
+                    os.remove(filepath)
+            except OSError:
+                pass
+
+    def stats(self):
+        """
+        :return: a dictionary with the number of jobs in memory in each state
+        """
+
+        with self.lock:
+            states = [job.state for job in self.jobs.values()]
+
+        return {state: states.count(state) for state in (QUEUED, RUNNING, COMPLETED, FAILED)}
+
+    def shutdown(self, wait=True):
+        """
+        Stop accepting jobs and optionally wait for the running and queued jobs to complete.
+        """
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait)
+
+    def _run(self, job, func, context):
+        """
+        Execute a job, recording the result or the error in its status.
+        """
+
+        job.state = RUNNING
+        job.started = time.time()
+        self.save(job)
+
+        state = FAILED
+
+        try:
+            job.result, job.score = func(context)
+            state = COMPLETED
+        except Exception as e:
+            logging.exception('Job {0} for model {1} failed'.format(job.job_id, job.model_name))
+            job.result = str(e)
+            state = FAILED
+        finally:
+            # The finish time is set before the final state, as cleanup relies on it for finished jobs
+            # The stage and steps are kept to show how far the job got
+            job.finished = time.time()
+            job.state = state
+            self.save(job)
+
+            # Write the profile for the job if it was requested with profile=true for the model
+            utils.end_profile()
+
+    def _get_file(self, job_id):
+        """
+        :return: the path of the status file for a job
+        """
+
+        # Job ids are used in the file name, so only the characters generated for ids are accepted
+        if not job_id or not all(c in '0123456789abcdef' for c in job_id):
+            err = "Invalid job id: {0}".format(job_id)
+            raise Exception(err)
+
+        return os.path.join(self.path, job_id + '.json')
+
+# The registry for jobs executed by this process
+registry = JobRegistry()
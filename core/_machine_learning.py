@@ -3,7 +3,11 @@ import gc
 import sys
 import time
 import copy
+import json
 import joblib
+import fnmatch
+import threading
+import weakref
 import numpy as np
 import pandas as pd
 import warnings
@@ -14,8 +18,11 @@ if not sys.warnoptions:
     
 from pathlib import Path
 from sklearn import preprocessing
-from sklearn.base import TransformerMixin
+from sklearn.base import TransformerMixin, clone
+from sklearn.metrics import get_scorer
 from sklearn.pipeline import Pipeline
+from sklearn.model_selection import GridSearchCV, ParameterGrid
+from sklearn.utils import check_random_state
 from sklearn.feature_extraction import FeatureHasher
 from sklearn.feature_extraction.text import CountVectorizer
 from sklearn.feature_extraction.text import TfidfVectorizer
@@ -33,11 +40,29 @@ from keras.wrappers.scikit_learn import KerasRegressor
 sys.stderr = stderr
 
 import _utils as utils
+import _metrics as metrics
 
 class PersistentModel:
     """
     A general class to manage persistent models
     """
+
+    # Attributes written to the metadata sidecar so that model information can be returned without loading the full model
+    metadata_attributes = ['name', 'state', 'state_timestamp', 'using_keras', 'debug', 'estimator', 'estimator_type',\
+                           'validation', 'lags', 'lag_target', 'features_df', 'original_features_df', 'metrics_df',\
+                           'confusion_matrix', 'importances', 'best_params', 'search_strategy', 'search_candidates',\
+                           'search_time_per_candidate']
+
+    # Training and test data kept with retain_data=true. This is stored in a separate file and only loaded when accessed.
+    data_attributes = ['X_train', 'y_train', 'X_test', 'y_test']
+
+    # Retained data loaded from file, keyed by the file and its modification time, so that the file is read once while 
+    # the data is in use. The data is only held by its users, e.g. a caller keeping the dictionary from load_data.
+    loaded_data = weakref.WeakValueDictionary()
+    loaded_data_lock = threading.Lock()
+
+    # Uncompressed files are not memory mapped on Windows, as a mapped file can't be replaced when the model is saved again
+    mmap_loads = os.name != 'nt'
     
     def __init__(self):
         """
@@ -48,39 +73,48 @@ class PersistentModel:
         self.state = None
         self.state_timestamp = None
         self.using_keras = False
+        self.data_file = None
+    
+    def __getattr__(self, name):
+        """
+        Load retained training and test data from its file when it is accessed.
+        The data is not kept with the model, so the memory used by cached models does not depend on the training data.
+        """
+
+        # Use the instance dictionary directly as this method is also called before the instance is initialized
+        if name in PersistentModel.data_attributes and self.__dict__.get('data_file') is not None:
+            data = self.load_data()
+
+            if name in data:
+                return data[name]
+        
+        raise AttributeError("'{0}' object has no attribute '{1}'".format(self.__class__.__name__, name))
         
-    def save(self, name, path, overwrite=True, compress=3, locked_timeout=2):
+    def save(self, name, path, overwrite=True, compress=3, locked_timeout=None):
         """
         Save the model to disk at the specified path.
         If the model already exists and overwrite=False, throw an exception.
         If overwrite=True, replace any existing file with the same name at the path.
-        If the model is found to be locked, wait 'locked_timeout' seconds and try again before quitting.
+        Concurrent saves of the same model are serialized with a file lock. If 'locked_timeout' is given, wait at most this 
+        many seconds for another save to complete before quitting. Files are written to a temporary file and then 
+        replaced atomically, so readers never wait for a save or see a partially written model.
         """
         
         # Create string for path and file name
         f = path + name + '.joblib'
-
-        # Create a path for the lock file
-        f_lock = f + '.lock'
                 
         # Create the directory if required
-        try:
-            Path(path).mkdir(parents=True, exist_ok=False) 
-        except FileExistsError:
-            pass
+        Path(path).mkdir(parents=True, exist_ok=True)
+
+        # Let any background save of the model complete first so that it does not replace this one
+        utils.background_writer.wait(f)
         
-        # If the file exists and overwriting is not allowed, raise an exception
-        if Path(f).exists() and not overwrite:
-            raise FileExistsError("The specified model name already exists: {0}.".format(name + '.joblib')\
-                                  +"\nPass overwrite=True if it is ok to overwrite.")
-        # Check if the file is currently locked
-        elif Path(f_lock).exists():
-            # Wait a few seconds and check again
-            time.sleep(locked_timeout)
-            # If the file is still locked raise an exception
-            if Path(f_lock).exists():
-                raise TimeoutError("The specified model is locked. If you believe this to be wrong, please delete file {0}".format(f_lock))
-        else:
+        with utils.FileLock(f, timeout=locked_timeout):
+            # If the file exists and overwriting is not allowed, raise an exception
+            if Path(f).exists() and not overwrite:
+                raise FileExistsError("The specified model name already exists: {0}.".format(name + '.joblib')\
+                                      +"\nPass overwrite=True if it is ok to overwrite.")
+            
             # Update properties
             self.name = name
             self.state = 'saved'
@@ -92,33 +126,181 @@ class PersistentModel:
                     # Get the trained keras model from the pipeline's estimator
                     keras_model = self.pipe.named_steps['estimator'].model
                     # Save the keras model architecture and weights to disk
-                    keras_model.save(path + name + '.h5', overwrite=overwrite)
+                    with utils.atomic_path(path + name + '.h5') as temp:
+                        keras_model.save(temp, overwrite=True)
                                         
                     # The Keras estimator is excluded from the model saved to the joblib file
                     self.pipe.named_steps['estimator'].model = None
             except AttributeError:
                 pass
+
+            # Store any retained training and test data in a separate file
+            self.save_data(name, path, compress=compress)
             
-            # Create the lock file
-            joblib.dump(f_lock, filename=Path(f_lock), compress=compress)
+            # Store this instance to file
+            with utils.atomic_path(f) as temp:
+                joblib.dump(self, filename=temp, compress=compress)
 
-            try:
-                # Store this instance to file
-                joblib.dump(self, filename=Path(f), compress=compress)
-            finally:
-                # Delete the lock file
-                Path(f_lock).unlink()
+            # Store the model information in a sidecar file
+            self.save_metadata(name, path)
+            
+            # Add the model to the registry used to list models
+            ModelRegistry.get(path).update(self, path)
                 
         return self
     
+    def save_data(self, name, path, compress=3):
+        """
+        Move the training and test data retained with retain_data=true from the model to the file <name>.data.joblib.
+        If the model has no retained data any data file left by a previous fit is deleted.
+        """
+
+        f = path + name + '.data.joblib'
+        data = {a: self.__dict__[a] for a in self.data_attributes if a in self.__dict__}
+
+        if len(data) > 0:
+            with utils.atomic_path(f) as temp:
+                joblib.dump(data, filename=temp, compress=compress)
+            
+            # The data is only removed from the model once it can be loaded from the file
+            self.data_file = f
+
+            for a in data:
+                self.__dict__.pop(a, None)
+        elif self.__dict__.get('data_file') != f:
+            if os.path.exists(f):
+                os.remove(f)
+            
+            self.data_file = None
+    
+    def load_data(self):
+        """
+        Load the training and test data retained with the model.
+        Use this rather than the data attributes to access several of them, as the file is read again once the data is released.
+        :return: a dictionary of the retained data, e.g. {'X_train': ..., 'y_train': ...}
+        """
+
+        if self.__dict__.get('data_file') is None:
+            return {}
+        
+        # The data file may still be written by a background save of the model
+        utils.background_writer.wait(self.data_file[:-len('.data.joblib')] + '.joblib')
+        
+        # The modification time is part of the key so that data saved by a later fit is loaded again
+        try:
+            key = (os.path.abspath(self.data_file), os.stat(self.data_file).st_mtime_ns)
+        except OSError:
+            return {}
+
+        with PersistentModel.loaded_data_lock:
+            data = PersistentModel.loaded_data.get(key)
+
+        if data is None:
+            with metrics.stage('model_load'):
+                if PersistentModel.mmap_loads and self.is_uncompressed(self.data_file):
+                    data = RetainedData(joblib.load(self.data_file, mmap_mode='c'))
+                else:
+                    with open(self.data_file, 'rb') as data_file:
+                        data = RetainedData(joblib.load(data_file))
+            
+            with PersistentModel.loaded_data_lock:
+                PersistentModel.loaded_data[key] = data
+        
+        return data
+    
+    def save_async(self, name, path, overwrite=True, compress=3):
+        """
+        Save the model to disk in a background thread and return immediately.
+        The model should already be in the in-memory cache so that it can be used while the save is pending.
+        Readers of the model files must call utils.background_writer.wait with the model's file path before loading.
+        The background thread saves a shallow copy of the model, so this instance is not changed by the save.
+        """
+        
+        # Create string for path and file name
+        f = path + name + '.joblib'
+        
+        # Check for an existing model here so that the error is returned to the caller
+        if Path(f).exists() and not overwrite:
+            raise FileExistsError("The specified model name already exists: {0}.".format(name + '.joblib')\
+                                  +"\nPass overwrite=True if it is ok to overwrite.")
+        
+        # Update properties
+        self.name = name
+        self.state = 'saving'
+        self.state_timestamp = time.time()
+
+        # The copy keeps its own attributes, so the state and retained data of this instance are not changed by the save
+        snapshot = copy.copy(self)
+
+        # The retained data moves to the copy that writes it to file. This instance loads it from there when accessed.
+        data = [a for a in self.data_attributes if a in self.__dict__]
+
+        if len(data) > 0:
+            self.data_file = path + name + '.data.joblib'
+
+            for a in data:
+                del self.__dict__[a]
+
+        # Writes are executed in order, so a later save of the same model will replace this one
+        utils.background_writer.submit(f, snapshot.save, name, path, overwrite=True, compress=compress)
+
+        return self
+    
+    def save_metadata(self, name, path):
+        """
+        Save a compact JSON sidecar with the model information used by metadata functions such as get_features and get_metrics.
+        Data frames are stored in the 'split' format and the best parameters in the argument syntax for this SSE.
+        If the information can't be stored as JSON, any existing sidecar is removed so that the full model is used instead.
+        """
+
+        f = Path(path + name + '.meta.json')
+        metadata = {}
+
+        try:
+            for attr in self.metadata_attributes:
+                if not hasattr(self, attr):
+                    continue
+
+                value = getattr(self, attr)
+
+                if isinstance(value, pd.DataFrame):
+                    value = {'__dataframe__': value.to_dict('split')}
+                elif attr == 'best_params' and isinstance(value, dict):
+                    value = utils.dict_to_sse_arg(value)
+                
+                metadata[attr] = value
+
+            output = json.dumps(metadata, default=_json_default)
+        except (TypeError, KeyError, ValueError):
+            if f.exists():
+                f.unlink()
+            return
+
+        with utils.atomic_path(f) as temp:
+            with open(temp, 'w', encoding='utf-8') as meta_file:
+                meta_file.write(output)
+    
     def load(self, name, path):
         """
         Check if the model exists at the specified path and return it to the caller.
         If the model is not found throw an exception.
+        Models saved uncompressed, e.g. with storage=mmap, are memory mapped so that worker processes can share the 
+        page cached arrays. The mapping is copy-on-write, so a model can still be updated in memory.
+        On Windows the files are read without memory mapping, as a mapped file can't be replaced by a later save.
         """
         
-        with open(Path(path + name + '.joblib'), 'rb') as f:
-            self = joblib.load(f)
+        f = Path(path + name + '.joblib')
+
+        with metrics.stage('model_load'):
+            if PersistentModel.mmap_loads and self.is_uncompressed(f):
+                self = joblib.load(f, mmap_mode='c')
+            else:
+                with open(f, 'rb') as model_file:
+                    self = joblib.load(model_file)
+        
+        # Point to the retained data at this path in case the models directory has been moved
+        if self.__dict__.get('data_file') is not None:
+            self.data_file = path + name + '.data.joblib'
         
         # If using Keras we need to load the HDF5 file as well
         # The model will only be available if the fit method has been called previously
@@ -129,12 +311,308 @@ class PersistentModel:
             kerasbackend.clear_session()
             
             # Load the keras model architecture and weights from disk
-            keras_model = keras.models.load_model(path + name + '.h5')
+            with metrics.stage('model_load'):
+                keras_model = keras.models.load_model(path + name + '.h5')
             keras_model._make_predict_function()                
             # Point the estimator in the sklearn pipeline to the keras model architecture and weights 
             self.pipe.named_steps['estimator'].model = keras_model
 
         return self
+    
+    @staticmethod
+    def is_uncompressed(f):
+        """
+        Check if a joblib file was saved without compression, in which case it starts with the pickle protocol opcode.
+        """
+
+        with open(f, 'rb') as model_file:
+            return model_file.read(1) == b'\x80'
+
+    def load_metadata(self, name, path):
+        """
+        Load the model information from the JSON sidecar written by save_metadata.
+        The returned model only has the attributes in metadata_attributes, and best_params is a string in the SSE argument syntax.
+        If the sidecar is not found, e.g. for models saved by an earlier version, throw a FileNotFoundError.
+        """
+
+        with open(Path(path + name + '.meta.json'), 'r', encoding='utf-8') as f:
+            metadata = json.load(f)
+        
+        model = PersistentModel()
+
+        for attr, value in metadata.items():
+            if isinstance(value, dict) and '__dataframe__' in value:
+                split = value['__dataframe__']
+                value = pd.DataFrame(split['data'], index=split['index'], columns=split['columns'])
+            
+            setattr(model, attr, value)
+        
+        return model
+
+class RetainedData(dict):
+    """
+    The training and test data loaded from a data file. A dict subclass is used as plain dicts can't be weakly referenced.
+    """
+    pass
+
+def _json_default(obj):
+    """
+    Convert NumPy and other values that are not supported by the json module.
+    """
+
+    if isinstance(obj, np.integer):
+        return int(obj)
+    elif isinstance(obj, np.floating):
+        return float(obj)
+    elif isinstance(obj, np.bool_):
+        return bool(obj)
+    elif isinstance(obj, np.ndarray):
+        return obj.tolist()
+    
+    raise TypeError("{0} is not JSON serializable".format(type(obj)))
+
+class ModelRegistry:
+    """
+    A catalog of the models saved in a directory, kept in a JSON file and served from memory.
+    The catalog is updated by PersistentModel.save and reloaded if it is changed by another process.
+    If the catalog file doesn't exist, it is built by scanning the directory. Models deleted from the directory or 
+    copied into it by other means are removed from or added to the catalog when a model is saved or by reconcile, 
+    e.g. on the --watch_models timer. Listing models never scans the directory.
+    """
+
+    # Registries for each models directory at the class level
+    registries = {}
+    registries_lock = threading.Lock()
+
+    # Name of the catalog file in the models directory
+    catalog_file = 'registry.json'
+
+    def __init__(self, path):
+        """
+        Class initializer.
+        :param path: the models directory
+        """
+
+        self.path = path
+        self.file = os.path.join(path, self.catalog_file)
+        self.lock = threading.RLock()
+        self.entries = {}
+        self.mtime = None
+    
+    @classmethod
+    def get(cls, path):
+        """
+        Get the registry for a models directory.
+        """
+
+        key = os.path.abspath(path)
+
+        with cls.registries_lock:
+            if key not in cls.registries:
+                cls.registries[key] = cls(path)
+            
+            return cls.registries[key]
+
+    def update(self, model, path):
+        """
+        Add or update the catalog entry for a model that has been saved to disk.
+        :param model: the PersistentModel
+        :param path: the models directory
+        """
+
+        entry = self.get_entry(model, path)
+
+        # The catalog file is locked while it is updated, as models can be saved by more than one process
+        with self.lock, utils.FileLock(self.file):
+            self._refresh()
+            self._reconcile()
+            self.entries[model.name] = entry
+            self._write()
+
+    def reconcile(self):
+        """
+        Add models copied into the directory and remove models deleted from it by other means than saving a model.
+        """
+
+        with self.lock, utils.FileLock(self.file):
+            self._refresh()
+
+            if self._reconcile():
+                self._write()
+
+    @classmethod
+    def reconcile_all(cls):
+        """
+        Reconcile the registries for all models directories in use by this process.
+        """
+
+        with cls.registries_lock:
+            registries = list(cls.registries.values())
+        
+        for registry in registries:
+            registry.reconcile()
+
+    def list(self, pattern='*', **filters):
+        """
+        List the models matching a pattern and filters on the catalog attributes.
+        :param pattern: a Unix shell-style pattern for the model name, e.g. 'HR-*'
+        :param filters: patterns for string attributes, e.g. estimator='*Forest*', and min_score or max_score for the score
+        :return: a list of catalog entries sorted by name
+        """
+
+        min_score = filters.pop('min_score', None)
+        max_score = filters.pop('max_score', None)
+
+        # The catalog file is replaced atomically, so it is read without the file lock unless it has to be built
+        with self.lock:
+            if not os.path.exists(self.file):
+                with utils.FileLock(self.file):
+                    self._refresh()
+            else:
+                self._refresh()
+            
+            entries = list(self.entries.values())
+
+        matches = []
+
+        for entry in sorted(entries, key=lambda e: e['name']):
+            # The pattern is matched against the model name and the file name for compatibility with earlier versions
+            if not (fnmatch.fnmatch(entry['name'], pattern) or fnmatch.fnmatch(entry['file'], pattern)):
+                continue
+
+            if any(not fnmatch.fnmatch(str(entry.get(k)), str(v)) for k, v in filters.items()):
+                continue
+
+            if min_score is not None and (entry['score'] is None or entry['score'] < float(min_score)):
+                continue
+
+            if max_score is not None and (entry['score'] is None or entry['score'] > float(max_score)):
+                continue
+
+            matches.append(entry)
+
+        return matches
+
+    def _refresh(self):
+        """
+        Load the catalog from disk if it has been changed since it was last read, or build it if it doesn't exist.
+        The lock must be held by the caller, and the file lock for the catalog as well if the catalog doesn't exist.
+        """
+
+        try:
+            mtime = os.stat(self.file).st_mtime
+        except FileNotFoundError:
+            self.entries = self._scan(self._get_names())
+            self._write()
+            return
+
+        if mtime != self.mtime:
+            with open(self.file, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+            
+            self.mtime = mtime
+
+    def _reconcile(self):
+        """
+        Remove entries for model files that no longer exist and add model files missing from the catalog.
+        The lock and the file lock for the catalog must be held by the caller.
+        :return: True if the catalog was changed and needs to be written
+        """
+
+        names = self._get_names()
+        deleted = set(self.entries) - names
+        added = names - set(self.entries)
+
+        for name in deleted:
+            del self.entries[name]
+        
+        self.entries.update(self._scan(added))
+        return len(deleted) > 0 or len(added) > 0
+
+    def _write(self):
+        """
+        Write the catalog to disk. The lock must be held by the caller.
+        """
+
+        # Write to a temporary file and then replace the catalog so that readers never see a partial file
+        with utils.atomic_path(self.file) as temp:
+            with open(temp, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f, default=_json_default)
+        
+        self.mtime = os.stat(self.file).st_mtime
+
+    def _get_names(self):
+        """
+        Get the names of the models saved in the directory.
+        """
+
+        # Skip the files for retained training and test data
+        return {f.name[:-len('.joblib')] for f in Path(self.path).glob('*.joblib') if not f.name.endswith('.data.joblib')}
+
+    def _scan(self, names):
+        """
+        Get the catalog entries for models in the directory.
+        The model information is read from the metadata sidecar where available.
+        :param names: the names of the models
+        """
+
+        entries = {}
+
+        for name in names:
+            f = Path(self.path + name + '.joblib')
+            model = PersistentModel()
+            model.name = name
+
+            try:
+                model = model.load_metadata(name, self.path)
+            except (FileNotFoundError, ValueError):
+                model.state_timestamp = f.stat().st_mtime
+
+            entries[name] = self.get_entry(model, self.path)
+
+        return entries
+
+    @staticmethod
+    def get_entry(model, path):
+        """
+        Get the catalog entry for a model.
+        :param model: the PersistentModel or the model information from the metadata sidecar
+        :param path: the models directory
+        :return: a dictionary with the name, estimator, type, score, size and timestamps for the model
+        """
+
+        f = Path(path + model.name + '.joblib')
+        
+        # The size includes the HDF5 file for Keras models and the file for retained data
+        files = (f, Path(path + model.name + '.h5'), Path(path + model.name + '.data.joblib'))
+        size = sum(p.stat().st_size for p in files if p.exists())
+
+        try:
+            created = f.stat().st_ctime
+        except FileNotFoundError:
+            created = None
+
+        return {'name': model.name, 'file': f.name, 'estimator': getattr(model, 'estimator', None),\
+                'estimator_type': getattr(model, 'estimator_type', None), 'score': ModelRegistry.get_score(model),\
+                'size': size, 'created': created, 'modified': getattr(model, 'state_timestamp', None)}
+
+    @staticmethod
+    def get_score(model):
+        """
+        Get a single score for a model from its metrics, i.e. the accuracy for classifiers and r2 for regressors.
+        :return: the score averaged over the rows of the metrics, or None if metrics are not available
+        """
+
+        metrics_df = getattr(model, 'metrics_df', None)
+
+        if not isinstance(metrics_df, pd.DataFrame):
+            return None
+
+        for col in ('accuracy', 'r2_score', 'r2'):
+            if col in metrics_df.columns:
+                return float(pd.to_numeric(metrics_df[col], errors='coerce').mean())
+        
+        return None
 
 class Preprocessor(TransformerMixin):
     """
@@ -236,6 +714,18 @@ class Preprocessor(TransformerMixin):
         if self.log is not None:
             self._print_log(1)
     
+    def get_params(self, deep=True):
+        """
+        Get the arguments used to initialize the Preprocessor.
+        This allows scikit-learn to clone the object, which is required when the transformers in a Pipeline are cached.
+        """
+
+        params = {"features": self.features, "return_type": self.return_type, "scale_hashed": self.scale_hashed,\
+        "scale_vectors": self.scale_vectors, "missing": self.missing, "scaler": self.scaler, "logfile": self.log}
+        params.update(self.kwargs)
+
+        return params
+    
     def fit(self, X, y=None, features=None, retrain=False):
         """
         Fit to the training dataset, storing information that will be needed for the transform dataset.
@@ -1005,6 +1495,183 @@ class Reshaper(TransformerMixin):
         with open(self.logfile, mode, encoding='utf-8') as f:
             f.write(output)
 
+class CancellableSplitter:
+    """
+    A wrapper for a Scikit-Learn cross validation splitter that checks the gRPC context before each fold.
+    This allows cross validation on a large dataset to stop if Qlik cancels the call.
+    For background jobs the number of folds completed is reported as the progress of the job.
+    """
+
+    def __init__(self, cv, context=None):
+        """
+        Class initializer.
+        :param cv: a cross validation splitter, e.g. from sklearn.model_selection.check_cv
+        :param context: the gRPC context of the call
+        """
+
+        self.cv = cv
+        self.context = context
+    
+    def split(self, X, y=None, groups=None):
+        """
+        Generate the indices for the training and test sets, checking the call is still active before each fold.
+        """
+
+        n_splits = self.get_n_splits(X, y, groups)
+
+        for i, (train, test) in enumerate(self.cv.split(X, y, groups)):
+            utils.check_context(self.context, "fold {0}".format(i+1))
+            utils.report_progress(self.context, "cross validation", i, n_splits)
+            yield train, test
+    
+    def get_n_splits(self, X=None, y=None, groups=None):
+        """
+        Return the number of folds from the wrapped splitter.
+        """
+
+        return self.cv.get_n_splits(X, y, groups)
+
+class ProgressCallback(keras.callbacks.Callback):
+    """
+    A Keras callback that reports the number of epochs completed as the progress of a background job.
+    """
+
+    def __init__(self, context=None):
+        """
+        Class initializer.
+        :param context: the JobContext of the job
+        """
+
+        super().__init__()
+        self.context = context
+    
+    def on_train_begin(self, logs=None):
+        utils.report_progress(self.context, "epochs", 0, self.params.get('epochs'))
+
+    def on_epoch_end(self, epoch, logs=None):
+        utils.report_progress(self.context, "epochs", epoch + 1, self.params.get('epochs'))
+    
+    def __deepcopy__(self, memo):
+        # The Keras wrapper copies its parameters for each fit, so copies share the context with the original
+        return self
+    
+    def __getstate__(self):
+        # The context is only valid for the job, so it is not saved with the model
+        return {}
+    
+    def __setstate__(self, state):
+        self.__init__()
+
+def cross_validate_predict(estimator, X, y, scoring, cv, fit_params=None, n_jobs=1, predict=True):
+    """
+    Cross validate an estimator, fitting it once for each fold to get both the scores and the out-of-fold predictions.
+    This replaces separate calls to sklearn's cross_validate and cross_val_predict, which fit the estimator twice per fold.
+    :param estimator: the estimator or pipeline, which is cloned for each fold
+    :param X: the features as a DataFrame or array
+    :param y: the targets as an array
+    :param scoring: a list of scorer names or a dictionary of names to scorer names or scorers
+    :param cv: a cross validation splitter, e.g. a CancellableSplitter
+    :param fit_params: parameters passed to the fit method of the estimator
+    :param n_jobs: the number of folds fitted in parallel using joblib. Use 1 for estimators that can't be pickled, e.g. Keras.
+    :param predict: whether to return the out-of-fold predictions
+    :return: a tuple of a dictionary of arrays of scores for each fold, with keys 'test_<name>', the predictions, 
+    :        and the indices of the samples that were predicted. Splitters such as TimeSeriesSplit don't predict every sample.
+    """
+
+    if not isinstance(scoring, dict):
+        scoring = {name: name for name in scoring}
+    
+    scorers = {name: get_scorer(scorer) if isinstance(scorer, str) else scorer for name, scorer in scoring.items()}
+
+    # The folds are generated here so that a CancellableSplitter checks the call before each fold is dispatched
+    results = joblib.Parallel(n_jobs=n_jobs)(joblib.delayed(_fit_and_score_fold)(clone(estimator), X, y, train, test,\
+                                             scorers, fit_params or {}, predict) for train, test in cv.split(X, y))
+    
+    scores = {'test_' + name: np.array([result[0][name] for result in results]) for name in scorers}
+    
+    if not predict:
+        return scores, None, None
+
+    # Put the predictions in the order of the samples
+    indices = np.concatenate([result[2] for result in results])
+    y_pred = np.concatenate([result[1] for result in results])
+    order = np.argsort(indices, kind='mergesort')
+
+    return scores, y_pred[order], indices[order]
+
+def _fit_and_score_fold(estimator, X, y, train, test, scorers, fit_params, predict):
+    """
+    Fit an estimator on the training set for a fold and score it, and optionally get its predictions, on the test set.
+    :return: a tuple of a dictionary of scores, the predictions or None, and the test indices
+    """
+
+    def subset(data, indices):
+        return data.iloc[indices] if hasattr(data, 'iloc') else data[indices]
+
+    X_train, X_test, y_train, y_test = subset(X, train), subset(X, test), subset(y, train), subset(y, test)
+
+    estimator.fit(X_train, y_train, **fit_params)
+
+    scores = {name: scorer(estimator, X_test, y_test) for name, scorer in scorers.items()}
+    y_pred = estimator.predict(X_test) if predict else None
+
+    return scores, y_pred, test
+
+class EarlyStoppingGridSearchCV(GridSearchCV):
+    """
+    A grid search that evaluates the candidates in a random order and stops when the best score has not improved for a 
+    number of candidates. Candidates are evaluated in batches of n_jobs so that the folds for a batch run in parallel.
+    """
+
+    def __init__(self, estimator, param_grid, patience=10, max_candidates=None, random_state=None, scoring=None, n_jobs=None,\
+                 refit=True, cv=None, verbose=0, pre_dispatch='2*n_jobs', error_score=np.nan, return_train_score=False):
+        """
+        Class initializer.
+        :param patience: the number of candidates without an improvement in the best score after which the search stops
+        :param max_candidates: the maximum number of candidates to evaluate. If None, the search can cover the full grid.
+        :param random_state: the seed for the order in which candidates are evaluated
+        :Other parameters are passed on to GridSearchCV
+        """
+
+        super().__init__(estimator=estimator, param_grid=param_grid, scoring=scoring, n_jobs=n_jobs, refit=refit, cv=cv,\
+                         verbose=verbose, pre_dispatch=pre_dispatch, error_score=error_score, return_train_score=return_train_score)
+        
+        self.patience = patience
+        self.max_candidates = max_candidates
+        self.random_state = random_state
+
+    def _run_search(self, evaluate_candidates):
+        """
+        Evaluate batches of candidates from the grid until the score stops improving.
+        """
+
+        candidates = list(ParameterGrid(self.param_grid))
+        check_random_state(self.random_state).shuffle(candidates)
+
+        if self.max_candidates:
+            candidates = candidates[:self.max_candidates]
+
+        # The score used to pick the best candidate is given by refit when there are multiple metrics
+        key = 'mean_test_' + (self.refit if isinstance(self.refit, str) else 'score')
+        batch_size = max(joblib.effective_n_jobs(self.n_jobs), 1)
+        best, stale = -np.inf, 0
+
+        for i in range(0, len(candidates), batch_size):
+            batch = candidates[i:i+batch_size]
+            results = evaluate_candidates(batch)
+
+            # The results include all candidates evaluated so far, with the latest batch last
+            scores = np.asarray(results[key][-len(batch):], dtype=float)
+            scores = scores[~np.isnan(scores)]
+
+            if len(scores) > 0 and scores.max() > best:
+                best, stale = scores.max(), 0
+            else:
+                stale += len(batch)
+            
+            if stale >= self.patience:
+                break
+
 class KerasClassifierForQlik(KerasClassifier):
     """
     A subclass of the KerasClassifier Scikit-Learn wrapper.
@@ -0,0 +1,373 @@
+import time
+import logging
+import threading
+import socketserver
+from bisect import bisect_left
+from contextlib import contextmanager
+from collections import OrderedDict
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+# Buckets for the histograms of durations in seconds, row counts and sizes in bytes
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+ROWS_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000, 10000000)
+BYTES_BUCKETS = tuple(1024 * 4**i for i in range(11))
+
+# Stages of a call that are timed separately. Compute is the time in the function handler outside the other stages.
+STAGES = ('decode', 'model_load', 'compute', 'encode')
+
+# The call being executed by the current thread
+_local = threading.local()
+
+class Histogram:
+    """
+    A cumulative histogram with fixed buckets in the Prometheus style.
+    """
+
+    def __init__(self, buckets):
+        """
+        Class initializer.
+        :param buckets: the upper bounds for the buckets in ascending order. A bucket for +Inf is added.
+        """
+
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """
+        Add a value to the histogram.
+        """
+
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class MetricsRegistry:
+    """
+    A thread-safe store for the histograms recorded for function calls.
+    The metrics can be rendered in the Prometheus text format and summarized in the log.
+    """
+
+    def __init__(self):
+        """
+        Class initializer.
+        """
+
+        self.histograms = OrderedDict()
+        self.help = {}
+        self.collectors = OrderedDict()
+        self.lock = threading.Lock()
+
+        # Totals by capability since the last summary
+        self.interval = {}
+
+    def observe(self, name, labels, value, buckets=SECONDS_BUCKETS, help=""):
+        """
+        Add a value to the histogram for a metric and set of labels.
+        :param name: the name of the metric, e.g. 'sse_stage_seconds'
+        :param labels: a tuple of (label, value) pairs
+        :param value: the value to add
+        :param buckets: the buckets used if this is the first value for the metric and labels
+        :param help: a description of the metric
+        """
+
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+
+            if histogram is None:
+                histogram = self.histograms[(name, labels)] = Histogram(buckets)
+                self.help.setdefault(name, help)
+
+            histogram.observe(value)
+
+    def register_collector(self, name, collect, help="", counters=()):
+        """
+        Add metrics that are read when the metrics are rendered, e.g. the response cache statistics.
+        :param name: the prefix for the metric names
+        :param collect: a function that returns a dictionary of values, each of which is exported as <name>_<key>
+        :param help: a description of the metric
+        :param counters: the keys for values that only ever increase, e.g. cache hits. These are exported as counters
+        :                and all other values as gauges.
+        """
+
+        with self.lock:
+            self.collectors[name] = (collect, help, frozenset(counters))
+
+    def record_call(self, call):
+        """
+        Record the metrics for a completed call.
+        :param call: the CallMetrics for the call
+        """
+
+        labels = tuple(call.labels.items())
+        total = time.perf_counter() - call.start
+
+        # Time in the handler that was not spent in another stage is counted as compute
+        timings = dict(call.timings)
+        timings['compute'] = max(total - sum(timings.values()), 0)
+
+        self.observe('sse_call_seconds', labels, total, help="Total duration of function calls in seconds")
+
+        for stage in STAGES:
+            if stage in timings:
+                self.observe('sse_stage_seconds', labels + (('stage', stage),), timings[stage],\
+                             help="Duration of each stage of function calls in seconds")
+
+        for direction in ('request', 'response'):
+            self.observe('sse_rows', labels + (('direction', direction),), call.counts[direction + '_rows'],\
+                         buckets=ROWS_BUCKETS, help="Number of rows in the request and response of function calls")
+            self.observe('sse_bytes', labels + (('direction', direction),), call.counts[direction + '_bytes'],\
+                         buckets=BYTES_BUCKETS, help="Size of the request and response of function calls in bytes")
+
+        # Add to the totals for the periodic summary
+        with self.lock:
+            totals = self.interval.setdefault(call.labels.get('capability', ''), dict.fromkeys(('calls', 'seconds',\
+                     'request_rows', 'response_rows') + STAGES, 0))
+            totals['calls'] += 1
+            totals['seconds'] += total
+            totals['request_rows'] += call.counts['request_rows']
+            totals['response_rows'] += call.counts['response_rows']
+
+            for stage in STAGES:
+                totals[stage] += timings.get(stage, 0)
+
+    def render(self):
+        """
+        Render the metrics in the Prometheus text exposition format.
+        :return: the metrics as a string
+        """
+
+        lines = []
+        families = OrderedDict()
+
+        with self.lock:
+            # The samples for a metric must be grouped together in the output
+            for (name, labels), histogram in self.histograms.items():
+                families.setdefault(name, []).append((labels, histogram))
+
+            for name, family in families.items():
+                lines.append("# HELP {0} {1}".format(name, self.help[name]))
+                lines.append("# TYPE {0} histogram".format(name))
+
+                for labels, histogram in family:
+                    cumulative = 0
+
+                    for bound, count in zip(self.buckets_as_text(histogram.buckets), histogram.counts):
+                        cumulative += count
+                        lines.append("{0}_bucket{1} {2}".format(name, _format_labels(labels + (('le', bound),)), cumulative))
+
+                    lines.append("{0}_sum{1} {2}".format(name, _format_labels(labels), histogram.sum))
+                    lines.append("{0}_count{1} {2}".format(name, _format_labels(labels), histogram.count))
+
+            collectors = list(self.collectors.items())
+
+        # Collectors are called outside the lock as they may take locks of their own
+        for name, (collect, help, counters) in collectors:
+            try:
+                values = collect()
+            except Exception as e:
+                logging.warning('Metrics collector {0} failed: {1}'.format(name, e))
+                continue
+
+            for key, value in values.items():
+                lines.append("# HELP {0}_{1} {2}".format(name, key, help))
+                lines.append("# TYPE {0}_{1} {2}".format(name, key, 'counter' if key in counters else 'gauge'))
+                lines.append("{0}_{1} {2}".format(name, key, value))
+
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+        Get a summary of the calls since the last summary and reset the totals.
+        :return: the summary as a string, or None if there were no calls
+        """
+
+        with self.lock:
+            interval, self.interval = self.interval, {}
+
+        if len(interval) == 0:
+            return None
+
+        output = []
+
+        for capability, totals in sorted(interval.items()):
+            n = totals['calls']
+            stages = ", ".join("{0} {1:.3f}s".format(stage, totals[stage]/n) for stage in STAGES)
+            output.append("{0}: {1} calls, mean {2:.3f}s ({3}), {4} rows in, {5} rows out"\
+                          .format(capability, n, totals['seconds']/n, stages, totals['request_rows'], totals['response_rows']))
+
+        # Add the statistics from the collectors, e.g. for the response and model caches
+        with self.lock:
+            collectors = list(self.collectors.items())
+
+        for name, (collect, help, counters) in collectors:
+            try:
+                output.append("{0}: {1}".format(name, collect()))
+            except Exception:
+                pass
+
+        return "Metrics summary - " + "; ".join(output)
+
+    @staticmethod
+    def buckets_as_text(buckets):
+        """
+        :return: the bucket bounds as strings, including +Inf
+        """
+        return ["{0:g}".format(b) for b in buckets] + ["+Inf"]
+
+class CallMetrics:
+    """
+    The timings and counts recorded for a single function call.
+    """
+
+    def __init__(self, labels):
+        """
+        Class initializer.
+        :param labels: a dictionary of labels for the call, e.g. capability, app and user
+        """
+
+        self.labels = labels
+        self.start = time.perf_counter()
+        self.timings = {}
+        self.counts = dict.fromkeys(('request_rows', 'request_bytes', 'response_rows', 'response_bytes'), 0)
+        self.stage = None
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Serve the metrics in the Prometheus text format at /metrics.
+    """
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = registry.render().encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are not written to the log
+        pass
+
+class MetricsServer(socketserver.ThreadingMixIn, HTTPServer):
+    """
+    A HTTP server that handles each scrape in a separate thread.
+    """
+    daemon_threads = True
+
+# The registry for this process
+registry = MetricsRegistry()
+
+def start_call(labels):
+    """
+    Start recording metrics for a call executed by the current thread.
+    :param labels: a dictionary of labels for the call, e.g. capability, app and user
+    :return: the CallMetrics for the call
+    """
+
+    call = CallMetrics(labels)
+    _local.call = call
+    return call
+
+def end_call(call, record=True):
+    """
+    Finish recording metrics for a call and add them to the registry.
+    :param call: the CallMetrics returned by start_call
+    :param record: if False the metrics are not added to the registry, e.g. in a worker process where they are passed 
+    :              back with the response instead
+    """
+
+    if getattr(_local, 'call', None) is call:
+        _local.call = None
+
+    if record:
+        registry.record_call(call)
+
+def add_timings(timings):
+    """
+    Add stage timings recorded elsewhere, e.g. by a worker process, to the call being executed by the current thread.
+    :param timings: a dictionary of seconds for each stage, e.g. {'decode': 0.2, 'model_load': 1.5}
+    """
+
+    call = getattr(_local, 'call', None)
+
+    if call is not None:
+        for name, seconds in timings.items():
+            call.timings[name] = call.timings.get(name, 0) + seconds
+
+@contextmanager
+def stage(name):
+    """
+    Time a stage of the call being executed by the current thread, e.g. with metrics.stage('decode'): ...
+    Nested stages are counted once, against the outermost stage. If there is no call being recorded this does nothing.
+    """
+
+    call = getattr(_local, 'call', None)
+
+    if call is None or call.stage is not None:
+        yield
+        return
+
+    call.stage = name
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        call.timings[name] = call.timings.get(name, 0) + time.perf_counter() - start
+        call.stage = None
+
+def count(name, value):
+    """
+    Add to a count for the call being executed by the current thread, e.g. count('response_rows', 100)
+    """
+
+    call = getattr(_local, 'call', None)
+
+    if call is not None:
+        call.counts[name] = call.counts.get(name, 0) + value
+
+def serve(port, host='127.0.0.1'):
+    """
+    Serve the metrics over HTTP from a daemon thread.
+    :param port: the port for the HTTP server
+    :param host: the interface to listen on. By default only local connections are accepted.
+    :return: the server
+    """
+
+    server = MetricsServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
+
+def log_summary(interval):
+    """
+    Write a summary of the calls to the log every interval seconds from a daemon thread.
+    :param interval: the number of seconds between summaries
+    """
+
+    def run():
+        while True:
+            time.sleep(interval)
+            output = registry.summary()
+
+            if output is not None:
+                logging.info(output)
+
+    threading.Thread(target=run, name='metrics-summary', daemon=True).start()
+
+def _format_labels(labels):
+    """
+    Format labels as {key="value",...} escaping the values as required by the Prometheus text format.
+    """
+
+    if len(labels) == 0:
+        return ""
+
+    escaped = ('{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels)
+    return "{" + ",".join(escaped) + "}"
@@ -45,10 +45,7 @@ class ProphetForQlik:
         self.context = context
 
         # Create a Pandas Data Frame with column ds for the dates and column y for values
-        self.request_df = pd.DataFrame([(row.duals[0].numData, row.duals[1].numData) \
-                                        for request_rows in self.request \
-                                        for row in request_rows.rows], \
-                                       columns=['ds','y'])
+        self.request_df = utils.request_df(self.request, ['numData', 'numData'], ['ds','y'], context=self.context)
         
         # Handle null value rows in the request dataset
         self.NaT_df = self.request_df.loc[self.request_df.ds.isnull()].copy()
@@ -269,6 +266,9 @@ class ProphetForQlik:
                 self.model.add_regressor(regressor, **self.regressor_kwargs[i])
                 i+=1
 
+        # Stop if Qlik is no longer waiting for the result
+        utils.check_context(self.context, "Prophet.fit")
+
         self.model.fit(self.input_df, **self.fit_kwargs)
              
         # Create a data frame for future values
@@ -436,6 +436,10 @@ class ProphetForQlik:
             if 'debug' in self.kwargs:
                 self.debug = 'true' == self.kwargs['debug'].lower()
             
+            # Set the profile option for writing a cProfile dump and a summary of the call to the logs folder
+            # Valid values are: true, false. Use profile_memory=true to include memory allocations and profile_top=<n> for the summary length.
+            utils.start_profile('Prophet', self.kwargs)
+            
             # Set the frequency of the timeseries
             # Any valid frequency for pd.date_range, such as 'D' or 'M' 
             # For options see: http://pandas.pydata.org/pandas-docs/stable/timeseries.html#offset-aliases
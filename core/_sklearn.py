@@ -3,15 +3,13 @@ import gc
 import sys
 import ast
 import time
+import copy
+import logging
 import string
 import locale
-import pathlib
 import warnings
 import numpy as np
 import pandas as pd
-from tempfile import mkdtemp
-from shutil import rmtree
-from collections import OrderedDict
 from pandas.api.types import is_string_dtype
 from pandas.api.types import is_numeric_dtype
 
@@ -23,10 +21,10 @@ from sklearn import metrics
 from sklearn import preprocessing
 from sklearn.pipeline import Pipeline
 from sklearn.model_selection import train_test_split
-from sklearn.model_selection import cross_validate
-from sklearn.model_selection import cross_val_predict
 from sklearn.model_selection import GridSearchCV
+from sklearn.model_selection import RandomizedSearchCV
 from sklearn.model_selection import TimeSeriesSplit
+from sklearn.model_selection import check_cv
 
 from sklearn.decomposition import PCA, KernelPCA, IncrementalPCA, TruncatedSVD, FactorAnalysis, FastICA, NMF, SparsePCA,\
                                 DictionaryLearning, LatentDirichletAllocation, MiniBatchDictionaryLearning, MiniBatchSparsePCA
@@ -70,7 +68,9 @@ import tensorflow as tf
 tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
 
 import _utils as utils
-from _machine_learning import Preprocessor, PersistentModel, TargetTransformer, Reshaper, KerasClassifierForQlik, KerasRegressorForQlik
+import _jobs as jobs
+from _cache import ModelCache
+from _machine_learning import Preprocessor, PersistentModel, ModelRegistry, CancellableSplitter, ProgressCallback, cross_validate_predict, EarlyStoppingGridSearchCV, TargetTransformer, Reshaper, KerasClassifierForQlik, KerasRegressorForQlik
 import ServerSideExtension_pb2 as SSE
 
 # Add Generated folder to module path
@@ -86,11 +86,14 @@ class SKLearnForQlik:
     # Counter used to name log files for instances of the class
     log_no = 0
     
-    # Ordered Dictionary to cache recently used models at the class level
-    model_cache = OrderedDict()
-    
-    # Limit on the number of models to be cached
-    cache_limit = 3
+    # Cache for recently used models at the class level, limited by the size of the models in memory
+    # This is replaced by the server based on the model_cache_mb, model_cache_policy and pin_models options
+    model_cache = ModelCache()
+
+    # Defaults for settings added after models could first be saved, applied to older models when they are loaded
+    # Models set up before search strategies were introduced used an exhaustive grid search
+    model_defaults = {'search_strategy': 'grid', 'search_budget': None, 'search_patience': 10, 'search_n_jobs': 1,\
+                      'async_save': False, 'cv_n_jobs': 1, 'profile': False, 'profile_memory': False, 'profile_top': 30}
     
     def __init__(self, request, context, path="../models/"):
         """
@@ -183,17 +186,26 @@ class SKLearnForQlik:
         col_headers = ['search_pattern']
         
         # Create a Pandas Data Frame for the request data
-        self.request_df = utils.request_df(self.request, row_template, col_headers)
+        self.request_df = utils.request_df(self.request, row_template, col_headers, context=self.context)
         
         # Get the list of models based on the search pattern
         search_pattern = self.request_df.loc[0, 'search_pattern']
         
+        # The search can be a pattern, or key word arguments with a pattern and filters on the model attributes
+        # e.g. 'pattern=HR-*, estimator=*Forest*, estimator_type=classifier, min_score=0.8'
+        if '=' in search_pattern:
+            filters = utils.get_kwargs(search_pattern)
+            search_pattern = filters.pop('pattern', '*')
+        else:
+            filters = {}
+        
         # If the search pattern is empty default to all models
         if not search_pattern.strip():
             search_pattern = '*'
         
-        # Get the list of models as a string
-        models = "\n".join([str(p).split("\\")[-1] for p in list(pathlib.Path(self.path).glob(search_pattern))])
+        # Get the list of models from the registry as a string
+        entries = ModelRegistry.get(self.path).list(search_pattern.strip(), **filters)
+        models = "\n".join([entry['file'] for entry in entries])
         
         # Prepare the output
         self.response = pd.Series(models)
@@ -221,7 +233,7 @@ class SKLearnForQlik:
                            'execution_args']
         
         # Create a Pandas Data Frame for the request data
-        self.request_df = utils.request_df(self.request, row_template, col_headers)
+        self.request_df = utils.request_df(self.request, row_template, col_headers, context=self.context)
                
         # Create a model that can be persisted to disk
         self.model = PersistentModel()
@@ -282,7 +294,7 @@ class SKLearnForQlik:
         col_headers = ['model_name', 'estimator_args', 'grid_search_args']
         
         # Create a Pandas Data Frame for the request data
-        self.request_df = utils.request_df(self.request, row_template, col_headers)
+        self.request_df = utils.request_df(self.request, row_template, col_headers, context=self.context)
        
         # Initialize the persistent model
         self.model = PersistentModel()
@@ -373,7 +385,7 @@ class SKLearnForQlik:
         col_headers = ['model_name', 'sort_order', 'layer_type', 'args', 'kwargs']
                 
         # Create a Pandas Data Frame for the request data
-        self.request_df = utils.request_df(self.request, row_template, col_headers)
+        self.request_df = utils.request_df(self.request, row_template, col_headers, context=self.context)
                
         # Create a model that can be persisted to disk
         self.model = PersistentModel()
@@ -439,7 +451,7 @@ class SKLearnForQlik:
         col_headers = ['model_name', 'name', 'variable_type', 'data_type', 'feature_strategy', 'strategy_args']
         
         # Create a Pandas Data Frame for the request data
-        self.request_df = utils.request_df(self.request, row_template, col_headers)
+        self.request_df = utils.request_df(self.request, row_template, col_headers, context=self.context)
        
         # Initialize the persistent model
         self.model = PersistentModel()
@@ -491,11 +503,11 @@ class SKLearnForQlik:
         Get feature definitions for an existing model
         """
         
-        # Get the model from cache or disk based on the model_name in request
-        self._get_model_by_name()
+        # Get the model information from cache or the metadata sidecar based on the model_name in request
+        self._get_model_by_name(metadata=True)
         
-        # Prepare the output
-        self.response = self.model.features_df
+        # Prepare the output. A copy is used as the model may be shared through the cache.
+        self.response = self.model.features_df.copy()
         self.response["sort_order"] = pd.Series([i+1 for i in range(len(self.response.index))], index=self.response.index)
         self.response = self.response[["model_name", "sort_order", "name", "variable_type", "data_type",\
                                        "feature_strategy", "strategy_args"]]
@@ -515,6 +527,9 @@ class SKLearnForQlik:
         Train and test the model based on the provided dataset
         """
         
+        # Progress is reported when the model is trained as a background job with the fit_async method
+        utils.report_progress(self.context, "preparing data")
+
         # Open an existing model and get the training & test dataset and targets
         train_test_df, target_df = self._get_model_and_data(target=True, set_feature_def=True)
         
@@ -554,7 +569,11 @@ class SKLearnForQlik:
             self.X_train = train_test_df
             self.y_train = target_df
         
+        # Drop any data retained by a previous fit of the model
+        self.model.data_file = None
+
         # Add the training and test data to the model if required
+        # The data is written to a separate file when the model is saved and is loaded from there when accessed
         if self.model.retain_data:
             self.model.X_train = self.X_train
             self.model.y_train = self.y_train
@@ -615,6 +634,10 @@ class SKLearnForQlik:
             self.model.estimator_kwargs['architecture'] = self.model.architecture
             self.model.estimator_kwargs['prediction_periods'] = self.model.prediction_periods
 
+            # Report the epochs completed when the model is trained as a background job
+            if hasattr(self.context, 'report_progress'):
+                self.model.estimator_kwargs['callbacks'] = [ProgressCallback(self.context)]
+
             # Debug information is printed to the terminal and logs if the paramater debug = true
             if self.model.debug:
                 self._print_log(10)
@@ -648,19 +671,24 @@ class SKLearnForQlik:
             # Construct an estimator
             estimator = self.algorithms[self.model.estimator](**self.model.estimator_kwargs)
 
-            # Prepare the grid search using the previously set parameter grid
-            grid_search = GridSearchCV(estimator=estimator, param_grid=self.model.param_grid, **self.model.grid_search_args)
+            # Prepare the hyperparameter search using the previously set parameter grid and the search_strategy argument
+            grid_search = self._get_search(estimator)
             
             # Add grid search to the pipeline steps
             pipe_steps.append(('grid_search', grid_search))
 
             # Construct the sklearn pipeline using the list of steps
-            self.model.pipe = Pipeline(pipe_steps)
+            # With cache_preprocessing=true the fitted preprocessing steps are cached and reused for the same data
+            self.model.pipe = Pipeline(pipe_steps, memory=self._get_memory())
 
             if self.model.validation in ["k-fold", "timeseries"]:
                 # Perform K-fold cross validation
                 self._cross_validate()
 
+            # Stop here if the call was cancelled during cross validation
+            utils.check_context(self.context, "pipeline fit")
+            utils.report_progress(self.context, "fitting")
+
             # Fit the training data to the pipeline
             if self.model.using_keras:
                 # https://stackoverflow.com/questions/54652536/keras-tensorflow-backend-error-tensor-input-10-specified-in-either-feed-de
@@ -679,6 +707,18 @@ class SKLearnForQlik:
             self.model.best_params = grid_search.best_params_
             self.model.cv_results = grid_search.cv_results_
 
+            # Record the number of candidates evaluated and the average time spent fitting and scoring each one across the folds
+            times = (grid_search.cv_results_['mean_fit_time'] + grid_search.cv_results_['mean_score_time']) * grid_search.n_splits_
+
+            if hasattr(grid_search, 'n_candidates_'):
+                # With successive halving the results have a row for each candidate in each iteration, so the time for 
+                # a candidate is the total across the iterations it was evaluated in
+                self.model.search_candidates = int(grid_search.n_candidates_[0])
+                self.model.search_time_per_candidate = float(np.sum(times) / self.model.search_candidates)
+            else:
+                self.model.search_candidates = len(grid_search.cv_results_['params'])
+                self.model.search_time_per_candidate = float(np.mean(times))
+
             # Get the best estimator to add to the final pipeline
             estimator = grid_search.best_estimator_
 
@@ -693,12 +733,17 @@ class SKLearnForQlik:
             pipe_steps.append(('estimator', estimator))
 
             # Construct the sklearn pipeline using the list of steps
-            self.model.pipe = Pipeline(pipe_steps)
+            # With cache_preprocessing=true the fitted preprocessing steps are cached and reused for the same data
+            self.model.pipe = Pipeline(pipe_steps, memory=self._get_memory())
 
             if self.model.validation in ["k-fold", "timeseries"]:
                 # Perform K-fold cross validation
                 self._cross_validate()
 
+            # Stop here if the call was cancelled during cross validation
+            utils.check_context(self.context, "pipeline fit")
+            utils.report_progress(self.context, "fitting")
+
             # Fit the training data to the pipeline
             if self.model.using_keras:
                 # https://stackoverflow.com/questions/54652536/keras-tensorflow-backend-error-tensor-input-10-specified-in-either-feed-de
@@ -712,6 +757,14 @@ class SKLearnForQlik:
             else:
                 self.model.pipe.fit(self.X_train, self.y_train.values.ravel())
         
+        # The cache is only used while fitting, so it is not kept with the model
+        self._release_memory()
+
+        # The progress callback is only used for this fit
+        self.model.estimator_kwargs.pop('callbacks', None)
+
+        utils.report_progress(self.context, "evaluating")
+
         if self.model.validation == "hold-out":       
             # Evaluate the model using the test data            
             self.calculate_metrics(caller="internal")
@@ -728,20 +781,35 @@ class SKLearnForQlik:
             # Calculate model agnostic feature importances
             self._calc_importances(X = X, y = y)
 
+        utils.report_progress(self.context, "saving")
+
         # Persist the model to disk
-        self.model = self.model.save(self.model.name, self.path, overwrite=self.model.overwrite, compress=self.model.compress)
+        # With async_save=true the model is saved by a background thread and the response is returned once it is in the cache
+        # Keras models are always saved synchronously as the saved model is reloaded into the pipeline
+        # Background jobs also save synchronously, so that a completed job means the model is on disk
+        if self.model.async_save and not self.model.using_keras and not isinstance(self.context, jobs.JobContext):
+            self.model = self.model.save_async(self.model.name, self.path, overwrite=self.model.overwrite, compress=self.model.compress)
+            saved = 'queued for saving to disk'
+        else:
+            self.model = self.model.save(self.model.name, self.path, overwrite=self.model.overwrite, compress=self.model.compress)
+            saved = 'saved to disk'
                 
         # Update the cache to keep this model in memory
         self._update_cache()
+
+        if self.model.state == 'saving':
+            # Once the background save completes, record the new model file so that the cached model is not seen as stale
+            f = self.path + self.model.name + '.joblib'
+            utils.background_writer.submit(f, self.__class__.model_cache.refresh, self.model.name, self.model)
         
         # Prepare the output
         if self.model.validation != "external": 
-            message = [[self.model.name, 'Model successfully trained, tested and saved to disk.',\
+            message = [[self.model.name, 'Model successfully trained, tested and {0}.'.format(saved),\
                         time.strftime('%X %x %Z', time.localtime(self.model.state_timestamp)),\
                         "{0} model has a score of {1:.3f} against the test data."\
                         .format(self.model.estimator, self.model.score), self.model.score]]
         else:
-            message = [[self.model.name, 'Model successfully trained and saved to disk.',\
+            message = [[self.model.name, 'Model successfully trained and {0}.'.format(saved),\
                         time.strftime('%X %x %Z', time.localtime(self.model.state_timestamp)),\
                         "{0} model score unknown as test_size was <= 0."\
                         .format(self.model.estimator), np.NaN]]
@@ -758,8 +826,275 @@ class SKLearnForQlik:
         # Finally send the response
         return self.response
         
-    # TO DO : Allow for larger datasets by using partial fitting methods avaialble with some sklearn algorithmns
-    # def partial_fit(self):
+    def fit_async(self):
+        """
+        Submit a job to train and test the model in the background and return the job id without waiting for the training.
+        This avoids the SSE timeout in Qlik for models that take a long time to train.
+        The job trains the model as the fit method does, and the model is saved to disk when the job completes.
+        The progress and result of the job can be retrieved with the get_job_status method.
+        """
+
+        # Initialize the persistent model
+        self.model = PersistentModel()
+        
+        # Get the model name from the first row of the request
+        self.model.name = self.request[0].rows[0].duals[0].strData
+
+        # Check that the model exists before submitting the job. Only the model information is needed for this.
+        self._get_model(metadata=True)
+
+        request = self.request
+        path = self.path
+        cls = self.__class__
+
+        def run(context):
+            # Train the model with a new instance of this class, using the job context in place of the gRPC context
+            response = cls(request, context, path=path).fit()
+            return "{0} {1}".format(response.loc[0, 'result'], response.loc[0, 'score_result']), float(response.loc[0, 'score'])
+        
+        # Submit the job to the pool of background workers
+        job = jobs.registry.submit(self.model.name, 'fit', run, metadata=self.context.invocation_metadata(), peer=self.context.peer())
+
+        self.response = pd.DataFrame([[self.model.name, job.job_id, job.state, time.strftime('%X %x %Z', time.localtime(job.submitted))]],\
+                                     columns=['model_name', 'job_id', 'state', 'time_stamp'])
+        
+        # Send the reponse table description to Qlik
+        self._send_table_description("fit_async")
+        
+        # Debug information is printed to the terminal and logs if the paramater debug = true
+        if self.model.debug:
+            self._print_log(4)
+        
+        # Finally send the response
+        return self.response
+    
+    def get_job_status(self):
+        """
+        Get the status of jobs submitted with the fit_async method.
+        For each job id in the request this returns the state, the current stage, e.g. cross validation or epochs, 
+        the steps completed in that stage, an estimate of the seconds remaining in the stage and the final result.
+        """
+
+        # Interpret the request data based on the expected row and column structure
+        row_template = ['strData']
+        col_headers = ['job_id']
+        
+        # Create a Pandas Data Frame for the request data
+        self.request_df = utils.request_df(self.request, row_template, col_headers, context=self.context)
+
+        fmt = lambda t: time.strftime('%X %x %Z', time.localtime(t)) if t is not None else ''
+        num = lambda n: np.nan if n is None else n
+        rows = []
+
+        for job_id in self.request_df['job_id'].str.strip().unique():
+            try:
+                job = jobs.registry.get(job_id)
+            except Exception as e:
+                # Unknown jobs are reported in the response so that polling from the load script doesn't fail
+                rows.append([job_id, '', 'unknown', '', np.nan, np.nan, np.nan, np.nan, np.nan, str(e), '', ''])
+                continue
+
+            rows.append([job.job_id, job.model_name, job.state, job.stage or '', num(job.step), num(job.total), num(job.progress()),\
+                         num(job.eta()), num(job.score), job.result or '', fmt(job.submitted), fmt(job.finished)])
+        
+        self.response = pd.DataFrame(rows, columns=['job_id', 'model_name', 'state', 'stage', 'step', 'total', 'progress',\
+                                                    'eta_seconds', 'score', 'result', 'submitted', 'finished'])
+        
+        # Send the reponse table description to Qlik
+        self._send_table_description("job_status")
+        
+        # Finally send the response
+        return self.response
+
+    def partial_fit(self):
+        """
+        Train the model incrementally, updating it with each batch of samples as the request is streamed from Qlik.
+        This can be used with estimators that implement partial_fit, e.g. SGDClassifier, SGDRegressor, PassiveAggressiveClassifier, 
+        MultinomialNB, MiniBatchKMeans and IncrementalPCA, to train on datasets that are larger than the available memory.
+        Only the current batch of samples is held in memory. Subsequent calls continue to update the saved model.
+        The preprocessor is fit to the first batch when the model is first trained, so this batch should be representative of the data.
+        """
+
+        # The request is read bundle by bundle rather than as a list, so that only the current batch is held in memory
+        bundles = iter(self.request)
+
+        try:
+            first = next(bundles)
+        except StopIteration:
+            err = "Incorrect usage. The request did not include any samples for the model."
+            raise Exception(err)
+        
+        # Initialize the persistent model
+        self.model = PersistentModel()
+        
+        # Get the model name from the first row of the request
+        self.model.name = first.rows[0].duals[0].strData
+        
+        # Get the model from cache or disk
+        self._get_model()
+
+        # Train a copy of the model, so that the cached model is only replaced once the updated model has been saved
+        # If the stream fails or is cancelled part way, predictions continue to use the model as it is on disk
+        self.model = copy.copy(self.model)
+        
+        # Debug information is printed to the terminal and logs if the paramater debug = true
+        if self.model.debug:
+            self._print_log(3)
+        
+        # Check that the model can be trained incrementally
+        if self.model.estimator_type not in ["classifier", "regressor", "decomposer", "clusterer"]:
+            err = "Incorrect usage. The estimator specified is not a known classifier, regressor, decomposer or clusterer: {0}".format(self.model.estimator)
+            raise Exception(err)
+        
+        if self.model.using_keras:
+            err = "Incorrect usage. Keras models cannot be trained with partial_fit. Use the fit function instead."
+            raise Exception(err)
+        
+        if self.model.lags or self.model.lag_target or self.model.scale_target or self.model.make_stationary:
+            err = "Incorrect usage. The lags, lag_target, scale_target and make_stationary arguments are not supported with partial_fit."
+            raise Exception(err)
+        
+        if not hasattr(self.algorithms[self.model.estimator], 'partial_fit'):
+            err = "Incorrect usage. The estimator {0} does not support partial_fit. Use an estimator such as SGDClassifier, SGDRegressor, "\
+                  "PassiveAggressiveClassifier, MultinomialNB, MiniBatchKMeans or IncrementalPCA.".format(self.model.estimator)
+            raise Exception(err)
+        
+        if self.model.dim_reduction and not hasattr(self.decomposers[self.model.reduction], 'partial_fit'):
+            err = "Incorrect usage. The dimensionality reduction class {0} does not support partial_fit. Use IncrementalPCA instead."\
+                  .format(self.model.reduction)
+            raise Exception(err)
+
+        supervised = self.model.estimator_type in ["classifier", "regressor"]
+
+        # Continue training the existing pipeline if the model has already been fit with an estimator that supports partial_fit
+        pipe = getattr(self.model, 'pipe', None)
+        new_model = pipe is None or not hasattr(pipe.named_steps.get('estimator'), 'partial_fit')
+
+        if not new_model:
+            # The fitted steps are updated in place, so they are copied from the cached model
+            pipe = copy.deepcopy(pipe)
+            prep = pipe.named_steps['preprocessor']
+            reduction = pipe.named_steps.get('reduction')
+            estimator = pipe.named_steps['estimator']
+
+            # Models previously trained with the fit method start counting samples here
+            self.model.partial_fit_samples = getattr(self.model, 'partial_fit_samples', 0)
+        else:
+            # Store the feature definitions except exclusions, as done by the fit method
+            exclusions = self.model.original_features_df['variable_type'].isin(["excluded", "target", "identifier"])
+            self.model.features_df = self.model.original_features_df.loc[~exclusions]
+
+            # Construct the preprocessor, which will be fit to the first batch
+            prep = Preprocessor(self.model.features_df, return_type='np', scale_hashed=self.model.scale_hashed, scale_vectors=self.model.scale_vectors,\
+            missing=self.model.missing, scaler=self.model.scaler, logfile=self.logfile, **self.model.scaler_kwargs)
+
+            # Construct the dimensionality reduction object if required
+            reduction = self.decomposers[self.model.reduction](**self.model.dim_reduction_args) if self.model.dim_reduction else None
+
+            # Construct an estimator
+            estimator = self.algorithms[self.model.estimator](**self.model.estimator_kwargs)
+
+            self.model.partial_fit_samples = 0
+        
+        # Scores for each batch, calculated before the batch is used for training, and the number of samples in the batch
+        scores = []
+
+        # Settings for models set up before partial_fit was available fall back to the defaults
+        batch_size = getattr(self.model, 'partial_fit_batch', 10000)
+        classes = getattr(self.model, 'partial_fit_classes', None)
+
+        for batch in self._get_batches(first, bundles, batch_size):
+            # Stop here if the call was cancelled while the request was being streamed
+            utils.check_context(self.context, "partial fit")
+
+            X, y = self._get_batch_data(batch, target=supervised)
+
+            # The preprocessor is fit to the first batch for a new model
+            if new_model:
+                prep.fit(X)
+            
+            X_transform = prep.transform(X)
+
+            if reduction is not None:
+                reduction.partial_fit(X_transform)
+                X_transform = reduction.transform(X_transform)
+            
+            if supervised:
+                y = y.values.ravel()
+
+                if not new_model:
+                    # Score the model on each batch before training on it to get a progressive validation score
+                    scores.append((estimator.score(X_transform, y), len(y)))
+                    estimator.partial_fit(X_transform, y)
+                elif self.model.estimator_type == "classifier":
+                    # Classifiers need all the class labels with the first batch. By default the labels in the first batch are used.
+                    labels = np.unique(y) if classes is None else pd.Series(classes).astype(y.dtype).values
+                    estimator.partial_fit(X_transform, y, classes=labels)
+                else:
+                    estimator.partial_fit(X_transform, y)
+            else:
+                estimator.partial_fit(X_transform)
+            
+            self.model.partial_fit_samples += len(X)
+            new_model = False
+        
+        # Construct the sklearn pipeline for the updated model
+        pipe_steps = [('preprocessor', prep)]
+
+        if reduction is not None:
+            pipe_steps.append(('reduction', reduction))
+        
+        pipe_steps.append(('estimator', estimator))
+
+        self.model.pipe = Pipeline(pipe_steps)
+        self.model.estimation_step = len(pipe_steps) - 1
+        self.model.validation = "progressive"
+
+        # The score is the average of the batch scores, weighted by the number of samples in each batch
+        if len(scores) > 0:
+            self.model.score = np.average([s[0] for s in scores], weights=[s[1] for s in scores])
+        else:
+            self.model.score = np.NaN
+
+        # Persist the model to disk
+        if self.model.async_save:
+            self.model = self.model.save_async(self.model.name, self.path, overwrite=True, compress=self.model.compress)
+            saved = 'queued for saving to disk'
+        else:
+            self.model = self.model.save(self.model.name, self.path, overwrite=True, compress=self.model.compress)
+            saved = 'saved to disk'
+        
+        # Update the cache to keep this model in memory
+        self._update_cache()
+
+        if self.model.state == 'saving':
+            # Once the background save completes, record the new model file so that the cached model is not seen as stale
+            f = self.path + self.model.name + '.joblib'
+            utils.background_writer.submit(f, self.__class__.model_cache.refresh, self.model.name, self.model)
+        
+        # Prepare the output
+        if len(scores) > 0:
+            score_result = "{0} model has a progressive validation score of {1:.3f}, with each batch scored before training on it."\
+                           .format(self.model.estimator, self.model.score)
+        elif supervised:
+            score_result = "{0} model score unknown as the model has only been trained on one batch.".format(self.model.estimator)
+        else:
+            score_result = "{0} model score is not calculated for decomposers and clusterers.".format(self.model.estimator)
+
+        message = [[self.model.name, 'Model successfully updated and {0}. {1} samples used for training.'.format(saved, self.model.partial_fit_samples),\
+                    time.strftime('%X %x %Z', time.localtime(self.model.state_timestamp)), score_result, self.model.score]]
+        
+        self.response = pd.DataFrame(message, columns=['model_name', 'result', 'time_stamp', 'score_result', 'score'])
+        
+        # Send the reponse table description to Qlik
+        self._send_table_description("fit")
+        
+        # Debug information is printed to the terminal and logs if the paramater debug = true
+        if self.model.debug:
+            self._print_log(4)
+        
+        # Finally send the response
+        return self.response
         
     def fit_transform(self, load_script=False):
         """
@@ -781,7 +1116,7 @@ class SKLearnForQlik:
             feature_col_num = 2
         
         # Create a Pandas Data Frame for the request data
-        self.request_df = utils.request_df(self.request, row_template, col_headers)
+        self.request_df = utils.request_df(self.request, row_template, col_headers, context=self.context)
                
         # Initialize the persistent model
         self.model = PersistentModel()
@@ -816,12 +1151,10 @@ class SKLearnForQlik:
         prep = Preprocessor(self.model.features_df, scale_hashed=self.model.scale_hashed, scale_vectors=self.model.scale_vectors,\
         missing=self.model.missing, scaler=self.model.scaler, logfile=self.logfile, **self.model.scaler_kwargs)
         
-        # Create a chache for the pipeline's transformers
-        # https://scikit-learn.org/stable/modules/compose.html#caching-transformers-avoid-repeated-computation
-        # cachedir = mkdtemp()
-
         # Construct a sklearn pipeline
-        self.model.pipe = Pipeline([('preprocessor', prep)]) #, memory=cachedir)
+        # With cache_preprocessing=true the fitted transformers are cached and reused for the same data
+        # https://scikit-learn.org/stable/modules/compose.html#caching-transformers-avoid-repeated-computation
+        self.model.pipe = Pipeline([('preprocessor', prep)], memory=self._get_memory())
 
         if self.model.dim_reduction:
             # Construct the dimensionality reduction object
@@ -854,8 +1187,8 @@ class SKLearnForQlik:
             # Prepare the response
             self.response = pd.DataFrame(self.y, columns=["result"], index=self.X.index)
                 
-        # Clear the cache directory setup for the pipeline's transformers
-        # rmtree(cachedir)
+        # The cache is only used while fitting, so it is not kept with the model
+        self._release_memory()
         
         # Update the cache to keep this model in memory
         self._update_cache()
@@ -1024,8 +1357,8 @@ class SKLearnForQlik:
         Returns a confusion matrix calculated previously using testing data with fit or calculate_metrics
         """
         
-        # Get the model from cache or disk based on the model_name in request
-        self._get_model_by_name()
+        # Get the model information from cache or the metadata sidecar based on the model_name in request
+        self._get_model_by_name(metadata=True)
         
         try:
             # Prepare the output
@@ -1069,7 +1402,7 @@ class SKLearnForQlik:
             feature_col_num = 2
         
         # Create a Pandas Data Frame for the request data
-        self.request_df = utils.request_df(self.request, row_template, col_headers)
+        self.request_df = utils.request_df(self.request, row_template, col_headers, context=self.context)
                
         # Initialize the persistent model
         self.model = PersistentModel()
@@ -1379,8 +1712,8 @@ class SKLearnForQlik:
         Explain feature importances for the requested model
         """
 
-        # Get the model from cache or disk based on the model_name in request
-        self._get_model_by_name()
+        # Get the model information from cache or the metadata sidecar based on the model_name in request
+        self._get_model_by_name(metadata=True)
 
         # Get the feature importances calculated in the calculate_metrics method
         try:
@@ -1409,8 +1742,8 @@ class SKLearnForQlik:
         Get a string that can be evaluated in Qlik to get the features portion of the predict function
         """
         
-        # Get the model from cache or disk based on the model_name in request
-        self._get_model_by_name()
+        # Get the model information from cache or the metadata sidecar based on the model_name in request
+        self._get_model_by_name(metadata=True)
         
         # Prepare the expression as a string
         delimiter = " &'|'& "
@@ -1451,12 +1784,21 @@ class SKLearnForQlik:
         Get the best parameters for the model based on the grid search cross validation 
         """
         
-        # Get the model from cache or disk based on the model_name in request
-        self._get_model_by_name()
+        # Get the model information from cache or the metadata sidecar based on the model_name in request
+        self._get_model_by_name(metadata=True)
         
         try:
             # Prepare the response
-            self.response = pd.DataFrame([[self.model.name, utils.dict_to_sse_arg(self.model.best_params)]])
+            # The best parameters are already in the SSE argument syntax if read from the metadata sidecar
+            best_params = self.model.best_params if isinstance(self.model.best_params, str) else utils.dict_to_sse_arg(self.model.best_params)
+            
+            # Models trained before search strategies were introduced used an exhaustive grid search
+            strategy = getattr(self.model, 'search_strategy', 'grid')
+            candidates = getattr(self.model, 'search_candidates', np.NaN)
+            time_per_candidate = getattr(self.model, 'search_time_per_candidate', np.NaN)
+
+            self.response = pd.DataFrame([[self.model.name, best_params, strategy, candidates, time_per_candidate]],\
+                                         columns=['model_name', 'best_params', 'strategy', 'candidates', 'time_per_candidate'])
         except AttributeError:
             err = "Best parameters are not available as a parameter grid was not provided for cross validation."
             raise Exception(err)
@@ -1476,8 +1818,8 @@ class SKLearnForQlik:
         Return metrics previously calculated during fit
         """
         
-        # Get the model from cache or disk based on the model_name in request
-        self._get_model_by_name()
+        # Get the model information from cache or the metadata sidecar based on the model_name in request
+        self._get_model_by_name(metadata=True)
         
         # Prepare the response data frame
         self.response = self.model.metrics_df
@@ -1540,7 +1882,8 @@ class SKLearnForQlik:
         :http://scikit-learn.org/stable/modules/classes.html#api-reference
         :
         :Additional parameters used by this SSE are: 
-        :overwrite, test_size, randon_state, compress, retain_data, debug
+        :overwrite, test_size, randon_state, compress, storage, retain_data, async_save, cache_preprocessing,
+        :partial_fit_batch, partial_fit_classes, debug
         :For details refer to the GitHub project: https://github.com/nabeel-oz/qlik-py-tools
         """
         
@@ -1549,13 +1892,26 @@ class SKLearnForQlik:
         # Default parameters:
         self.model.overwrite = True
         self.model.debug = False
+        self.model.profile = False
+        self.model.profile_memory = False
+        self.model.profile_top = 30
         self.model.test_size = 0.33
         self.model.cv = 0
+        self.model.cv_n_jobs = 1
+        self.model.search_strategy = "grid"
+        self.model.search_budget = None
+        self.model.search_patience = 10
+        self.model.search_n_jobs = 1
         self.model.time_series_split = 0
         self.model.max_train_size = None
         self.model.random_state = 42
         self.model.compress = 3
+        self.model.storage = "compressed"
         self.model.retain_data = False
+        self.model.async_save = False
+        self.model.cache_preprocessing = False
+        self.model.partial_fit_batch = 10000
+        self.model.partial_fit_classes = None
         self.model.scale_hashed = True
         self.model.scale_vectors = True
         self.model.scaler = "StandardScaler"
@@ -1598,6 +1954,44 @@ class SKLearnForQlik:
             if 'cv' in execution_args:
                 self.model.cv = utils.atoi(execution_args['cv'])
             
+            # Number of folds fitted in parallel during cross validation. Use -1 for all processors.
+            # This is ignored for Keras models, whose folds are always fitted one at a time.
+            if 'cv_n_jobs' in execution_args:
+                self.model.cv_n_jobs = utils.atoi(execution_args['cv_n_jobs'])
+            
+            # Strategy for the hyperparameter search when a parameter grid is set with set_param_grid
+            # Valid values are: grid, random, halving, early_stopping
+            if 'search_strategy' in execution_args:
+                self.model.search_strategy = execution_args['search_strategy'].lower()
+
+                if self.model.search_strategy not in ("grid", "random", "halving", "early_stopping"):
+                    err = "Invalid search_strategy argument: {0}. Valid values are: grid, random, halving, early_stopping"\
+                          .format(self.model.search_strategy)
+                    raise Exception(err)
+            
+            # Maximum number of candidates evaluated by the random, halving and early_stopping strategies
+            if 'search_budget' in execution_args:
+                self.model.search_budget = utils.atoi(execution_args['search_budget'])
+            
+            # Number of candidates without an improvement in the score after which the early_stopping strategy stops
+            if 'search_patience' in execution_args:
+                self.model.search_patience = utils.atoi(execution_args['search_patience'])
+            
+            # Number of processes used by the hyperparameter search. Use -1 for all processors.
+            if 'search_n_jobs' in execution_args:
+                self.model.search_n_jobs = utils.atoi(execution_args['search_n_jobs'])
+            
+            # Arguments that don't apply to the chosen strategy are rejected rather than silently ignored
+            if 'search_budget' in execution_args and self.model.search_strategy == "grid":
+                err = "The search_budget argument does not apply to the grid search strategy, which evaluates every candidate. "\
+                      "Use search_strategy=random, halving or early_stopping to limit the number of candidates."
+                raise Exception(err)
+            
+            if 'search_patience' in execution_args and self.model.search_strategy != "early_stopping":
+                err = "The search_patience argument only applies to the early_stopping search strategy, not {0}."\
+                      .format(self.model.search_strategy)
+                raise Exception(err)
+
             # Enable timeseries backtesting using TimeSeriesSplit. https://scikit-learn.org/stable/modules/generated/sklearn.model_selection.TimeSeriesSplit.html
             # This will select the a validation strategy appropriate for time series and sequential data.
             # The feature definitions must include an 'identifier' field which can be used to sort the series into the correct order.
@@ -1652,15 +2046,56 @@ class SKLearnForQlik:
             # Compression level between 1-9 used by joblib when saving the model
             if 'compress' in execution_args:
                 self.model.compress = utils.atoi(execution_args['compress'])
+            
+            # Storage format for the model. Valid values are: compressed, mmap
+            # With mmap the model is saved uncompressed so that its arrays can be memory mapped when loaded
+            if 'storage' in execution_args:
+                self.model.storage = execution_args['storage'].lower()
+
+                if self.model.storage == "mmap":
+                    self.model.compress = 0
+                elif self.model.storage != "compressed":
+                    err = "Invalid storage argument: {0}. Valid values are: compressed, mmap".format(self.model.storage)
+                    raise Exception(err)
                 
             # Flag to determine if the training and test data should be saved in the model
             if 'retain_data' in execution_args:
                 self.model.retain_data = 'true' == execution_args['retain_data'].lower()
 
+            # Flag to return the fit response once the model is in the cache and save it to disk in the background
+            if 'async_save' in execution_args:
+                self.model.async_save = 'true' == execution_args['async_save'].lower()
+
+            # Minimum number of samples used for each update of the model by the partial_fit function
+            if 'partial_fit_batch' in execution_args:
+                self.model.partial_fit_batch = utils.atoi(execution_args['partial_fit_batch'])
+            
+            # Class labels for classifiers trained with partial_fit, separated by semicolons, e.g. Yes;No
+            # If not provided, the first batch of samples must include all the class labels
+            if 'partial_fit_classes' in execution_args:
+                self.model.partial_fit_classes = execution_args['partial_fit_classes'].split(';')
+
+            # Flag to cache the fitted preprocessing steps so that they are reused when fitting to the same data again
+            if 'cache_preprocessing' in execution_args:
+                self.model.cache_preprocessing = 'true' == execution_args['cache_preprocessing'].lower()
+
             # Flag to determine if feature importances should be calculated when the fit method is called
             if 'calculate_importances' in execution_args:
                 self.model.calc_feature_importances = 'true' == execution_args['calculate_importances'].lower()
                        
+            # Set the profile option for writing a cProfile dump and a summary of each call for the model to the logs folder
+            # Valid values are: true, false. Use profile_memory=true to include memory allocations and profile_top=<n> for the summary length.
+            if 'profile' in execution_args:
+                self.model.profile = 'true' == execution_args['profile'].lower()
+            
+            if 'profile_memory' in execution_args:
+                self.model.profile_memory = 'true' == execution_args['profile_memory'].lower()
+            
+            if 'profile_top' in execution_args:
+                self.model.profile_top = utils.atoi(execution_args['profile_top'])
+            
+            self._start_profile()
+
             # Set the debug option for generating execution logs
             # Valid values are: true, false
             if 'debug' in execution_args:
@@ -1676,10 +2111,14 @@ class SKLearnForQlik:
                     self.logfile = os.path.join(os.getcwd(), 'logs', 'SKLearn Log {}.txt'.format(self.log_no))
                     
                     # Create dictionary of parameters to display for debug
-                    self.exec_params = {"overwrite":self.model.overwrite, "test_size":self.model.test_size, "cv":self.model.cv,\
+                    self.exec_params = {"overwrite":self.model.overwrite, "test_size":self.model.test_size, "cv":self.model.cv, "cv_n_jobs":self.model.cv_n_jobs,\
+                    "search_strategy":self.model.search_strategy, "search_budget":self.model.search_budget,\
+                    "search_patience":self.model.search_patience, "search_n_jobs":self.model.search_n_jobs,\
                     "time_series_split": self.model.time_series_split, "max_train_size":self.model.max_train_size, "lags":self.model.lags,\
                     "lag_target":self.model.lag_target, "scale_target":self.model.scale_target, "make_stationary":self.model.make_stationary,\
-                    "random_state":self.model.random_state, "compress":self.model.compress, "retain_data":self.model.retain_data,\
+                    "random_state":self.model.random_state, "compress":self.model.compress, "storage":self.model.storage, "retain_data":self.model.retain_data,\
+                    "async_save":self.model.async_save, "cache_preprocessing":self.model.cache_preprocessing,\
+                    "partial_fit_batch":self.model.partial_fit_batch, "partial_fit_classes":self.model.partial_fit_classes,\
                     "calculate_importances": self.model.calc_feature_importances, "debug":self.model.debug}
 
                     self._print_log(1)
@@ -1772,6 +2211,71 @@ class SKLearnForQlik:
         if self.model.debug:
             self._print_log(2)
     
+    def _get_memory(self):
+        """
+        Get the memory argument for the sklearn pipeline.
+        With cache_preprocessing=true the fitted transformers are cached in the directory managed by utils.transformer_cache.
+        Keras pipelines are not cached as the reshaping of the data depends on the Keras model.
+        """
+
+        if getattr(self.model, 'cache_preprocessing', False) and not self.model.using_keras:
+            return utils.transformer_cache.get_location()
+        
+        return None
+    
+    def _release_memory(self):
+        """
+        Remove the memory from the fitted pipeline so that the cache directory is not saved with the model,
+        and keep the cache within its size limit.
+        """
+
+        if self.model.pipe.memory is not None:
+            self.model.pipe.memory = None
+            utils.transformer_cache.reduce_size()
+
+    def _get_search(self, estimator):
+        """
+        Set up the hyperparameter search for the estimator based on the search_strategy execution argument.
+        The search uses process level parallelism based on search_n_jobs, unless n_jobs is given in the grid search arguments.
+        joblib passes large arrays to the worker processes through shared memory.
+        """
+
+        search_args = dict(self.model.grid_search_args)
+        search_args.setdefault('n_jobs', self.model.search_n_jobs)
+
+        # Keras models can't be sent to other processes
+        if self.model.using_keras:
+            search_args['n_jobs'] = 1
+
+        budget = self.model.search_budget
+
+        if self.model.search_strategy == "grid":
+            return GridSearchCV(estimator=estimator, param_grid=self.model.param_grid, **search_args)
+        
+        search_args.setdefault('random_state', self.model.random_state)
+
+        if self.model.search_strategy == "random":
+            # Sample a number of candidates from the grid. Lists of values in the grid are sampled uniformly.
+            return RandomizedSearchCV(estimator=estimator, param_distributions=self.model.param_grid, n_iter=budget or 10,\
+                                      **search_args)
+        elif self.model.search_strategy == "halving":
+            # Successive halving evaluates all candidates on a small sample and keeps the best for larger samples
+            try:
+                from sklearn.experimental import enable_halving_search_cv
+                from sklearn.model_selection import HalvingGridSearchCV, HalvingRandomSearchCV
+            except ImportError:
+                err = "The halving search strategy requires scikit-learn 0.24 or later."
+                raise Exception(err)
+            
+            if budget:
+                return HalvingRandomSearchCV(estimator=estimator, param_distributions=self.model.param_grid,\
+                                             n_candidates=budget, **search_args)
+            
+            return HalvingGridSearchCV(estimator=estimator, param_grid=self.model.param_grid, **search_args)
+        elif self.model.search_strategy == "early_stopping":
+            return EarlyStoppingGridSearchCV(estimator=estimator, param_grid=self.model.param_grid,\
+                                             patience=self.model.search_patience, max_candidates=budget, **search_args)
+
     def _set_grid_params(self, param_grid, grid_search_args):
         """
         Set up the grid search parameters to be used later for sklearn.model_selection.GridSearchCV
@@ -1804,9 +2308,10 @@ class SKLearnForQlik:
         if self.model.debug:
             self._print_log(9)
 
-    def _get_model_by_name(self):
+    def _get_model_by_name(self, metadata=False):
         """
         Get a previously saved model using the model_name
+        If metadata=True, only the model information is needed, so the metadata sidecar is read if the model is not in cache
         """
         
         # Interpret the request data based on the expected row and column structure
@@ -1814,7 +2319,7 @@ class SKLearnForQlik:
         col_headers = ['model_name']
         
         # Create a Pandas Data Frame for the request data
-        self.request_df = utils.request_df(self.request, row_template, col_headers)
+        self.request_df = utils.request_df(self.request, row_template, col_headers, context=self.context)
         
         # Initialize the persistent model
         self.model = PersistentModel()
@@ -1823,7 +2328,7 @@ class SKLearnForQlik:
         self.model.name = self.request_df.loc[0, 'model_name']
         
         # Get the model from cache or disk
-        self._get_model()
+        self._get_model(metadata=metadata)
         
         # Debug information is printed to the terminal and logs if the paramater debug = true
         if self.model.debug:
@@ -1850,7 +2355,7 @@ class SKLearnForQlik:
             features_col_num = 2
         
         # Create a Pandas Data Frame for the request data
-        self.request_df = utils.request_df(self.request, row_template, col_headers)
+        self.request_df = utils.request_df(self.request, row_template, col_headers, context=self.context)
 
         if ordered_data:
             # Set the key column as the index
@@ -1931,6 +2436,62 @@ class SKLearnForQlik:
         else:
             return samples_df
     
+    @staticmethod
+    def _get_batches(first, bundles, batch_size):
+        """
+        Group the bundles in a request into batches of at least batch_size rows, reading the bundles as they are needed.
+        :param first: the first bundle in the request, which has already been read
+        :param bundles: an iterator for the remaining bundles
+        :param batch_size: the minimum number of rows in each batch, except the last one
+        :return: a generator of lists of bundles
+        """
+
+        batch = [first]
+        rows = len(first.rows)
+
+        for bundle in bundles:
+            if rows >= batch_size:
+                yield batch
+                batch = []
+                rows = 0
+            
+            batch.append(bundle)
+            rows += len(bundle.rows)
+        
+        yield batch
+    
+    def _get_batch_data(self, batch, target=False):
+        """
+        Get the samples and targets from a batch of bundles based on the model's feature definitions.
+        The batch has the same structure as the request for the fit method.
+        If target=False, the targets are returned as None.
+        """
+
+        # Create a Pandas Data Frame for the batch
+        request_df = utils.request_df(batch, ['strData', 'strData'], ['model_name', 'n_features'], context=self.context)
+        
+        try:
+            # Split the features provided as a string into individual columns
+            samples_df = pd.DataFrame([x.split("|") for x in request_df['n_features'].tolist()],\
+                                      columns=self.model.original_features_df.loc[:,"name"].tolist())
+        except AssertionError as ae:
+            err = "The number of input columns do not match feature definitions. Ensure you are using the | delimiter and providing the correct features."
+            err += "\n\nExpected Features:\n{}\n".format(self.model.original_features_df.loc[:,"name"].tolist())
+            raise AssertionError(err) from ae
+        
+        # Convert the data types based on feature definitions and sort by the unique identifier (if defined in the definitions)
+        samples_df = utils.convert_types(samples_df, self.model.original_features_df, sort=True)
+
+        target_df = None
+
+        if target:
+            # Get the target feature
+            target_name = self.model.original_features_df.loc[self.model.original_features_df["variable_type"] == "target"].index[0]
+            target_df = samples_df.loc[:,[target_name]]
+        
+        # Remove excluded features, target and identifier from the data
+        return samples_df[self.model.features_df.index.tolist()], target_df
+
     def _add_lags(self, X, y=None, extrapolate=1, update_features_df=False):
         """
         Add lag observations to X.
@@ -2145,16 +2706,21 @@ class SKLearnForQlik:
         elif self.model.estimator_type == "regressor":
             scoring = ['r2', 'neg_mean_squared_error', 'neg_mean_absolute_error', 'neg_median_absolute_error', 'explained_variance']
         
+        # Wrap the cross validation splitter so that the call is checked before each fold
+        cv = CancellableSplitter(check_cv(self.model.cv, y_train, classifier=self.model.estimator_type == "classifier"), self.context)
+
+        # Keras models can't be sent to other processes, so their folds are always fitted one at a time
+        n_jobs = 1 if self.model.using_keras else self.model.cv_n_jobs
+
         # Perform cross validation using the training data and the model pipeline
-        scores = cross_validate(self.model.pipe, self.X_train, y_train, scoring=scoring, cv=self.model.cv, fit_params=fit_params, return_train_score=False)
+        # Each fold is fitted once, giving the scores and, for classifiers, the predictions for the confusion matrix
+        scores, y_pred, indices = cross_validate_predict(self.model.pipe, self.X_train, y_train, scoring, cv, fit_params=fit_params,\
+                                                         n_jobs=n_jobs, predict=self.model.estimator_type == "classifier")
 
         # Prepare the metrics data frame according to the output format
         if self.model.estimator_type == "classifier":           
-            # Get cross validation predictions for the confusion matrix
-            y_pred = cross_val_predict(self.model.pipe, self.X_train, y_train, cv=self.model.cv, fit_params=fit_params)
-
-            # Prepare the confusion matrix and add it to the model
-            self._prep_confusion_matrix(y_train, y_pred, labels)
+            # Prepare the confusion matrix from the out-of-fold predictions and add it to the model
+            self._prep_confusion_matrix(y_train[indices], y_pred, labels)
 
             # Create an empty data frame to set the structure
             metrics_df = pd.DataFrame(columns=["class", "accuracy", "accuracy_std", "precision", "precision_std", "recall",\
@@ -2307,6 +2873,24 @@ class SKLearnForQlik:
             self.table.fields.add(name="time_stamp")
             self.table.fields.add(name="score_result")
             self.table.fields.add(name="score", dataType=1)
+        elif variant == "fit_async":
+            self.table.fields.add(name="model_name")
+            self.table.fields.add(name="job_id")
+            self.table.fields.add(name="state")
+            self.table.fields.add(name="time_stamp")
+        elif variant == "job_status":
+            self.table.fields.add(name="job_id")
+            self.table.fields.add(name="model_name")
+            self.table.fields.add(name="state")
+            self.table.fields.add(name="stage")
+            self.table.fields.add(name="step", dataType=1)
+            self.table.fields.add(name="total", dataType=1)
+            self.table.fields.add(name="progress", dataType=1)
+            self.table.fields.add(name="eta_seconds", dataType=1)
+            self.table.fields.add(name="score", dataType=1)
+            self.table.fields.add(name="result")
+            self.table.fields.add(name="submitted")
+            self.table.fields.add(name="finished")
         elif variant == "metrics_clf":
             self.table.fields.add(name="model_name")
             self.table.fields.add(name="class")
@@ -2370,6 +2954,9 @@ class SKLearnForQlik:
         elif variant == "best_params":
             self.table.fields.add(name="model_name")
             self.table.fields.add(name="best_params")
+            self.table.fields.add(name="strategy")
+            self.table.fields.add(name="candidates", dataType=1)
+            self.table.fields.add(name="time_per_candidate", dataType=1)
         elif variant == "cluster":
             self.table.fields.add(name="model_name")
             self.table.fields.add(name="key")
@@ -2394,16 +2981,32 @@ class SKLearnForQlik:
         table_header = (('qlik-tabledescription-bin', self.table.SerializeToString()),)
         self.context.send_initial_metadata(table_header)
     
-    def _get_model(self, use_cache=True):
+    def _get_model(self, use_cache=True, metadata=False):
         """
         Get the model from the class model cache or disk.
         Update the cache if loading from disk.
+        If metadata=True and the model is not in cache, only the model information is loaded from the metadata sidecar.
         Return the model.
         """
         
-        if use_cache and self.model.name in self.__class__.model_cache:
+        cached = self.__class__.model_cache.get(self.model.name) if use_cache else None
+
+        if cached is None:
+            # Wait for any background save of the model to complete before reading it from disk
+            utils.background_writer.wait(self.path + self.model.name + '.joblib')
+
+        if cached is None and metadata:
+            try:
+                # Load the model information without deserializing the full model
+                self.model = self.model.load_metadata(self.model.name, self.path)
+                return
+            except FileNotFoundError:
+                # Models saved before the sidecar was introduced are loaded in full
+                pass
+
+        if cached is not None:
             # Load the model from cache
-            self.model = self.__class__.model_cache[self.model.name]
+            self.model = cached
 
             # Refresh the keras model to avoid tensorflow errors 
             if self.model.using_keras and hasattr(self.model, 'pipe'):
@@ -2414,7 +3017,7 @@ class SKLearnForQlik:
                 self._print_log(6)
         else:
             # Load the model from disk
-            self.model = self.model.load(self.model.name, self.path) 
+            self.model = self.load_model(self.model.name, self.path) 
 
             # Debug information is printed to the terminal and logs if the paramater debug = true
             if self.model.debug:
@@ -2422,28 +3025,66 @@ class SKLearnForQlik:
             
             # Update the cache to keep this model in memory
             self._update_cache()
+        
+        # Profile the rest of the call if profile=true was set for the model
+        self._start_profile()
+    
+    def _start_profile(self):
+        """
+        Start profiling the current call if the model was set up with profile=true.
+        The profile is written to the logs folder at the end of the call.
+        """
+
+        if getattr(self.model, 'profile', False):
+            utils.profile_call('SKLearn', getattr(self.model, 'profile_memory', False), getattr(self.model, 'profile_top', 30))
     
     def _update_cache(self):
         """
         Maintain a cache of recently used models at the class level
         """
         
-        # Check if the model cache is full
-        if self.__class__.cache_limit == len(self.__class__.model_cache):
-            # Remove the oldest item from the cache if exceeding cache limit
-            self.__class__.model_cache.popitem(last=False)
-        
-        # Remove the obsolete version of the model from the cache
-        if self.model.name in self.__class__.model_cache:
-            del self.__class__.model_cache[self.model.name]
-        
-        # Add the current model to the cache
-        self.__class__.model_cache[self.model.name] = self.model
+        # Add the current model to the cache, replacing any obsolete version and evicting models if the cache is full
+        # The model is dropped from the cache if its file is later replaced, e.g. by another SSE sharing the models directory
+        self.__class__.model_cache.put(self.model.name, self.model, file=self.path + self.model.name + '.joblib')
         
         # Debug information is printed to the terminal and logs if the paramater debug = true
         if self.model.debug:
             self._print_log(8)
     
+    @classmethod
+    def reload_model(cls, name, path="../models/"):
+        """
+        Load a model from disk into the class model cache, e.g. when the cache finds that the model file has been replaced.
+        Keras models are not loaded as this clears the Keras session used by other calls. They are loaded on next use.
+        Models without a readable metadata sidecar are loaded in full, as it can't be known beforehand if they use Keras.
+        """
+
+        try:
+            if PersistentModel().load_metadata(name, path).using_keras:
+                logging.warning('Keras model {0} was not loaded into the model cache. It will be loaded on first use.'.format(name))
+                return
+        except (FileNotFoundError, ValueError):
+            # Models saved before the sidecar was introduced, or with an unreadable sidecar, are loaded in full
+            pass
+        
+        model = cls.load_model(name, path)
+        cls.model_cache.put(name, model, file=path + name + '.joblib')
+    
+    @classmethod
+    def load_model(cls, name, path="../models/"):
+        """
+        Load a model from disk. All models are loaded through this method before they are cached, so that older models 
+        get the defaults for settings that were added later.
+        """
+
+        model = PersistentModel().load(name, path)
+
+        for attr, default in cls.model_defaults.items():
+            if not hasattr(model, attr):
+                setattr(model, attr, default)
+        
+        return model
+    
     def _keras_refresh(self):
         """
         Avoid tensorflow errors for keras models by clearing the session and reloading from disk
@@ -2525,7 +3166,8 @@ class SKLearnForQlik:
             
         elif step == 8:
             # Message when cache is updated
-            output = "\nCache updated. Models in cache:\n{0}\n\n".format([k for k,v in self.__class__.model_cache.items()])
+            output = "\nCache updated. Models in cache:\n{0}\n\nCache statistics: {1}\n\n".format(self.__class__.model_cache.names(),\
+            self.__class__.model_cache.stats())
         
         elif step == 9:
             # Output when a parameter grid is set up
@@ -3,8 +3,9 @@ import re
 import sys
 import time
 import string
+import shutil
 import pathlib
-import joblib
+import tempfile
 import random
 import warnings
 import numpy as np
@@ -19,6 +20,8 @@ from spacy.util import minibatch, compounding, decaying
 from spacy.gold import GoldParse
 from sklearn.model_selection import train_test_split
 import _utils as utils
+import _metrics as metrics
+from _cache import ModelCache
 import ServerSideExtension_pb2 as SSE
 
 # Add Generated folder to module path
@@ -34,6 +37,13 @@ class SpaCyForQlik:
     # Counter used to name log files for instances of the class
     log_no = 0
 
+    # Cache for loaded spaCy models at the class level, keyed by the model name or path
+    # This is replaced by the server based on the model_cache_mb and model_cache_policy options
+    model_cache = ModelCache()
+
+    # Maximum number of seconds to wait for a model being retrained before loading it again
+    locked_timeout = 60
+
     def __init__(self, request, context, path="../models/spaCy/"):
         """
         Class initializer.
@@ -67,7 +77,7 @@ class SpaCyForQlik:
             col_headers = ['key', 'text', 'model_name', 'kwargs']
         
         # Create a Pandas DataFrame for the request data
-        self.request_df = utils.request_df(self.request, row_template, col_headers)
+        self.request_df = utils.request_df(self.request, row_template, col_headers, context=self.context)
 
         # Get the argument strings from the request dataframe
         kwargs = self.request_df.loc[0, 'kwargs']
@@ -100,7 +110,7 @@ class SpaCyForQlik:
         col_headers = ['text', 'entity', 'entity_type', 'model_name', 'kwargs']
         
         # Create a Pandas DataFrame for the request data
-        self.request_df = utils.request_df(self.request, row_template, col_headers)
+        self.request_df = utils.request_df(self.request, row_template, col_headers, context=self.context)
 
         # Get the argument strings from the request dataframe
         kwargs = self.request_df.loc[0, 'kwargs']
@@ -185,6 +195,10 @@ class SpaCyForQlik:
 
                     self._print_log(1)
             
+            # Set the profile option for writing a cProfile dump and a summary of the call to the logs folder
+            # Valid values are: true, false. Use profile_memory=true to include memory allocations and profile_top=<n> for the summary length.
+            utils.start_profile('SpaCy', self.kwargs)
+            
             # Set whether the model (if getting named entites) or base model (if retraining) is a custom model
             # i.e. not one of the pre-trained models provided by spaCy
             if 'custom' in self.kwargs:
@@ -253,10 +267,14 @@ class SpaCyForQlik:
 
         # Load the spaCy model
         try:
-            nlp = spacy.load(self.model)
+            nlp = self.load_model(self.model)
         except OSError:
+            # Custom models are already given as a path to the directory
+            if self.custom:
+                raise
+            
             self.model = self.path + self.model + "/"
-            nlp = spacy.load(self.model)
+            nlp = self.load_model(self.model)
         
         # Create an empty list for storing named entities
         entities = []
@@ -275,6 +293,44 @@ class SpaCyForQlik:
         
         return entities
 
+    @classmethod
+    def load_model(cls, model):
+        """
+        Get a spaCy model from the class model cache, loading it with spacy.load if required.
+        Models are only read by the entity tagger, so a cached model can be shared between calls.
+        A model directory is briefly missing while a retrained model is swapped into place. If the model can't be loaded 
+        while it is being retrained, the retraining is waited on and the model is loaded again.
+        :param model: the name of a spaCy model package or the path to a model directory
+        :return: the spaCy Language object
+        """
+
+        nlp = cls.model_cache.get(model)
+
+        if nlp is None:
+            with metrics.stage('model_load'):
+                try:
+                    nlp = spacy.load(model)
+                except OSError:
+                    # The lock is held on the model path without the trailing separator while the model is saved
+                    lock_path = model.rstrip('/\\')
+
+                    if not os.path.exists(lock_path + '.lock'):
+                        raise
+
+                    with utils.FileLock(lock_path, timeout=cls.locked_timeout):
+                        pass
+                    
+                    nlp = spacy.load(model)
+            
+            # Models loaded from a directory are dropped from the cache if the directory is replaced, e.g. by retraining
+            # The size is taken from the model files as pickling a spaCy model to measure it would be slow
+            path = getattr(nlp, 'path', None)
+            file = model if os.path.isdir(model) else None
+            size = sum(f.stat().st_size for f in pathlib.Path(str(path)).glob('**/*') if f.is_file()) if path else None
+            cls.model_cache.put(model, nlp, file=file, size=size)
+        
+        return nlp
+
     def _prep_data(self):
         """
         Prepare the data for retraining the model.
@@ -351,11 +407,12 @@ class SpaCyForQlik:
         if self.debug:
             self._print_log(6)
     
-    def _retrain_model(self, locked_timeout=2):
+    def _retrain_model(self, locked_timeout=None):
         """
         Update an existing spaCy model with labelled training data.
         The model is stored to disk using spaCy's to_disk method.
-        If the model is found to be locked (based on the existance of a lock file) this function will fail after 'locked_timeout' seconds.
+        Concurrent saves of the same model are serialized with a file lock. If 'locked_timeout' is given, this function will 
+        fail if another save doesn't complete within this many seconds.
         """
 
         # Load the model, set up the pipeline and train the entity recognizer:
@@ -366,7 +423,8 @@ class SpaCyForQlik:
             if self.custom:
                 self.base_model = self.path + self.base_model + "/"
             
-            nlp = spacy.load(self.base_model)  
+            with metrics.stage('model_load'):
+                nlp = spacy.load(self.base_model)  
         # If the parameter blank=true is passed we start with a blank Language class, e.g. en
         else:
             nlp = spacy.blank(self.base_model)  
@@ -405,6 +463,9 @@ class SpaCyForQlik:
             if self.blank:
                 nlp.begin_training()
             for epoch in range(self.epochs): 
+                # Stop if Qlik is no longer waiting for the result
+                utils.check_context(self.context, "epoch {0}".format(epoch+1))
+
                 random.shuffle(self.train)
                 losses = {}
                 # batch up the examples using spaCy's minibatch
@@ -449,27 +510,29 @@ class SpaCyForQlik:
         # Save model to output directory:
         
         output_dir = pathlib.Path(self.path + self.model + '/')
-        lock_file = pathlib.Path(self.path + self.model + '.lock')
-        
-        # Create the output directory if required
-        if not output_dir.exists():
-            output_dir.mkdir(parents=True, exist_ok=False)
-        # If the model is locked wait a few seconds
-        elif lock_file.exists():
-            time.sleep(locked_timeout)
-            # If the model is still locked raise an exception
-            if lock_file.exists():
-                raise TimeoutError("The specified model is locked. If you think this is wrong, please delete file {0}".format(lock_file))
+        output_dir.parent.mkdir(parents=True, exist_ok=True)
 
-        try:
-            # Create the lock file
-            joblib.dump(self.path + self.model, filename=lock_file)
-
-            # Store the spaCy model to disk
-            nlp.to_disk(output_dir)
-        finally:
-            # Delete the lock file
-            lock_file.unlink()
+        with utils.FileLock(self.path + self.model, timeout=locked_timeout):
+            # Store the spaCy model to a temporary directory, so that the existing model stays usable while writing
+            temp_dir = pathlib.Path(tempfile.mkdtemp(dir=str(output_dir.parent), prefix=self.model + '.', suffix='.tmp'))
+
+            try:
+                nlp.to_disk(temp_dir)
+
+                # Swap the new model into place. The previous version is renamed first as directories can't be replaced.
+                if output_dir.exists():
+                    old_dir = pathlib.Path(tempfile.mkdtemp(dir=str(output_dir.parent), prefix=self.model + '.', suffix='.old'))
+                    os.replace(str(output_dir), str(old_dir / 'model'))
+                    os.replace(str(temp_dir), str(output_dir))
+                    shutil.rmtree(str(old_dir), ignore_errors=True)
+                else:
+                    os.replace(str(temp_dir), str(output_dir))
+            finally:
+                if temp_dir.exists():
+                    shutil.rmtree(str(temp_dir), ignore_errors=True)
+        
+        # Drop the previous version of the model from the cache
+        self.__class__.model_cache.remove(self.path + self.model + '/')
 
         # Debug information is printed to the terminal and logs if the paramater debug = true
         if self.debug:
@@ -2,13 +2,29 @@ import os
 import sys
 import ast
 import time
+import shutil
 import string
 import locale
-import pickle
+import atexit
+import pstats
+import cProfile
+import logging
+import threading
 import warnings
+import tempfile
+import tracemalloc
 import numpy as np
 import pandas as pd
 from pathlib import Path
+from contextlib import contextmanager
+from concurrent import futures
+
+# Advisory file locks use fcntl where available and msvcrt on Windows
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
 
 import ServerSideExtension_pb2 as SSE
 
@@ -16,83 +32,345 @@ import ServerSideExtension_pb2 as SSE
 if not sys.warnoptions:
     warnings.simplefilter("ignore")
 
-from sklearn import preprocessing
+import _metrics as metrics
 
 # Add Generated folder to module path.
 PARENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(os.path.join(PARENT_DIR, 'generated'))
 
-def request_df(request_list, row_template, col_headers):
+def request_df(request_list, row_template, col_headers, context=None):
     """
     This function takes in a SSE request as a list together with a row template and column headers as lists of strings.
     Returns a Data Frame for the request.
+    If the gRPC context is provided, decoding stops if the call is no longer active.
     e.g. request_df(request_list, ['strData', 'numData', 'strData'], ['dim1', 'measure', 'kwargs'])
     """
     
-    rows = [row for request_rows in request_list for row in request_rows.rows]
-    outer = []
+    columns = request_columns(request_list, row_template, context=context)
+
+    return pd.DataFrame(dict(zip(col_headers, columns)), columns=col_headers)
+
+def request_columns(request, row_template, context=None):
+    """
+    Decode a SSE request column by column into typed NumPy arrays.
+    The request can be a list of BundledRows or the request iterator itself, in which case bundles are consumed as they arrive.
+    Returns a list with one array per entry in the row template: float64 for 'numData' and object (str) for 'strData'.
+    If the gRPC context is provided, the call is checked before decoding each bundle and CallCancelled is raised if it is 
+    no longer active. Only the decoding is timed, not the wait for bundles from the request iterator.
+    e.g. request_columns(request_list, ['strData', 'numData', 'strData'])
+    """
+
+    columns = [[] for _ in row_template]
+    numeric = [field == 'numData' for field in row_template]
+    width = len(row_template)
+
+    for bundle in request:
+        check_context(context, "request decode")
+
+        with metrics.stage('decode'):
+            # Slicing a repeated field returns a plain list, which is much faster to iterate than the protobuf container
+            # Each row is read once, appending its values to the lists for the columns, which are converted to arrays at the end
+            for row in bundle.rows[:]:
+                duals = row.duals[:]
+
+                if len(duals) < width:
+                    err = "A row in the request has {0} values while {1} are expected.".format(len(duals), width)
+                    raise IndexError(err)
+
+                for column, is_num, dual in zip(columns, numeric, duals):
+                    column.append(dual.numData if is_num else dual.strData)
+
+    with metrics.stage('decode'):
+        return [np.array(column, dtype=np.float64 if is_num else object) for column, is_num in zip(columns, numeric)]
+
+def check_context(context, stage=""):
+    """
+    Check that the call from Qlik is still active and within its deadline before starting a stage of the work.
+    Qlik abandons calls e.g. when the user changes selections, so there is no point in continuing.
+    Raises CallCancelled if the call is no longer active. If the context is None, the check is skipped.
+    """
+
+    if context is None:
+        return
     
-    for i in range(len(rows)):
-        inner = []
-        
-        for j in range(len(row_template)):
-            inner.append(getattr(rows[i].duals[j], row_template[j]))
-        
-        outer.append(inner)
+    if not context.is_active():
+        raise CallCancelled("The call was cancelled by Qlik before {0}.".format(stage))
     
-    return pd.DataFrame(outer, columns=col_headers)
+    remaining = context.time_remaining()
 
-def get_response_rows(response, template):
+    if remaining is not None and remaining <= 0:
+        raise CallCancelled("The deadline for the call passed before {0}.".format(stage))
+
+def report_progress(context, stage, step=None, total=None):
     """
-    Take in a list of responses and covert them to SSE.Rows based on the column type specified in template
-    The template should be a list of the form: ["str", "num", "dual", ...]
-    For string values use: "str"
-    For numeric values use: "num"
-    For dual values: "dual"
+    Report the progress of a function executed as a background job, e.g. report_progress(context, 'cross validation', 2, 5).
+    The progress is recorded if the context is a JobContext. For calls from Qlik this does nothing.
+    :param context: the context of the call
+    :param stage: the stage of the work, e.g. 'fitting'
+    :param step: the number of steps completed in this stage, e.g. folds or epochs
+    :param total: the total number of steps in this stage
+    """
+
+    report = getattr(context, 'report_progress', None)
+
+    if report is not None:
+        report(stage, step, total)
+
+class CallCancelled(Exception):
+    """
+    Raised when the call from Qlik is no longer active or has passed its deadline.
+    """
+    pass
+
+class Profiler:
+    """
+    Profile a function call with cProfile, and optionally tracemalloc, and write the results to the logs folder.
+    Only the thread executing the call is profiled.
+    """
+
+    # Counter for the profiles written by this process
+    log_no = 0
+    log_lock = threading.Lock()
+
+    def __init__(self, name, memory=False, top=30):
+        """
+        Class initializer.
+        :param name: the name used for the output files, e.g. 'SKLearn'
+        :param memory: trace memory allocations with tracemalloc
+        :param top: the number of functions and allocation sites included in the summary
+        """
+
+        self.name = name
+        self.memory = memory
+        self.top = top
+        self.profile = cProfile.Profile()
+        self.started_tracemalloc = False
+
+    def start(self):
+        """
+        Start profiling the current thread.
+        """
+
+        self.start_time = time.time()
+
+        # tracemalloc is process wide, so it is only stopped by the profiler that started it
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+
+        self.profile.enable()
+        return self
+
+    def stop(self):
+        """
+        Stop profiling and write the profile as a .pstats file and a summary of the top functions as a .txt file.
+        :return: the path of the summary file
+        """
+
+        self.profile.disable()
+        snapshot = tracemalloc.take_snapshot() if self.memory and tracemalloc.is_tracing() else None
+
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+
+        with self.log_lock:
+            self.__class__.log_no += 1
+            log_no = self.log_no
+
+        # Profiles will be stored in ..\logs\<name> Profile <pid>-<n>.pstats and .txt
+        path = os.path.join(os.getcwd(), 'logs', '{0} Profile {1}-{2}'.format(self.name, os.getpid(), log_no))
+        self.profile.dump_stats(path + '.pstats')
+
+        with open(path + '.txt', 'w', encoding='utf-8') as f:
+            f.write("{0} Profile: {1}\nElapsed time: {2:.3f} seconds\n\n"\
+                    .format(self.name, time.ctime(self.start_time), time.time() - self.start_time))
+
+            stats = pstats.Stats(self.profile, stream=f)
+            stats.sort_stats('cumulative').print_stats(self.top)
+            stats.sort_stats('tottime').print_stats(self.top)
+
+            if snapshot is not None:
+                f.write("Top {0} allocation sites by memory in use:\n\n".format(self.top))
+
+                for stat in snapshot.statistics('lineno')[:self.top]:
+                    f.write("{0}\n".format(stat))
+
+        return path + '.txt'
+
+# The profiler for the call being executed by the current thread
+_profiling = threading.local()
+
+def start_profile(name, kwargs, pop=False):
     """
+    Start profiling the call being executed by the current thread if the execution arguments include profile=true.
+    Optional arguments are profile_memory=true to trace memory allocations and profile_top=<n> for the summary length.
+    The profile is written to the logs folder when end_profile is called at the end of the call.
+    :param name: the name used for the output files, e.g. 'SKLearn'
+    :param kwargs: the execution arguments as a dictionary
+    :param pop: remove the profile arguments from kwargs, e.g. if the remaining arguments are passed on to a function
+    :return: the Profiler or None if profiling is not required
+    """
+
+    get = kwargs.pop if pop else kwargs.get
+    profile = 'true' == get('profile', 'false').lower()
+    memory = 'true' == get('profile_memory', 'false').lower()
+    top = atoi(get('profile_top', '30'))
 
-    response_rows = []
+    if not profile:
+        return None
     
-    # For each row in the response list
-    for row in response:
-        i = 0
-        this_row = []
-        
-        if len(template) > 1:        
-            # For each column in the row
-            for col in row:
-                # Convert values to type SSE.Dual according to the template list
-                if template[i] == "str":
-                    if col is None:
-                        col = "\x00"
-                    elif type(col) is not str:
-                        col = "{0:.5f}".format(col)
-                    this_row.append(SSE.Dual(strData=col))
-                elif template[i] == "num":
-                    this_row.append(SSE.Dual(numData=col))
-                elif template[i] == "dual":
-                    this_row.append(SSE.Dual(strData=col, numData=col))
-                i = i + 1
+    return profile_call(name, memory, top)
+
+def profile_call(name, memory=False, top=30):
+    """
+    Start profiling the call being executed by the current thread, e.g. based on profile options stored with a model.
+    The profile is written to the logs folder when end_profile is called at the end of the call.
+    :param name: the name used for the output files, e.g. 'SKLearn'
+    :param memory: trace memory allocations as well
+    :param top: the number of functions and allocation sites in the summary
+    :return: the Profiler or None if it could not be started
+    """
+
+    # Only one profiler is used for a call, even if the parameters are set more than once
+    if getattr(_profiling, 'profiler', None) is not None:
+        return _profiling.profiler
+
+    try:
+        _profiling.profiler = Profiler(name, memory, top).start()
+    except ValueError as e:
+        # Only one cProfile profiler can be active at a time in recent versions of Python
+        logging.warning('Profiling skipped for this call: {0}'.format(e))
+        _profiling.profiler = None
+
+    return _profiling.profiler
+
+def end_profile():
+    """
+    Stop the profiler for the call being executed by the current thread, if any, and write the profile to the logs folder.
+    """
+
+    profiler = getattr(_profiling, 'profiler', None)
+
+    if profiler is not None:
+        _profiling.profiler = None
+        logging.info('Profile written to {0}'.format(profiler.stop()))
+
+def encode_response(response, template):
+    """
+    Convert a response to a list of SSE.Rows based on the column type specified in template.
+    The response can be a DataFrame, a Series, a NumPy array or a list of columns.
+    The template should be a list of the form: ["str", "num", "dual", ...]
+    Values are converted to Python types column by column and each row is then built in a single pass.
+    """
+
+    columns = get_response_columns(response)
+    values = []
+
+    # Convert each column to a list of values for the SSE.Dual fields according to the template list
+    for col, dtype in zip(columns, template):
+        if dtype == "str":
+            values.append(format_str_column(col))
+        elif dtype == "num":
+            values.append(format_num_column(col))
+        elif dtype == "dual":
+            values.append(list(zip(format_str_column(col), format_num_column(col))))
         else:
-            # Convert values to type SSE.Dual according to the template list
-            if template[0] == "str":
-                if row is None:
-                    row = "\x00"
-                elif type(row) is not str:
-                    row = "{0:.5f}".format(row)
-                this_row.append(SSE.Dual(strData=row))
-            elif template[0] == "num":
-                this_row.append(SSE.Dual(numData=row))
-            elif template[0] == "dual":
-                this_row.append(SSE.Dual(strData=row, numData=row))
+            err = "Invalid data type in the response template: {0}. Valid types are: str, num, dual".format(dtype)
+            raise Exception(err)
+
+    rows = []
+
+    # The duals are added to each row in place, as passing a list of SSE.Dual to SSE.Row copies every dual
+    for row_values in zip(*values):
+        row = SSE.Row()
+        add = row.duals.add
+
+        for dtype, value in zip(template, row_values):
+            dual = add()
+
+            if dtype == "str":
+                dual.strData = value
+            elif dtype == "num":
+                dual.numData = value
+            else:
+                dual.strData, dual.numData = value
         
-        # Group columns into a iterable and add to the the response_rows
-        response_rows.append(iter(this_row))
+        rows.append(row)
+
+    return rows
+
+def stream_response(response, template, bundle_bytes=1024*1024, chunk_rows=10000):
+    """
+    Encode a response and yield it as SSE.BundledRows of approximately bundle_bytes each.
+    The size of each bundle is estimated by adding up the ByteSize() of its rows.
+    Rows are encoded in chunks of chunk_rows, so only part of a large response is held as SSE.Rows at any time.
+    The response and template are the same as for encode_response.
+    """
 
-    # Values are then structured as SSE.Rows
-    response_rows = [SSE.Row(duals=duals) for duals in response_rows]
+    columns = get_response_columns(response)
+    num_rows = len(columns[0]) if len(columns) > 0 else 0
 
-    return response_rows
+    rows = []
+    size = 0
+
+    for start in range(0, num_rows, chunk_rows):
+        with metrics.stage('encode'):
+            # Encode the next chunk of the response
+            chunk = encode_response([col[start : start + chunk_rows] for col in columns], template)
+            # Get the row sizes with an allowance for the field tag and length prefix within the bundle
+            sizes = [row.ByteSize() + 4 for row in chunk]
+
+        for row, row_size in zip(chunk, sizes):
+            rows.append(row)
+            size += row_size
+
+            # Yield the bundle once it reaches the target size
+            if size >= bundle_bytes:
+                yield SSE.BundledRows(rows=rows)
+                rows = []
+                size = 0
+
+    # Yield the remaining rows. An empty bundle is sent if the response has no rows.
+    if len(rows) > 0 or num_rows == 0:
+        yield SSE.BundledRows(rows=rows)
+
+def get_response_columns(response):
+    """
+    Return the columns of a response as a list of NumPy arrays.
+    The response can be a DataFrame, a Series, a NumPy array or a list of columns.
+    """
+
+    if isinstance(response, pd.DataFrame):
+        return [response.iloc[:, j].to_numpy() for j in range(response.shape[1])]
+    elif isinstance(response, pd.Series):
+        return [response.to_numpy()]
+    elif isinstance(response, np.ndarray):
+        return [response] if response.ndim == 1 else [response[:, j] for j in range(response.shape[1])]
+    else:
+        return [np.asarray(col) for col in response]
+
+def format_str_column(col):
+    """
+    Format a column of values as strings for the strData field of SSE.Dual.
+    Numeric columns are formatted in bulk with 5 decimal places.
+    In object columns, strings are left as is, None is sent as a null and other values are formatted as numbers.
+    """
+
+    if col.dtype.kind in "biuf":
+        return list(map("{0:.5f}".format, col.tolist()))
+
+    return [s if isinstance(s, str) else "\x00" if s is None else "{0:.5f}".format(s) for s in col.tolist()]
+
+def format_num_column(col):
+    """
+    Format a column of values as numbers for the numData field of SSE.Dual.
+    In object columns, None is sent as NaN.
+    """
+
+    if col.dtype.kind in "biuf":
+        return col.tolist()
+
+    return [np.nan if n is None else n for n in col.tolist()]
 
 def fillna(df, method="zeros"):
     """
@@ -119,6 +397,9 @@ def get_scaler(df, missing="zeros", scaler="StandardScaler", **kwargs):
     Valid options specified through the missing parameter are: zeros, mean, median, mode
     """
 
+    # sklearn is imported here as it is slow to import and only needed by some functions
+    from sklearn import preprocessing
+
     s = getattr(preprocessing, scaler)
     s = s(**kwargs)
 
@@ -137,6 +418,9 @@ def scale(df, missing="zeros", scaler="robust", **kwargs):
     scalers = {'standard':'StandardScaler', 'minmax':'MinMaxScaler', 'maxabs':'MaxAbsScaler',\
                'robust':'RobustScaler', 'quantile':'QuantileTransformer'}
     
+    # sklearn is imported here as it is slow to import and only needed by some functions
+    from sklearn import preprocessing
+
     s = getattr(preprocessing, scalers[scaler])
     s = s(**kwargs)
     
@@ -520,30 +804,319 @@ def decode(y, labels={}):
 
     return y
 
-def lock(filepath, wait=2, retries=2):
+class FileLock:
     """
-    Create a lockfile for a specified file.
-    If the file is already locked, wait for a specified number of seconds.
-    Retry a maximum number of times before timing out.
+    An exclusive advisory lock for a file, held on a <filepath>.lock file using fcntl, or msvcrt on Windows.
+    Use this to serialize writers. Readers don't take the lock, as writers replace files atomically with atomic_path.
+    The lock is released by the operating system if the process ends, so a lock file left on disk is never stale.
+    e.g. with FileLock(filepath): ...
     """
 
-    # Create a path for the lock file
-    f_lock = filepath + '.lock'
+    def __init__(self, filepath, timeout=None):
+        """
+        Class initializer.
+        :param filepath: the file to be locked
+        :param timeout: the maximum number of seconds to wait for the lock. By default the lock is waited on until released.
+        """
+
+        self.f_lock = filepath + '.lock'
+        self.timeout = timeout
+        self.file = None
+
+    def acquire(self):
+        """
+        Acquire the lock, waiting for another writer to release it if required.
+        Raises a TimeoutError if the lock is not acquired within the timeout.
+        """
+
+        Path(self.f_lock).parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(self.f_lock, 'a+b')
+
+        # Block on the lock unless a timeout is specified, in which case poll for it
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        delay = 0.01
+
+        while True:
+            try:
+                self._lock(blocking=deadline is None)
+                return self
+            except OSError:
+                if time.time() >= deadline:
+                    self.file.close()
+                    self.file = None
+                    raise TimeoutError("The specified file is locked by another writer: {0}".format(self.f_lock))
+                
+                time.sleep(min(delay, max(deadline - time.time(), 0)))
+                delay = min(delay * 2, 0.5)
+
+    def release(self):
+        """
+        Release the lock.
+        """
+
+        if self.file is None:
+            return
+
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            else:
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self.file.close()
+            self.file = None
+
+    def _lock(self, blocking=True):
+        """
+        Lock the open lock file. Raises an OSError if not blocking and the lock is held by another writer.
+        """
 
-    for _ in range(retries):
-        # If the file is currently locked
-        if Path(f_lock).exists():
-            # Wait a few seconds and check again
-            time.sleep(wait)
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
         else:
-            # Write a lock file
-            with open(f_lock, 'wb') as file:
-                pickle.dump(f_lock, file)
-                break  
-    else:
-        # If the file is still locked after maximum retries raise an exception
-        if Path(f_lock).exists():
-            raise TimeoutError("The specified file is locked. If you believe this to be wrong, please delete file {0}".format(f_lock))
+            # msvcrt.locking only retries for a few seconds when blocking, so keep trying until the lock is acquired
+            self.file.seek(0)
+
+            while True:
+                try:
+                    msvcrt.locking(self.file.fileno(), msvcrt.LK_NBLCK, 1)
+                    return
+                except OSError:
+                    if not blocking:
+                        raise
+                    time.sleep(0.05)
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+
+# The umask of the process, read once at import as it can only be read by setting it, which is not thread safe
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+@contextmanager
+def atomic_path(filepath):
+    """
+    Get a temporary path to write a file to, which atomically replaces the file at filepath once the block completes.
+    Readers see either the previous or the new version of the file, never a partially written one.
+    If the block raises an exception the temporary file is removed and the original file is left as it was.
+    e.g. with atomic_path(f) as temp: joblib.dump(obj, temp)
+    """
+
+    path = Path(filepath)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    # The temporary file is created in the same directory so that it can be renamed over the original
+    fd, temp = tempfile.mkstemp(dir=str(path.parent), prefix=path.name + '.', suffix='.tmp')
+    os.close(fd)
+
+    try:
+        yield temp
+
+        # mkstemp creates the file readable by its owner only, so apply the permissions of a newly created file instead
+        # This keeps the file readable e.g. by other service accounts sharing the models directory
+        os.chmod(temp, 0o666 & ~_UMASK)
+        os.replace(temp, str(path))
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+class BackgroundWriter:
+    """
+    Run writes, such as model saves, in a background thread so that a call can return before the write completes.
+    Writes are executed one at a time in the order they are submitted. Each write has a key, e.g. the file path, 
+    so that a reader can wait for any pending write to the same file before reading it.
+    """
+
+    def __init__(self):
+        """
+        Class initializer.
+        """
+
+        # A single thread keeps writes to the same file in order
+        self.executor = futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='background-writer')
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def submit(self, key, func, *args, **kwargs):
+        """
+        Submit a write to be executed in the background.
+        :param key: the key for the write, e.g. the path of the file being written
+        :param func: the function that performs the write
+        :return: a Future for the write
+        """
+
+        future = self.executor.submit(self._run, key, func, *args, **kwargs)
+
+        with self.lock:
+            self.pending[key] = future
+        
+        future.add_done_callback(lambda f: self._done(key, f))
+        return future
+
+    def wait(self, key, timeout=None):
+        """
+        Wait for a pending write with the given key to complete, if there is one.
+        Calls from a write being executed by the writer return immediately, as the write can not wait for itself.
+        """
+
+        if getattr(self.local, 'running', False):
+            return
+
+        with self.lock:
+            future = self.pending.get(key)
+        
+        if future is not None:
+            futures.wait([future], timeout=timeout)
+
+    def flush(self, timeout=None):
+        """
+        Wait for all pending writes to complete, e.g. before shutting down.
+        """
+
+        with self.lock:
+            pending = list(self.pending.values())
+        
+        if len(pending) > 0:
+            logging.info('Waiting for {0} background writes to complete'.format(len(pending)))
+            futures.wait(pending, timeout=timeout)
+
+    def _run(self, key, func, *args, **kwargs):
+        """
+        Execute a write, logging any error as there is no caller to raise it to.
+        """
+
+        self.local.running = True
+
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            logging.error('Background write to {0} failed: {1}'.format(key, e))
+            raise
+        finally:
+            self.local.running = False
+
+    def _done(self, key, future):
+        """
+        Remove a completed write from the pending writes, unless a later write with the same key was submitted.
+        """
+
+        with self.lock:
+            if self.pending.get(key) is future:
+                del self.pending[key]
+
+# The writer used for background model saves, flushed when the process exits
+background_writer = BackgroundWriter()
+atexit.register(background_writer.flush)
+
+class TransformerCache:
+    """
+    A managed directory used as the joblib memory for sklearn pipelines, so that fitted transformers such as the 
+    Preprocessor are reused when the same transformer is fitted to the same data again, e.g. in repeated fits of a model.
+    The directory is kept under a size limit by removing the least recently used entries and is deleted when the 
+    process that created it exits. Worker processes started by that process share the directory.
+    """
+
+    def __init__(self, bytes_limit=1024**3):
+        """
+        Class initializer.
+        :param bytes_limit: the maximum size of the cached transformers on disk
+        """
+
+        self.bytes_limit = bytes_limit
+        self.location = None
+        self.owner = None
+        self.lock = threading.Lock()
+
+    def get_location(self):
+        """
+        Get the cache directory, creating it on first use.
+        :return: the path of the directory, which can be passed as the memory argument for a sklearn Pipeline
+        """
+
+        with self.lock:
+            if self.location is None or not os.path.isdir(self.location):
+                self.location = tempfile.mkdtemp(prefix='qlik-py-tools-cache-')
+                self.owner = os.getpid()
+        
+        return self.location
+
+    def reduce_size(self):
+        """
+        Remove the least recently used entries until the cache is within its size limit.
+        :return: the number of entries removed
+        """
+
+        with self.lock:
+            if self.location is None:
+                return 0
+
+            entries = []
+
+            # Each cached call is stored by joblib in its own directory with the result in output.pkl
+            for dirpath, dirnames, filenames in os.walk(self.location):
+                if 'output.pkl' in filenames:
+                    try:
+                        size = sum(os.path.getsize(os.path.join(dirpath, f)) for f in filenames)
+                        output = os.path.join(dirpath, 'output.pkl')
+                        last_used = max(os.path.getatime(output), os.path.getmtime(output))
+                    except OSError:
+                        # The entry may have been removed by another process
+                        continue
+
+                    entries.append((last_used, size, dirpath))
+                    dirnames[:] = []
+            
+            total = sum(e[1] for e in entries)
+            removed = 0
+
+            for last_used, size, dirpath in sorted(entries):
+                if total <= self.bytes_limit:
+                    break
+
+                shutil.rmtree(dirpath, ignore_errors=True)
+                total -= size
+                removed += 1
+        
+        if removed > 0:
+            logging.info('Removed {0} entries from the transformer cache to keep it under {1:.0f} MB'\
+                         .format(removed, self.bytes_limit / 1024**2))
+        
+        return removed
+
+    def clear(self):
+        """
+        Delete the cache directory. Only the process that created the directory deletes it.
+        """
+
+        with self.lock:
+            if self.location is not None and self.owner == os.getpid():
+                shutil.rmtree(self.location, ignore_errors=True)
+                self.location = None
+
+# The cache for fitted transformers used by pipelines with cache_preprocessing=true, deleted when the process exits
+transformer_cache = TransformerCache()
+atexit.register(transformer_cache.clear)
+
+# Locks taken with the lock function, so that they can be released with unlock
+_file_locks = {}
+_file_locks_lock = threading.Lock()
+
+def lock(filepath, wait=2, retries=2):
+    """
+    Lock a specified file for writing using a FileLock.
+    If the file is already locked, wait up to wait * retries seconds before timing out.
+    Prefer using FileLock in a with statement, which always releases the lock.
+    """
+
+    file_lock = FileLock(filepath, timeout=wait * retries).acquire()
+
+    with _file_locks_lock:
+        _file_locks[filepath] = file_lock
     
     return True
 
@@ -552,10 +1125,10 @@ def unlock(filepath):
     Unlock a file locked with the lock method.
     """
     
-    # Create a path for the lock file
-    f_lock = filepath + '.lock'
-    # Delete the lock file
-    if Path(f_lock).exists():
-        Path(f_lock).unlink()
+    with _file_locks_lock:
+        file_lock = _file_locks.pop(filepath, None)
+    
+    if file_lock is not None:
+        file_lock.release()
      
     return True